@@ -0,0 +1,312 @@
+"""
+Admission control for the handlers that call DeepSeek.
+
+Every LLM-bound request (chat, reflect, pure chat, their streams and the narrative SSE)
+takes a permit before its handler runs and gives it back when its response is closed.
+The handlers that hold a session turn (SESSION_TURN_ENDPOINTS) take theirs only once the
+turn is theirs: a request queued behind earlier turns of its session holds no permit, and
+the wait is not counted as LLM latency. Duplicates answered from another turn take none.
+The number of permits (the limit) adapts per worker, AIMD style:
+- a response that started within ADMISSION_LATENCY_TOLERANCE x its endpoint's usual
+  latency (or within ADMISSION_LATENCY_FLOOR, so cache hits do not set the bar), while
+  the worker was using its whole limit, raises the limit by 1/limit;
+- a slower response, or a 5xx (a timeout, no key to lease), cuts it by
+  ADMISSION_BACKOFF, at most once per batch of requests admitted before the last cut.
+
+A request over the limit waits in a short queue (ADMISSION_QUEUE_TIMEOUT), served by
+priority class and then arrival: interactive chat first, reflection next, narrative
+generation last. Lower classes may only use a share of the limit, so the interactive
+turns keep headroom. When the queue is full, a higher-priority request pushes out the
+lowest queued one; everything else gets a 503 with Retry-After right away.
+
+Under gthread a waiting request holds a thread as much as a running one, so permits
+plus waiters never exceed ADMISSION_THREADS - ADMISSION_RESERVED_THREADS and
+/api/start, /api/login, /healthz and /metrics always find a free thread.
+"""
+import os
+import math
+import time
+import asyncio
+import threading
+
+from metrics import ADMISSION_DECISIONS, ADMISSION_IN_FLIGHT, ADMISSION_LIMIT, inc, set_gauge, span
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+# gthread threads per worker (the Dockerfile's --threads) and how many stay for cheap endpoints
+ADMISSION_THREADS = int(os.getenv("ADMISSION_THREADS", "8"))
+ADMISSION_RESERVED_THREADS = int(os.getenv("ADMISSION_RESERVED_THREADS", "2"))
+ADMISSION_INITIAL_LIMIT = float(os.getenv("ADMISSION_INITIAL_LIMIT", "4"))
+ADMISSION_MIN_LIMIT = float(os.getenv("ADMISSION_MIN_LIMIT", "1"))
+ADMISSION_MAX_LIMIT = float(os.getenv("ADMISSION_MAX_LIMIT", "64"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "16"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+ADMISSION_LATENCY_TOLERANCE = float(os.getenv("ADMISSION_LATENCY_TOLERANCE", "2"))
+ADMISSION_LATENCY_FLOOR = float(os.getenv("ADMISSION_LATENCY_FLOOR", "1"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.7"))
+# weight of one sample in an endpoint's usual latency (slow, so an overload does not become the norm)
+BASELINE_ALPHA = 0.05
+SERVICE_TIME_ALPHA = 0.2
+MAX_RETRY_AFTER = 30
+
+# priority class -> (rank, share of the limit it may use)
+PRIORITY_CLASSES = {
+    'interactive': (0, 1.0),
+    'reflection': (1, 0.75),
+    'narrative': (2, 0.5),
+}
+# endpoint (view function name) -> priority class; endpoints not listed are never queued
+ENDPOINT_PRIORITIES = {
+    'chat': 'interactive',
+    'chat_stream': 'interactive',
+    'pure_deepseek_chat': 'interactive',
+    'pure_deepseek_chat_stream': 'interactive',
+    'reflect': 'reflection',
+    'reflect_stream': 'reflection',
+    'generate_narrative_sse': 'narrative',
+}
+# endpoints that take their permit in the handler, after the session turn (session_turns.py)
+SESSION_TURN_ENDPOINTS = frozenset(('chat', 'chat_stream', 'pure_deepseek_chat', 'pure_deepseek_chat_stream'))
+
+
+class Overloaded(Exception):
+    """The worker has no LLM capacity for this request; retry after `retry_after` seconds."""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Permit:
+    """One admitted request. responded() feeds its latency to the limit; release() frees it."""
+    def __init__(self, controller, endpoint, priority, in_flight):
+        self.controller = controller
+        self.endpoint = endpoint
+        self.priority = priority
+        self.admitted = time.monotonic()
+        self.in_flight = in_flight  # permits out when this one was granted, itself included
+        self.sampled = False
+        self.released = False
+
+    def responded(self, status):
+        """The response started with `status`; the first call counts."""
+        if not self.sampled:
+            self.sampled = True
+            self.controller._sample(self, status, time.monotonic() - self.admitted)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class _Waiter:
+    def __init__(self, seq, endpoint, priority, loop=None):
+        self.seq = seq
+        self.endpoint = endpoint
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES[priority][0]
+        self.permit = None
+        self.shed = False
+        self.event = threading.Event()
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        if self.future is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    def __init__(self, enabled=ADMISSION_CONTROL, threads=ADMISSION_THREADS,
+                 reserved_threads=ADMISSION_RESERVED_THREADS, initial_limit=ADMISSION_INITIAL_LIMIT,
+                 min_limit=ADMISSION_MIN_LIMIT, max_limit=ADMISSION_MAX_LIMIT,
+                 queue_size=ADMISSION_QUEUE_SIZE, queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+                 latency_tolerance=ADMISSION_LATENCY_TOLERANCE, latency_floor=ADMISSION_LATENCY_FLOOR,
+                 backoff=ADMISSION_BACKOFF):
+        """threads=0 for an event-loop server, where waiting requests cost no thread."""
+        self.enabled = enabled
+        # permits plus waiters may not use more threads than this (None: no thread budget)
+        self.thread_budget = max(1, threads - reserved_threads) if threads else None
+        if self.thread_budget is not None:
+            max_limit = min(max_limit, self.thread_budget)
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = min(max(initial_limit, min_limit), self.max_limit)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.latency_floor = latency_floor
+        self.backoff = backoff
+        self.in_flight = 0
+        self._by_priority = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._waiters = []
+        self._seq = 0
+        self._baselines = {}  # endpoint -> usual seconds until the response starts
+        self._service_time = 1.0  # usual seconds a permit is held
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        set_gauge(ADMISSION_LIMIT, self.limit)
+
+    # --- admission ---
+
+    def acquire(self, endpoint, priority):
+        """Permit for a request of `priority`, waiting in the queue if needed; raises Overloaded."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            permit, waiter = self._enter(endpoint, priority)
+        if permit is not None:
+            return permit
+        with span('admission_queue'):
+            waiter.event.wait(self.queue_timeout)
+            with self._lock:
+                return self._leave(waiter)
+
+    async def aacquire(self, endpoint, priority):
+        """Async twin of acquire(); the wait is a future on the running loop."""
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            permit, waiter = self._enter(endpoint, priority, loop)
+        if permit is not None:
+            return permit
+        with span('admission_queue'):
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                with self._lock:
+                    granted = waiter.permit
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                if granted is not None:
+                    granted.release()
+                raise
+            with self._lock:
+                return self._leave(waiter)
+
+    def _enter(self, endpoint, priority, loop=None):
+        """(permit, None) if admitted now, else (None, queued waiter); raises Overloaded."""
+        rank = PRIORITY_CLASSES[priority][0]
+        if self._admissible(priority) and all(w.rank > rank for w in self._waiters):
+            inc(ADMISSION_DECISIONS, priority, 'admitted')
+            return self._grant(endpoint, priority), None
+        if len(self._waiters) >= self._queue_capacity():
+            worst = max(self._waiters, key=lambda w: (w.rank, w.seq), default=None)
+            if worst is None or worst.rank <= rank:
+                inc(ADMISSION_DECISIONS, priority, 'rejected')
+                raise Overloaded("server is at capacity, retry later", self._retry_after())
+            # a more urgent request takes the place of the least urgent waiter
+            self._waiters.remove(worst)
+            worst.shed = True
+            worst.wake()
+        self._seq += 1
+        waiter = _Waiter(self._seq, endpoint, priority, loop)
+        self._waiters.append(waiter)
+        return None, waiter
+
+    def _leave(self, waiter):
+        """Result of a wait that ended (granted, shed or timed out); lock held."""
+        if waiter.permit is not None:
+            inc(ADMISSION_DECISIONS, waiter.priority, 'queued')
+            return waiter.permit
+        if waiter.shed:
+            inc(ADMISSION_DECISIONS, waiter.priority, 'shed')
+        else:
+            self._waiters.remove(waiter)
+            inc(ADMISSION_DECISIONS, waiter.priority, 'timeout')
+        raise Overloaded("server is at capacity, retry later", self._retry_after())
+
+    def _admissible(self, priority):
+        share = PRIORITY_CLASSES[priority][1]
+        return self.in_flight < max(1, math.floor(self.limit * share))
+
+    def _queue_capacity(self):
+        if self.thread_budget is None:
+            return self.queue_size
+        return max(0, min(self.queue_size, self.thread_budget - self.in_flight))
+
+    def _grant(self, endpoint, priority):
+        self.in_flight += 1
+        self._by_priority[priority] += 1
+        inc(ADMISSION_IN_FLIGHT)
+        return Permit(self, endpoint, priority, self.in_flight)
+
+    def _dispatch(self):
+        """Hand free permits to the waiters, most urgent first; lock held."""
+        while self._waiters:
+            waiter = min(self._waiters, key=lambda w: (w.rank, w.seq))
+            if not self._admissible(waiter.priority):
+                return
+            self._waiters.remove(waiter)
+            waiter.permit = self._grant(waiter.endpoint, waiter.priority)
+            waiter.wake()
+
+    def _release(self, permit):
+        with self._lock:
+            self.in_flight -= 1
+            self._by_priority[permit.priority] -= 1
+            held = time.monotonic() - permit.admitted
+            self._service_time += SERVICE_TIME_ALPHA * (held - self._service_time)
+            self._dispatch()
+        inc(ADMISSION_IN_FLIGHT, amount=-1)
+
+    # --- limit ---
+
+    def _sample(self, permit, status, seconds):
+        if 400 <= status < 500:
+            return  # says nothing about capacity
+        with self._lock:
+            baseline = self._baselines.get(permit.endpoint)
+            if status >= 500:
+                self._decrease(permit)
+            elif baseline is not None and seconds > max(baseline * self.latency_tolerance, self.latency_floor):
+                self._decrease(permit)
+            elif permit.in_flight >= math.floor(self.limit):
+                # only a worker that used its limit learns whether it could take more
+                self._set_limit(self.limit + 1 / self.limit)
+            if status < 500:
+                self._baselines[permit.endpoint] = seconds if baseline is None else (
+                    baseline + BASELINE_ALPHA * (seconds - baseline))
+            self._dispatch()
+
+    def _decrease(self, permit):
+        # the requests admitted before the last cut saw the old limit; one cut per batch
+        if permit.admitted < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self._set_limit(self.limit * self.backoff)
+
+    def _set_limit(self, limit):
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        set_gauge(ADMISSION_LIMIT, self.limit)
+
+    def _retry_after(self):
+        """Seconds until the queue ahead of a new request has likely drained."""
+        waiting = len(self._waiters) + 1
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(self._service_time * waiting / max(1.0, self.limit))))
+
+    def saturated(self):
+        """True when the worker has no spare LLM capacity (for optional, speculative work)."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            return bool(self._waiters) or self.in_flight >= math.floor(self.limit)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'queued': len(self._waiters),
+                'by_priority': dict(self._by_priority),
+                'service_time': round(self._service_time, 3),
+            }
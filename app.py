@@ -1,30 +1,197 @@
-from flask import Flask, request, jsonify,Response,stream_with_context
+from flask import Blueprint, Flask, request, jsonify,Response,stream_with_context,g
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
-import json, time, threading, asyncio
-from queue import Queue
-from session_memory import MongoDBSessionMemoryStore
-from deepseek_key_manager import deepseek_key_manager
+import math
+import logging
+import json, time
+from session_memory import (
+    CHAT_FIELDS,
+    NARRATIVE_FIELDS,
+    PURE_CHAT_FIELDS,
+    REFLECT_FIELDS,
+    MongoDBSessionMemoryStore,
+    new_memory,
+)
+from narrative_jobs import NarrativeJobManager, resume_offset
+from session_turns import SessionBusy, SessionCoordinator, idempotency_key, request_key
+from sse import TextFrames, encode_stream, negotiate, text_event
+from startup import Warmup
+from admission import ENDPOINT_PRIORITIES, SESSION_TURN_ENDPOINTS, AdmissionController, Overloaded
+from deepseek_key_manager import KeyPoolExhausted
+from deadlines import DeadlineExceeded, start_deadline
+import metrics
 from helper import (
     build_chain,
     build_narrative_chain,
     build_reflection_chain,
     call_deepseek_with_fallback,
-    get_history_as_string
+    with_deepseek_key,
+    stream_with_deepseek_key,
+    stream_deepseek_with_fallback,
+    chunk_texts,
+    primed,
+    cached_completion,
+    cached_stream,
+    response_cache,
+    narrative_cache_messages,
+    replay_chunks,
+    prompt_as_messages,
+    narrative_input,
+    intake_concluded,
+    CHAT_PROMPT,
+    REFLECTION_CHAT_PROMPT,
+    GREETING,
+    INITIAL_PROMPT,
+    REFLECTION_PROMPT,
+    PURE_CHAT_SYSTEM_PROMPT,
+)
+from conversation_budget import (
+    budgeted_chat_inputs,
+    budgeted_history_string,
+    estimate_prompt_tokens,
+    fit_to_budget,
+    maybe_schedule_summary,
+    record_prompt_tokens,
+    usage_from_reply,
 )
-from langchain.memory import ConversationBufferWindowMemory
 
 
 load_dotenv()
-app = Flask(__name__)
-CORS(app)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per DeepSeek call is too chatty
+api = Blueprint('api', __name__)
 
 
+# Nothing below connects anywhere: the Mongo client is created on first use in each
+# worker, and the worker warm-up imports LangChain and pings Mongo in the background.
 MONGODB_URI = os.getenv("MONGODB_URI")
 session_memory_store = MongoDBSessionMemoryStore(MONGODB_URI)
+narrative_jobs = NarrativeJobManager(session_memory_store)
+session_turns = SessionCoordinator(session_memory_store)
+warmup = Warmup(session_memory_store)
+admission = AdmissionController()
+
+
+def endpoint_name():
+    return request.endpoint and request.endpoint.rpartition('.')[2]  # without the 'api.' prefix
+
+
+@api.before_app_request
+def start_timer():
+    warmup.start()
+    g.request_started = metrics.begin_request()
+    start_deadline(request.headers.get('X-Request-Timeout'))
+
+
+@api.before_app_request
+def admit():
+    """LLM-bound requests wait for (or are refused) a permit; cheap endpoints pass straight through."""
+    priority = ENDPOINT_PRIORITIES.get(endpoint_name())
+    if priority is None or endpoint_name() in SESSION_TURN_ENDPOINTS:
+        return None
+    try:
+        g.permit = admission.acquire(endpoint_name(), priority)
+    except Overloaded as e:
+        return overloaded_response(e)
+    return None
+
+
+def admit_turn():
+    """The permit of a SESSION_TURN_ENDPOINTS request, once it holds the session turn."""
+    g.permit = admission.acquire(endpoint_name(), ENDPOINT_PRIORITIES[endpoint_name()])
+
+
+@api.after_app_request
+def record_request(resp):
+    if 'request_started' in g:
+        resp.headers['Server-Timing'] = metrics.end_request(endpoint_name(), resp.status_code,
+                                                            g.request_started)
+    if g.get('permit') is not None:
+        g.permit.responded(resp.status_code)
+    return resp
+
 
-@app.route('/api/login', methods=['POST'])
+@api.teardown_app_request
+def release_permit(exc):
+    # streams run inside stream_with_context, so this is once the stream ended or was closed
+    permit = g.pop('permit', None)
+    if permit is not None:
+        permit.release()
+
+
+@api.route('/healthz', methods=['GET'])
+def healthz():
+    """Readiness: 200 once this worker has its LangChain modules loaded and Mongo connected."""
+    ready, report = warmup.status()
+    return jsonify(report), 200 if ready else 503
+
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "metrics disabled"}), 404
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+def keys_exhausted_response(e):
+    """503 with Retry-After when no DeepSeek key could be leased in time."""
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 503
+    if e.retry_after:
+        resp.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    return resp
+
+def overloaded_response(e):
+    """503 with Retry-After when the worker has no LLM capacity left for the request."""
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+def deadline_response(e):
+    """504 when DeepSeek did not answer before the request's deadline."""
+    return jsonify({"error": str(e)}), 504
+
+def session_busy_response(e):
+    """409 when earlier turns of the same session kept it locked past the lock timeout."""
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 409
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+def stream_text_response(chunks, on_complete, on_close=None):
+    """
+    SSE response for a primed text stream, framed like the narrative stream.
+    on_complete(text) persists the turn, and only runs once the stream finished successfully.
+    on_close runs when the response is closed, also if the client left before the end.
+    """
+    def sse_stream():
+        try:
+            yield "event: open\ndata: ok\n\n"
+            parts = []
+            try:
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield text_event(chunk)
+                on_complete("".join(parts))
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'__error__': str(e)})}\n\n"
+            yield "event: done\ndata: end\n\n"
+        finally:
+            if on_close is not None:
+                on_close()
+
+    resp = Response(stream_with_context(sse_stream()), mimetype='text/event-stream')
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # make Nginx not buffer
+    if on_close is not None:
+        # for a stream closed before its first chunk, when the generator never ran
+        resp.call_on_close(on_close)
+    return resp
+
+@api.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
     session_id = data.get("session_id")
@@ -43,17 +210,11 @@ def login():
         return jsonify({"status": "signup", "user": new_profile})
 
 
-@app.route('/api/start', methods=['GET'])
+@api.route('/api/start', methods=['GET'])
 def start():
-    greeting = (
-        "你好，我是一名心理疗愈机器人，感谢你愿意在这里分享。\n"
-        "你可以慢慢告诉我你最近遇到的情绪困境。无论是关于工作、学业上的压力，经济方面的焦虑，"
-        "身体或心理上的不适，还是在人际关系中的烦恼与失落，都可以随意向我倾诉。我会认真聆听，不评判、不催促。\n"
-        "你愿意和我说说看吗？"
-    )
-    return jsonify({"message": greeting})
-
-@app.route('/api/chat', methods=['POST'])
+    return jsonify({"message": GREETING})
+
+@api.route('/api/chat', methods=['POST'])
 def chat():
     data = request.get_json()
     session_id = data.get('session_id')
@@ -62,143 +223,281 @@ def chat():
         return jsonify({"error": "Missing session_id or input"}), 400
 
     session_memory_store.cleanup()
-    session_data = session_memory_store.get(session_id)
-    memory = session_data.get('memory')
-    if not memory:
-        memory = ConversationBufferWindowMemory(k=30, return_messages=True)
-    # Rotate through keys
-    for _ in range(len(deepseek_key_manager.keys)):
-        api_key = deepseek_key_manager.get_key()
-        try:
-            chain = build_chain(memory, api_key)
-            reply = chain.invoke({'input': user_input})
-            memory.save_context({'input': user_input}, {'output': reply.content})
-            session_data['memory'] = memory
-            session_memory_store.set(session_id, session_data)
-            return jsonify({"response": reply.content})
-        except Exception as e:
-            if 'rate limit' in str(e).lower():
-                deepseek_key_manager.rotate()
-                continue
-            else:
-                return jsonify({"error": str(e)}), 500
-    return jsonify({"error": "All API keys exhausted or invalid."}), 500
 
+    def turn(fence):
+        # runs once per distinct turn, in order; duplicates of an in-flight turn share its reply
+        admit_turn()
+        session_data = session_memory_store.get(session_id, CHAT_FIELDS)
+        memory = session_data.get('memory')
+        if not memory:
+            memory = new_memory()
+        inputs = budgeted_chat_inputs(session_data, memory, user_input)
+        estimated = estimate_prompt_tokens(INITIAL_PROMPT, inputs['history'], user_input)
+
+        def complete():
+            # Key leased from the pool; rate-limited keys cool down and the call moves on
+            reply = with_deepseek_key(lambda api_key: build_chain(api_key).invoke(inputs), tokens=estimated,
+                                      hedge='chat')
+            record_prompt_tokens('chat', estimated, usage_from_reply(reply))
+            return reply.content
+
+        reply = cached_completion('chat', lambda: prompt_as_messages(CHAT_PROMPT, inputs), complete)
+        memory.save_context({'input': user_input}, {'output': reply})
+        session_data['memory'] = memory
+        session_memory_store.save_turn(session_id, session_data, user_input, reply, fence=fence)
+        maybe_schedule_summary(session_memory_store, session_id, session_data, memory)
+        speculate_narrative(session_id, memory, reply)
+        return reply
+
+    try:
+        reply = session_turns.run(session_id, request_key('chat', user_input), turn,
+                                  idempotency_key('chat', request.headers.get('Idempotency-Key')))
+        return jsonify({"response": reply})
+    except SessionBusy as e:
+        return session_busy_response(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except KeyPoolExhausted as e:
+        return keys_exhausted_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@api.route('/api/chat_stream', methods=['POST'])
+def chat_stream():
+    """/api/chat as an SSE token stream; the turn is saved once the reply is complete."""
+    data = request.get_json()
+    session_id = data.get('session_id')
+    user_input = data.get('input', '')
+    if not session_id or not user_input:
+        return jsonify({"error": "Missing session_id or input"}), 400
+
+    idempotency = idempotency_key('chat', request.headers.get('Idempotency-Key'))
+    # the session stays locked until the stream is closed
+    try:
+        turn = session_turns.acquire(session_id, idempotency)
+    except SessionBusy as e:
+        return session_busy_response(e)
+    if turn.previous is not None:
+        return stream_text_response(iter(replay_chunks(turn.previous)), lambda reply: None, turn.release)
+
+    try:
+        admit_turn()
+        session_data = session_memory_store.get(session_id, CHAT_FIELDS)
+        memory = session_data.get('memory')
+        if not memory:
+            memory = new_memory()
+        inputs = budgeted_chat_inputs(session_data, memory, user_input)
+        estimated = estimate_prompt_tokens(INITIAL_PROMPT, inputs['history'], user_input)
+        usage = {}
+
+        def stream():
+            return metrics.timed_stream(chunk_texts(stream_with_deepseek_key(
+                lambda api_key: build_chain(api_key, streaming=True).stream(inputs), tokens=estimated
+            ), usage), 'chat')
+
+        def on_complete(reply):
+            if usage:
+                record_prompt_tokens('chat', estimated, usage)
+            memory.save_context({'input': user_input}, {'output': reply})
+            session_data['memory'] = memory
+            session_memory_store.save_turn(session_id, session_data, user_input, reply, fence=turn.fence)
+            turn.finish(reply)
+            maybe_schedule_summary(session_memory_store, session_id, session_data, memory)
+            speculate_narrative(session_id, memory, reply)
+
+        chunks = primed(cached_stream('chat', lambda: prompt_as_messages(CHAT_PROMPT, inputs), stream))
+    except Overloaded as e:
+        turn.release()
+        return overloaded_response(e)
+    except KeyPoolExhausted as e:
+        turn.release()
+        return keys_exhausted_response(e)
+    except DeadlineExceeded as e:
+        turn.release()
+        return deadline_response(e)
+    except Exception as e:
+        turn.release()
+        return jsonify({"error": str(e)}), 500
+    return stream_text_response(chunks, on_complete, turn.release)
+
+
+def narrative_generation(user_input):
+    """(generate, on_complete) for a narrative job on the seed `user_input`."""
+    cache_messages = narrative_cache_messages(user_input)
+    cached_story = response_cache.get('narrative', cache_messages)
+    if cached_story is not None:
+        # replay a cached story through the same job/SSE path as a live generation
+        return lambda: iter(replay_chunks(cached_story)), None
+    generate = lambda: metrics.timed_stream(stream_with_deepseek_key(
+        lambda api_key: build_narrative_chain(api_key).stream({"input": user_input})
+    ), 'narrative')
+    return generate, lambda story: response_cache.set('narrative', cache_messages, story)
+
+
+def speculate_narrative(session_id, memory, reply):
+    """
+    Start writing the narrative as soon as intake concludes, so generate_narrative_sse
+    can serve it from the job; drop an unserved one once the conversation moves on.
+    """
+    user_input = narrative_input(memory)
+    if intake_concluded(reply):
+        if admission.saturated():
+            # no spare LLM capacity; the narrative is generated when it is asked for
+            metrics.inc(metrics.NARRATIVE_SPECULATIONS, 'skipped')
+            return
+        generate, on_complete = narrative_generation(user_input)
+        narrative_jobs.speculate(session_id, user_input, generate, on_complete)
+    else:
+        narrative_jobs.discard_stale(session_id, user_input)
 
-def _last_k_lines(s: str, k: int = 12) -> str:
-    lines = [ln for ln in s.splitlines() if ln.strip()]
-    return "\n".join(lines[-k:])
 
 # === NEW: SSE streaming endpoint ===
-@app.route('/api/generate_narrative_sse', methods=['GET'])
+@api.route('/api/generate_narrative_sse', methods=['GET'])
 def generate_narrative_sse():
     session_id = request.args.get('session_id')
     if not session_id:
         return jsonify({"error": "Missing session_id"}), 400
 
-    session_data = session_memory_store.get(session_id) or {}
+    session_data = session_memory_store.get(session_id, NARRATIVE_FIELDS) or {}
     memory = session_data.get('memory')
     if not memory:
         return jsonify({"error": "No memory found for this session"}), 400
 
-    session_data.pop('story', None) 
     # Build compact seed from recent history
-    chat_history_full = get_history_as_string(memory)
-    chat_history = _last_k_lines(chat_history_full, 12)
-    user_input = f"我的情感困境（摘要）：\n{chat_history}"
-
-    # queue for cross-thread streaming
-    q: Queue = Queue()
-    SENTINEL = object()
-
-    def run_chain_in_thread():
-        async def _run():
-            api_key = deepseek_key_manager.get_key()
-            chain = build_narrative_chain(api_key)
-            try:
-                async for chunk in chain.astream({"input": user_input}):
-                    # StrOutputParser makes `chunk` a plain string
-                    if chunk:
-                        q.put(chunk)
-                q.put(SENTINEL)
-            except Exception as e:
-                # send a structured error for the SSE loop to surface
-                q.put(json.dumps({"__error__": str(e)}))
-                q.put(SENTINEL)
+    user_input = narrative_input(memory)
+    generate, on_complete = narrative_generation(user_input)
 
-        asyncio.run(_run())
-
-    threading.Thread(target=run_chain_in_thread, daemon=True).start()
+    # the job outlives this connection; reconnects and other tabs read from the same buffer
+    job, started = narrative_jobs.open(session_id, user_input, session_data, generate, on_complete)
+    offset = resume_offset(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
 
     def sse_stream():
+        nonlocal offset
         yield "event: open\ndata: ok\n\n"
-        accumulated = []
+        if offset and started:
+            # nothing left to resume: the client restarts from a fresh generation
+            yield "event: reset\ndata: {}\n\n"
+            offset = 0
         last_ping = time.time()
+        frames = TextFrames()
 
         while True:
             # keep-alive pings so proxies don’t buffer/close
-            if time.time() - last_ping > 15:
+            if time.time() - last_ping >= 15:
                 yield "event: ping\ndata: {}\n\n"
                 last_ping = time.time()
 
-            try:
-                item = q.get(timeout=1.0)
-            except Exception:
-                continue
-
-            if item is SENTINEL:
-                full_story = "".join(accumulated).strip()
-                if full_story:
-                    session_data['story'] = full_story
-                    session_memory_store.set(session_id, session_data)
+            # block until new text, held-back text is due or the next ping is due
+            timeout = max(0.0, 15 - (time.time() - last_ping))
+            pending = frames.wait_time()
+            if pending is not None:
+                timeout = min(timeout, pending)
+            chunks, done, error = job.wait_after(offset, timeout=timeout)
+            for end, text in chunks:
+                # event id = character offset, echoed back as Last-Event-ID on reconnect
+                frames.add(end, text)
+                offset = end
+            if done or frames.due():
+                frame = frames.flush()
+                if frame:
+                    yield frame
+
+            if done:
+                if error:
+                    yield f"event: error\ndata: {json.dumps({'__error__': error})}\n\n"
                 yield "event: done\ndata: end\n\n"
                 break
 
-            # surface errors (if any)
-            if isinstance(item, str) and item.startswith('{"__error__"'):
-                yield f"event: error\ndata: {item}\n\n"
-                yield "event: done\ndata: end\n\n"
-                break
-
-            # normal chunk
-            text = item
-            accumulated.append(text)
-            yield f"data: {json.dumps({'text': text})}\n\n"
-
-    resp = Response(stream_with_context(sse_stream()), mimetype='text/event-stream')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    resp = Response(stream_with_context(encode_stream(sse_stream(), encoding)), mimetype='text/event-stream')
     resp.headers["Cache-Control"] = "no-cache"
     resp.headers["X-Accel-Buffering"] = "no"  # make Nginx not buffer
+    resp.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
     return resp
 
-@app.route('/api/reflect', methods=['POST'])
+@api.route('/api/reflect', methods=['POST'])
 def reflect():
     data = request.get_json()
     session_id = data.get('session_id')
     user_input = data.get('input', '')
     if not session_id or not user_input:
         return jsonify({"error": "Missing session_id or input"}), 400
-    session_data = session_memory_store.get(session_id)
+    session_data = session_memory_store.get(session_id, REFLECT_FIELDS)
     memory = session_data.get('memory')
     story = session_data.get('story')
     if not memory or not story:
         return jsonify({"error": "No memory or story found for this session"}), 400
-    history_chat = get_history_as_string(memory)
-    for _ in range(len(deepseek_key_manager.keys)):
-        api_key = deepseek_key_manager.get_key()
-        try:
-            reflector_chain, _ = build_reflection_chain(history_chat, story, api_key)
-            reflection = reflector_chain.invoke({'input': user_input})
-            return jsonify({"reflection": reflection.content})
-        except Exception as e:
-            if 'rate limit' in str(e).lower():
-                deepseek_key_manager.rotate()
-                continue
-            else:
-                return jsonify({"error": str(e)}), 500
-    return jsonify({"error": "All API keys exhausted or invalid."}), 500
-
-
-@app.route('/api/pure_deepseek_chat', methods=['POST'])
+    # summary + token-budgeted recent turns instead of the full history dump
+    history_chat = budgeted_history_string(session_data, memory)
+    estimated = estimate_prompt_tokens(REFLECTION_PROMPT + history_chat + story, [], user_input)
+    inputs = {'input': user_input, 'history_chat': history_chat, 'story': story}
+
+    def complete():
+        reflection = with_deepseek_key(
+            lambda api_key: build_reflection_chain(api_key).invoke(inputs), tokens=estimated, hedge='reflect'
+        )
+        record_prompt_tokens('reflect', estimated, usage_from_reply(reflection))
+        return reflection.content
+
+    try:
+        reflection = cached_completion(
+            'reflect', lambda: prompt_as_messages(REFLECTION_CHAT_PROMPT, inputs), complete
+        )
+        return jsonify({"reflection": reflection})
+    except KeyPoolExhausted as e:
+        return keys_exhausted_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@api.route('/api/reflect_stream', methods=['POST'])
+def reflect_stream():
+    """/api/reflect as an SSE token stream."""
+    data = request.get_json()
+    session_id = data.get('session_id')
+    user_input = data.get('input', '')
+    if not session_id or not user_input:
+        return jsonify({"error": "Missing session_id or input"}), 400
+    session_data = session_memory_store.get(session_id, REFLECT_FIELDS)
+    memory = session_data.get('memory')
+    story = session_data.get('story')
+    if not memory or not story:
+        return jsonify({"error": "No memory or story found for this session"}), 400
+    history_chat = budgeted_history_string(session_data, memory)
+    estimated = estimate_prompt_tokens(REFLECTION_PROMPT + history_chat + story, [], user_input)
+    inputs = {'input': user_input, 'history_chat': history_chat, 'story': story}
+    usage = {}
+
+    def stream():
+        return metrics.timed_stream(chunk_texts(stream_with_deepseek_key(
+            lambda api_key: build_reflection_chain(api_key, streaming=True).stream(inputs), tokens=estimated
+        ), usage), 'reflect')
+
+    def on_complete(reflection):
+        if usage:
+            record_prompt_tokens('reflect', estimated, usage)
+
+    try:
+        chunks = primed(
+            cached_stream('reflect', lambda: prompt_as_messages(REFLECTION_CHAT_PROMPT, inputs), stream)
+        )
+    except KeyPoolExhausted as e:
+        return keys_exhausted_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return stream_text_response(chunks, on_complete)
+
+
+@api.route('/api/pure_deepseek_chat', methods=['POST'])
 def pure_deepseek_chat():
     data = request.get_json()
     session_id = data.get('session_id')
@@ -208,23 +507,108 @@ def pure_deepseek_chat():
     if not session_id:
         return jsonify({"error": "No session_id provided"}), 400
 
-    session_data = session_memory_store.get(session_id) or {}
-    history = session_data.get("messages", [])
+    def turn(fence):
+        admit_turn()
+        session_data = session_memory_store.get(session_id, PURE_CHAT_FIELDS) or {}
+        history = session_data.get("messages", [])
 
-    system_prompt = (
-        "你是一位极其出色的心理疗愈师，擅长帮助用户缓解他们的情绪困境。"
-    )
+        messages = [{"role": "system", "content": PURE_CHAT_SYSTEM_PROMPT}] + fit_to_budget(history) + [
+            {"role": "user", "content": user_message}
+        ]
+        estimated = estimate_prompt_tokens(PURE_CHAT_SYSTEM_PROMPT, messages[1:-1], user_message)
 
-    messages = [{"role": "system", "content": system_prompt}] + history + [
-        {"role": "user", "content": user_message}
-    ]
+        def complete():
+            usage = {}
+            reply = call_deepseek_with_fallback(messages, usage=usage, hedge='pure_chat')
+            record_prompt_tokens('pure_chat', estimated, usage)
+            return reply
 
-    try:
-        reply = call_deepseek_with_fallback(messages)
+        reply = cached_completion('pure_chat', lambda: messages, complete)
         history.append({"role": "user", "content": user_message})
         history.append({"role": "assistant", "content": reply})
         session_data["messages"] = history
-        session_memory_store.set(session_id, session_data)
+        session_memory_store.set(session_id, session_data, fence=fence)
+        return reply
+
+    try:
+        reply = session_turns.run(session_id, request_key('pure_chat', user_message), turn,
+                                  idempotency_key('pure_chat', request.headers.get('Idempotency-Key')))
         return jsonify({"response": reply})
+    except SessionBusy as e:
+        return session_busy_response(e)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except KeyPoolExhausted as e:
+        return keys_exhausted_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": f"AI接口异常，请稍后重试。({str(e)})"}), 500
+
+
+@api.route('/api/pure_deepseek_chat_stream', methods=['POST'])
+def pure_deepseek_chat_stream():
+    """/api/pure_deepseek_chat as an SSE token stream; history is saved once the reply is complete."""
+    data = request.get_json()
+    session_id = data.get('session_id')
+    user_message = data.get('input', '').strip()
+    if not user_message:
+        return jsonify({"error": "No input provided"}), 400
+    if not session_id:
+        return jsonify({"error": "No session_id provided"}), 400
+
+    idempotency = idempotency_key('pure_chat', request.headers.get('Idempotency-Key'))
+    try:
+        turn = session_turns.acquire(session_id, idempotency)
+    except SessionBusy as e:
+        return session_busy_response(e)
+    if turn.previous is not None:
+        return stream_text_response(iter(replay_chunks(turn.previous)), lambda reply: None, turn.release)
+
+    try:
+        admit_turn()
+        session_data = session_memory_store.get(session_id, PURE_CHAT_FIELDS) or {}
+        history = session_data.get("messages", [])
+
+        messages = [{"role": "system", "content": PURE_CHAT_SYSTEM_PROMPT}] + fit_to_budget(history) + [
+            {"role": "user", "content": user_message}
+        ]
+        estimated = estimate_prompt_tokens(PURE_CHAT_SYSTEM_PROMPT, messages[1:-1], user_message)
+        usage = {}
+
+        def on_complete(reply):
+            if usage:
+                record_prompt_tokens('pure_chat', estimated, usage)
+            history.append({"role": "user", "content": user_message})
+            history.append({"role": "assistant", "content": reply})
+            session_data["messages"] = history
+            session_memory_store.set(session_id, session_data, fence=turn.fence)
+            turn.finish(reply)
+
+        chunks = primed(cached_stream('pure_chat', lambda: messages, lambda: metrics.timed_stream(
+            stream_deepseek_with_fallback(messages, usage=usage, tokens=estimated), 'pure_chat'
+        )))
+    except Overloaded as e:
+        turn.release()
+        return overloaded_response(e)
+    except KeyPoolExhausted as e:
+        turn.release()
+        return keys_exhausted_response(e)
+    except DeadlineExceeded as e:
+        turn.release()
+        return deadline_response(e)
     except Exception as e:
+        turn.release()
         return jsonify({"error": f"AI接口异常，请稍后重试。({str(e)})"}), 500
+    return stream_text_response(chunks, on_complete, turn.release)
+
+
+def create_app():
+    """The Flask app (gunicorn: app:app, or app:create_app() for a fresh instance)."""
+    flask_app = Flask(__name__)
+    CORS(flask_app)
+    flask_app.register_blueprint(api)
+    return flask_app
+
+
+app = create_app()
@@ -0,0 +1,621 @@
+"""
+Async-native serving mode for the /api/* routes.
+
+Same endpoints and payloads as the Flask `app`, served by an ASGI server:
+
+    hypercorn -b 0.0.0.0:5000 -w 2 asgi_app:app
+
+LLM calls are awaited on the worker's event loop through the process-wide pooled
+HTTP/2 client, and narrative tokens are streamed straight from the async iterator.
+Blocking pymongo calls run in the default thread pool.
+"""
+import os
+import math
+import logging
+import json
+import asyncio
+from quart import Quart, request, jsonify, Response, g
+from quart_cors import cors
+from dotenv import load_dotenv
+from session_memory import (
+    CHAT_FIELDS,
+    NARRATIVE_FIELDS,
+    PURE_CHAT_FIELDS,
+    REFLECT_FIELDS,
+    MongoDBSessionMemoryStore,
+    flush_all,
+    new_memory,
+)
+from narrative_jobs import NarrativeJobManager, resume_offset
+from session_turns import SessionBusy, SessionCoordinator, idempotency_key, request_key
+from sse import TextFrames, aencode_stream, negotiate, text_event
+from startup import Warmup
+from admission import ENDPOINT_PRIORITIES, SESSION_TURN_ENDPOINTS, AdmissionController, Overloaded
+from deepseek_key_manager import KeyPoolExhausted
+from deadlines import DeadlineExceeded, start_deadline
+import metrics
+from helper import (
+    build_chain,
+    build_narrative_chain,
+    build_reflection_chain,
+    acall_deepseek_with_fallback,
+    awith_deepseek_key,
+    astream_with_deepseek_key,
+    astream_deepseek_with_fallback,
+    achunk_texts,
+    aprimed,
+    acached_completion,
+    acached_stream,
+    response_cache,
+    narrative_cache_messages,
+    replay_chunks,
+    prompt_as_messages,
+    CHAT_PROMPT,
+    REFLECTION_CHAT_PROMPT,
+    narrative_input,
+    intake_concluded,
+    GREETING,
+    INITIAL_PROMPT,
+    REFLECTION_PROMPT,
+    PURE_CHAT_SYSTEM_PROMPT,
+)
+from conversation_budget import (
+    budgeted_chat_inputs,
+    budgeted_history_string,
+    estimate_prompt_tokens,
+    fit_to_budget,
+    maybe_schedule_summary,
+    record_prompt_tokens,
+    usage_from_reply,
+)
+
+PING_INTERVAL = 15
+
+
+def keys_exhausted_response(e):
+    """503 with Retry-After when no DeepSeek key could be leased in time."""
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 503
+    if e.retry_after:
+        resp.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    return resp
+
+
+def overloaded_response(e):
+    """503 with Retry-After when the worker has no LLM capacity left for the request."""
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+
+def deadline_response(e):
+    """504 when DeepSeek did not answer before the request's deadline."""
+    return jsonify({"error": str(e)}), 504
+
+
+def session_busy_response(e):
+    """409 when earlier turns of the same session kept it locked past the lock timeout."""
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 409
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+
+async def areplay(text):
+    for chunk in replay_chunks(text):
+        yield chunk
+
+
+def call_on_close(fn):
+    """
+    Run fn() in a thread once the response is over: sent in full, failed, or the client
+    went away before the body (or even the headers) went out. Like Flask's call_on_close.
+    """
+    request.scope.setdefault('on_close', []).append(fn)
+
+
+def stream_text_response(chunks, on_complete, on_close=None):
+    """
+    SSE response for a primed async text stream, framed like the narrative stream.
+    on_complete(text) is awaited once the stream finished successfully; on_close() is
+    awaited when the stream ends, also if the client went away.
+    """
+    async def sse_stream():
+        try:
+            yield "event: open\ndata: ok\n\n"
+            parts = []
+            try:
+                async for chunk in chunks:
+                    parts.append(chunk)
+                    yield text_event(chunk)
+                await on_complete("".join(parts))
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'__error__': str(e)})}\n\n"
+            yield "event: done\ndata: end\n\n"
+        finally:
+            if on_close is not None:
+                await on_close()
+
+    resp = Response(sse_stream(), mimetype='text/event-stream')
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # make Nginx not buffer
+    resp.timeout = None
+    return resp
+
+
+def create_app(session_memory_store=None):
+    load_dotenv()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    app = cors(Quart(__name__))
+    if session_memory_store is None:
+        session_memory_store = MongoDBSessionMemoryStore(os.getenv("MONGODB_URI"))
+    store = session_memory_store
+    narrative_jobs = NarrativeJobManager(store)
+    session_turns = SessionCoordinator(store)
+    warmup = Warmup(store)
+    # waiting requests are futures on the loop, not threads: no thread budget to keep
+    admission = AdmissionController(threads=0)
+
+    @app.before_serving
+    async def start_warmup():
+        warmup.start()
+
+    @app.after_serving
+    async def flush_session_writes():
+        await asyncio.to_thread(flush_all)
+
+    @app.before_request
+    async def start_timer():
+        g.request_started = metrics.begin_request()
+        start_deadline(request.headers.get('X-Request-Timeout'))
+
+    @app.before_request
+    async def admit():
+        priority = ENDPOINT_PRIORITIES.get(request.endpoint)
+        if priority is None or request.endpoint in SESSION_TURN_ENDPOINTS:
+            return None
+        try:
+            permit = await admission.aacquire(request.endpoint, priority)
+        except Overloaded as e:
+            return overloaded_response(e)
+        # released by close_request once the whole response (a stream included) is sent
+        request.scope['admission_permit'] = permit
+        return None
+
+    async def admit_turn():
+        """The permit of a SESSION_TURN_ENDPOINTS request, once it holds the session turn."""
+        request.scope['admission_permit'] = await admission.aacquire(
+            request.endpoint, ENDPOINT_PRIORITIES[request.endpoint])
+
+    @app.after_request
+    async def record_request(resp):
+        if 'request_started' in g:
+            resp.headers['Server-Timing'] = metrics.end_request(request.endpoint, resp.status_code,
+                                                                g.request_started)
+        permit = request.scope.get('admission_permit')
+        if permit is not None:
+            permit.responded(resp.status_code)
+        return resp
+
+    serve = app.asgi_app
+
+    async def close_request(scope, receive, send):
+        try:
+            await serve(scope, receive, send)
+        finally:
+            permit = scope.get('admission_permit')
+            if permit is not None:
+                permit.release()
+            on_close = scope.get('on_close')
+            if on_close:
+                loop = asyncio.get_running_loop()
+                # shielded: the callbacks run to the end even if this task is being cancelled
+                await asyncio.shield(asyncio.gather(*(loop.run_in_executor(None, fn) for fn in on_close)))
+
+    app.asgi_app = close_request
+
+    @app.route('/healthz', methods=['GET'])
+    async def healthz():
+        ready, report = warmup.status()
+        return jsonify(report), 200 if ready else 503
+
+    @app.route('/metrics', methods=['GET'])
+    async def prometheus_metrics():
+        if not metrics.METRICS_ENABLED:
+            return jsonify({"error": "metrics disabled"}), 404
+        body, content_type = await asyncio.to_thread(metrics.render)
+        return Response(body, content_type=content_type)
+
+    @app.route('/api/login', methods=['POST'])
+    async def login():
+        data = await request.get_json()
+        session_id = data.get("session_id")
+        description = data.get("description", "")
+
+        if not session_id:
+            return jsonify({"error": "Missing session_id"}), 400
+
+        profile = await asyncio.to_thread(store.get_profile, session_id)
+        if profile:
+            return jsonify({"status": "login", "user": profile})
+        new_profile = await asyncio.to_thread(store.upsert_profile, session_id, description)
+        return jsonify({"status": "signup", "user": new_profile})
+
+    @app.route('/api/start', methods=['GET'])
+    async def start():
+        return jsonify({"message": GREETING})
+
+    @app.route('/api/chat', methods=['POST'])
+    async def chat():
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        user_input = data.get('input', '')
+        if not session_id or not user_input:
+            return jsonify({"error": "Missing session_id or input"}), 400
+
+        async def turn(fence):
+            await admit_turn()
+            session_data = await asyncio.to_thread(store.get, session_id, CHAT_FIELDS)
+            memory = session_data.get('memory')
+            if not memory:
+                memory = new_memory()
+            inputs = budgeted_chat_inputs(session_data, memory, user_input)
+            estimated = estimate_prompt_tokens(INITIAL_PROMPT, inputs['history'], user_input)
+
+            async def complete():
+                reply = await awith_deepseek_key(
+                    lambda api_key: build_chain(api_key).ainvoke(inputs), tokens=estimated, hedge='chat'
+                )
+                record_prompt_tokens('chat', estimated, usage_from_reply(reply))
+                return reply.content
+
+            reply = await acached_completion('chat', lambda: prompt_as_messages(CHAT_PROMPT, inputs), complete)
+            memory.save_context({'input': user_input}, {'output': reply})
+            session_data['memory'] = memory
+            await asyncio.to_thread(store.save_turn, session_id, session_data, user_input, reply, fence=fence)
+            maybe_schedule_summary(store, session_id, session_data, memory)
+            await speculate_narrative(session_id, memory, reply)
+            return reply
+
+        try:
+            reply = await session_turns.arun(session_id, request_key('chat', user_input), turn,
+                                             idempotency_key('chat', request.headers.get('Idempotency-Key')))
+            return jsonify({"response": reply})
+        except SessionBusy as e:
+            return session_busy_response(e)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except KeyPoolExhausted as e:
+            return keys_exhausted_response(e)
+        except DeadlineExceeded as e:
+            return deadline_response(e)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/chat_stream', methods=['POST'])
+    async def chat_stream():
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        user_input = data.get('input', '')
+        if not session_id or not user_input:
+            return jsonify({"error": "Missing session_id or input"}), 400
+
+        idempotency = idempotency_key('chat', request.headers.get('Idempotency-Key'))
+        # the session stays locked until the stream is closed
+        try:
+            turn = await session_turns.aacquire(session_id, idempotency)
+        except SessionBusy as e:
+            return session_busy_response(e)
+        # released when the stream ends, or by close_request if the response never gets that far
+        call_on_close(turn.release)
+        release = turn.arelease
+        if turn.previous is not None:
+            return stream_text_response(areplay(turn.previous), lambda reply: asyncio.sleep(0), release)
+
+        try:
+            await admit_turn()
+            session_data = await asyncio.to_thread(store.get, session_id, CHAT_FIELDS)
+            memory = session_data.get('memory')
+            if not memory:
+                memory = new_memory()
+            inputs = budgeted_chat_inputs(session_data, memory, user_input)
+            estimated = estimate_prompt_tokens(INITIAL_PROMPT, inputs['history'], user_input)
+            usage = {}
+
+            def stream():
+                return metrics.atimed_stream(achunk_texts(astream_with_deepseek_key(
+                    lambda api_key: build_chain(api_key, streaming=True).astream(inputs), tokens=estimated
+                ), usage), 'chat')
+
+            async def on_complete(reply):
+                if usage:
+                    record_prompt_tokens('chat', estimated, usage)
+                memory.save_context({'input': user_input}, {'output': reply})
+                session_data['memory'] = memory
+                await asyncio.to_thread(store.save_turn, session_id, session_data, user_input, reply,
+                                        fence=turn.fence)
+                turn.finish(reply)
+                maybe_schedule_summary(store, session_id, session_data, memory)
+                await speculate_narrative(session_id, memory, reply)
+
+            chunks = await aprimed(await acached_stream(
+                'chat', lambda: prompt_as_messages(CHAT_PROMPT, inputs), stream
+            ))
+        except Overloaded as e:
+            await release()
+            return overloaded_response(e)
+        except KeyPoolExhausted as e:
+            await release()
+            return keys_exhausted_response(e)
+        except DeadlineExceeded as e:
+            await release()
+            return deadline_response(e)
+        except Exception as e:
+            await release()
+            return jsonify({"error": str(e)}), 500
+        return stream_text_response(chunks, on_complete, release)
+
+    async def narrative_generation(user_input):
+        """(agenerate, on_complete) for a narrative job on the seed `user_input`."""
+        cache_messages = narrative_cache_messages(user_input)
+        cached_story = await asyncio.to_thread(response_cache.get, 'narrative', cache_messages)
+        if cached_story is not None:
+            # a cached story goes through the same job/SSE path as a live generation
+            return lambda: areplay(cached_story), None
+        agenerate = lambda: metrics.atimed_stream(astream_with_deepseek_key(
+            lambda api_key: build_narrative_chain(api_key).astream({"input": user_input})
+        ), 'narrative')
+        return agenerate, lambda story: response_cache.set('narrative', cache_messages, story)
+
+    async def speculate_narrative(session_id, memory, reply):
+        """Start the narrative once intake concludes; drop an unserved one when the chat moves on."""
+        user_input = narrative_input(memory)
+        if intake_concluded(reply):
+            if admission.saturated():
+                metrics.inc(metrics.NARRATIVE_SPECULATIONS, 'skipped')
+                return
+            agenerate, on_complete = await narrative_generation(user_input)
+            await narrative_jobs.aspeculate(session_id, user_input, agenerate, on_complete)
+        else:
+            await asyncio.to_thread(narrative_jobs.discard_stale, session_id, user_input)
+
+    @app.route('/api/generate_narrative_sse', methods=['GET'])
+    async def generate_narrative_sse():
+        session_id = request.args.get('session_id')
+        if not session_id:
+            return jsonify({"error": "Missing session_id"}), 400
+
+        session_data = await asyncio.to_thread(store.get, session_id, NARRATIVE_FIELDS) or {}
+        memory = session_data.get('memory')
+        if not memory:
+            return jsonify({"error": "No memory found for this session"}), 400
+
+        user_input = narrative_input(memory)
+        agenerate, on_complete = await narrative_generation(user_input)
+
+        # the job outlives this connection; reconnects and other tabs read from the same buffer
+        job, started = await narrative_jobs.aopen(session_id, user_input, session_data, agenerate, on_complete)
+        offset = resume_offset(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+
+        async def sse_stream():
+            nonlocal offset
+            yield "event: open\ndata: ok\n\n"
+            if offset and started:
+                # nothing left to resume: the client restarts from a fresh generation
+                yield "event: reset\ndata: {}\n\n"
+                offset = 0
+            frames = TextFrames()
+            while True:
+                pending = frames.wait_time()
+                chunks, done, error = await job.await_after(offset, PING_INTERVAL if pending is None else pending)
+                for end, text in chunks:
+                    # event id = character offset, echoed back as Last-Event-ID on reconnect
+                    frames.add(end, text)
+                    offset = end
+                if done or frames.due():
+                    frame = frames.flush()
+                    if frame:
+                        yield frame
+                elif not chunks and pending is None:
+                    # keep-alive pings so proxies don’t buffer/close while the model is thinking
+                    yield "event: ping\ndata: {}\n\n"
+                if done:
+                    if error:
+                        yield f"event: error\ndata: {json.dumps({'__error__': error})}\n\n"
+                    yield "event: done\ndata: end\n\n"
+                    return
+
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        resp = Response(aencode_stream(sse_stream(), encoding), mimetype='text/event-stream')
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.headers["X-Accel-Buffering"] = "no"  # make Nginx not buffer
+        resp.headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+        resp.timeout = None  # streams outlive Quart's default response timeout
+        return resp
+
+    @app.route('/api/reflect', methods=['POST'])
+    async def reflect():
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        user_input = data.get('input', '')
+        if not session_id or not user_input:
+            return jsonify({"error": "Missing session_id or input"}), 400
+        session_data = await asyncio.to_thread(store.get, session_id, REFLECT_FIELDS)
+        memory = session_data.get('memory')
+        story = session_data.get('story')
+        if not memory or not story:
+            return jsonify({"error": "No memory or story found for this session"}), 400
+        history_chat = budgeted_history_string(session_data, memory)
+        estimated = estimate_prompt_tokens(REFLECTION_PROMPT + history_chat + story, [], user_input)
+        inputs = {'input': user_input, 'history_chat': history_chat, 'story': story}
+
+        async def complete():
+            reflection = await awith_deepseek_key(
+                lambda api_key: build_reflection_chain(api_key).ainvoke(inputs), tokens=estimated,
+                hedge='reflect'
+            )
+            record_prompt_tokens('reflect', estimated, usage_from_reply(reflection))
+            return reflection.content
+
+        try:
+            reflection = await acached_completion(
+                'reflect', lambda: prompt_as_messages(REFLECTION_CHAT_PROMPT, inputs), complete
+            )
+            return jsonify({"reflection": reflection})
+        except KeyPoolExhausted as e:
+            return keys_exhausted_response(e)
+        except DeadlineExceeded as e:
+            return deadline_response(e)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/reflect_stream', methods=['POST'])
+    async def reflect_stream():
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        user_input = data.get('input', '')
+        if not session_id or not user_input:
+            return jsonify({"error": "Missing session_id or input"}), 400
+        session_data = await asyncio.to_thread(store.get, session_id, REFLECT_FIELDS)
+        memory = session_data.get('memory')
+        story = session_data.get('story')
+        if not memory or not story:
+            return jsonify({"error": "No memory or story found for this session"}), 400
+        history_chat = budgeted_history_string(session_data, memory)
+        estimated = estimate_prompt_tokens(REFLECTION_PROMPT + history_chat + story, [], user_input)
+        inputs = {'input': user_input, 'history_chat': history_chat, 'story': story}
+        usage = {}
+
+        def stream():
+            return metrics.atimed_stream(achunk_texts(astream_with_deepseek_key(
+                lambda api_key: build_reflection_chain(api_key, streaming=True).astream(inputs), tokens=estimated
+            ), usage), 'reflect')
+
+        async def on_complete(reflection):
+            if usage:
+                record_prompt_tokens('reflect', estimated, usage)
+
+        try:
+            chunks = await aprimed(await acached_stream(
+                'reflect', lambda: prompt_as_messages(REFLECTION_CHAT_PROMPT, inputs), stream
+            ))
+        except KeyPoolExhausted as e:
+            return keys_exhausted_response(e)
+        except DeadlineExceeded as e:
+            return deadline_response(e)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        return stream_text_response(chunks, on_complete)
+
+    @app.route('/api/pure_deepseek_chat', methods=['POST'])
+    async def pure_deepseek_chat():
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        user_message = data.get('input', '').strip()
+        if not user_message:
+            return jsonify({"error": "No input provided"}), 400
+        if not session_id:
+            return jsonify({"error": "No session_id provided"}), 400
+
+        async def turn(fence):
+            await admit_turn()
+            session_data = await asyncio.to_thread(store.get, session_id, PURE_CHAT_FIELDS) or {}
+            history = session_data.get("messages", [])
+            messages = [{"role": "system", "content": PURE_CHAT_SYSTEM_PROMPT}] + fit_to_budget(history) + [
+                {"role": "user", "content": user_message}
+            ]
+            estimated = estimate_prompt_tokens(PURE_CHAT_SYSTEM_PROMPT, messages[1:-1], user_message)
+
+            async def complete():
+                usage = {}
+                reply = await acall_deepseek_with_fallback(messages, usage=usage, hedge='pure_chat')
+                record_prompt_tokens('pure_chat', estimated, usage)
+                return reply
+
+            reply = await acached_completion('pure_chat', lambda: messages, complete)
+            history.append({"role": "user", "content": user_message})
+            history.append({"role": "assistant", "content": reply})
+            session_data["messages"] = history
+            await asyncio.to_thread(store.set, session_id, session_data, fence=fence)
+            return reply
+
+        try:
+            reply = await session_turns.arun(session_id, request_key('pure_chat', user_message), turn,
+                                             idempotency_key('pure_chat', request.headers.get('Idempotency-Key')))
+            return jsonify({"response": reply})
+        except SessionBusy as e:
+            return session_busy_response(e)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except KeyPoolExhausted as e:
+            return keys_exhausted_response(e)
+        except DeadlineExceeded as e:
+            return deadline_response(e)
+        except Exception as e:
+            return jsonify({"error": f"AI接口异常，请稍后重试。({str(e)})"}), 500
+
+    @app.route('/api/pure_deepseek_chat_stream', methods=['POST'])
+    async def pure_deepseek_chat_stream():
+        data = await request.get_json()
+        session_id = data.get('session_id')
+        user_message = data.get('input', '').strip()
+        if not user_message:
+            return jsonify({"error": "No input provided"}), 400
+        if not session_id:
+            return jsonify({"error": "No session_id provided"}), 400
+
+        idempotency = idempotency_key('pure_chat', request.headers.get('Idempotency-Key'))
+        try:
+            turn = await session_turns.aacquire(session_id, idempotency)
+        except SessionBusy as e:
+            return session_busy_response(e)
+        # released when the stream ends, or by close_request if the response never gets that far
+        call_on_close(turn.release)
+        release = turn.arelease
+        if turn.previous is not None:
+            return stream_text_response(areplay(turn.previous), lambda reply: asyncio.sleep(0), release)
+
+        try:
+            await admit_turn()
+            session_data = await asyncio.to_thread(store.get, session_id, PURE_CHAT_FIELDS) or {}
+            history = session_data.get("messages", [])
+            messages = [{"role": "system", "content": PURE_CHAT_SYSTEM_PROMPT}] + fit_to_budget(history) + [
+                {"role": "user", "content": user_message}
+            ]
+            estimated = estimate_prompt_tokens(PURE_CHAT_SYSTEM_PROMPT, messages[1:-1], user_message)
+            usage = {}
+
+            async def on_complete(reply):
+                if usage:
+                    record_prompt_tokens('pure_chat', estimated, usage)
+                history.append({"role": "user", "content": user_message})
+                history.append({"role": "assistant", "content": reply})
+                session_data["messages"] = history
+                await asyncio.to_thread(store.set, session_id, session_data, fence=turn.fence)
+                turn.finish(reply)
+
+            chunks = await aprimed(await acached_stream('pure_chat', lambda: messages, lambda: metrics.atimed_stream(
+                astream_deepseek_with_fallback(messages, usage=usage, tokens=estimated), 'pure_chat'
+            )))
+        except Overloaded as e:
+            await release()
+            return overloaded_response(e)
+        except KeyPoolExhausted as e:
+            await release()
+            return keys_exhausted_response(e)
+        except DeadlineExceeded as e:
+            await release()
+            return deadline_response(e)
+        except Exception as e:
+            await release()
+            return jsonify({"error": f"AI接口异常，请稍后重试。({str(e)})"}), 500
+        return stream_text_response(chunks, on_complete, release)
+
+    return app
+
+
+app = create_app()
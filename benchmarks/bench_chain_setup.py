@@ -0,0 +1,75 @@
+"""
+Per-request chain setup overhead: rebuilding prompt + ChatOpenAI + LCEL pipeline on
+every request (previous behaviour) versus fetching the compiled pipeline from the
+registry and building its runtime inputs.
+
+    DEEPSEEK_API_KEY_1=dummy python benchmarks/bench_chain_setup.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from langchain_openai import ChatOpenAI  # noqa: E402
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder  # noqa: E402
+from langchain.memory import ConversationBufferWindowMemory  # noqa: E402
+from langchain.schema.runnable import RunnablePassthrough, RunnableLambda  # noqa: E402
+from helper import INITIAL_PROMPT, build_chain, chat_inputs  # noqa: E402
+
+ITERATIONS = 200
+API_KEY = os.getenv("DEEPSEEK_API_KEY_1", "dummy")
+
+
+def legacy_build_chain(memory, openai_api_key):
+    prompt = ChatPromptTemplate.from_messages([
+        ('system', INITIAL_PROMPT),
+        MessagesPlaceholder(variable_name='history'),
+        ('human', '{input}')
+    ])
+    llm = ChatOpenAI(
+        model="deepseek-chat",
+        temperature=0.7,
+        max_tokens=None,
+        openai_api_key=openai_api_key,
+        openai_api_base="https://api.deepseek.com/v1",
+    )
+    return (
+        RunnablePassthrough.assign(
+            history=RunnableLambda(memory.load_memory_variables) | itemgetter('history')
+        )
+        | prompt
+        | llm
+    )
+
+
+def registry_build_chain(memory, openai_api_key):
+    return build_chain(openai_api_key), chat_inputs(memory, "你好")
+
+
+def measure(label, fn, memory):
+    fn(memory, API_KEY)  # warm-up (registry builds its pipeline once here)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fn(memory, API_KEY)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size for stat in snapshot.statistics('filename'))
+    print(f"{label:<10}{elapsed / ITERATIONS * 1e6:>12.1f} us/req"
+          f"{allocated / ITERATIONS / 1024:>12.1f} KiB retained/req{peak / 1024:>12.1f} KiB peak")
+
+
+def main():
+    memory = ConversationBufferWindowMemory(k=30, return_messages=True)
+    for i in range(30):
+        memory.save_context({'input': f"用户消息 {i}"}, {'output': f"回复 {i}"})
+    measure('legacy', legacy_build_chain, memory)
+    measure('registry', registry_build_chain, memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Deadlines, stall detection and hedging (deadlines.py, with_deepseek_key) against the
+fake DeepSeek, through the Dockerfile's gunicorn command (one mongomock_wsgi worker).
+
+- stalls: a third of the streams go silent before their first token for longer than the
+  client waits. With DEEPSEEK_STALL_TIMEOUT the stall is cut off and the turn moves to
+  another key (3 keys here); without it (stall timeout above the client timeout) those
+  turns are lost.
+- deadline: DeepSeek takes 5s and the client sends X-Request-Timeout: 1; the turn
+  comes back as a 504 after about a second instead of after the full reply.
+- hedging: 2% of the calls take 3s longer; with DEEPSEEK_HEDGING=1 a call still running
+  past the recent p95 is duplicated on another key, for at most ~10% extra calls.
+
+    python benchmarks/bench_deadlines.py
+"""
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+from load_test import percentile, start_app  # noqa: E402
+
+KEYS = 3
+CLIENT_TIMEOUT = 15.0
+STALL_TURNS = 30
+HEDGE_TURNS = 300
+CONCURRENCY = 4
+
+os.environ.setdefault("NARRATIVE_SPECULATION", "0")
+os.environ.setdefault("ADMISSION_CONTROL", "0")
+
+
+def turn(base_url, path, headers=None):
+    """(status or 'timeout', seconds) for one new-session turn."""
+    start = time.perf_counter()
+    try:
+        with httpx.stream('POST', f"{base_url}{path}", timeout=CLIENT_TIMEOUT, headers=headers,
+                          json={'session_id': f"dl-{uuid.uuid4().hex[:12]}", 'input': '最近总是睡不好，怎么办？'}) as resp:
+            body = resp.read().decode()
+            status = resp.status_code
+            if status == 200 and path.endswith('_stream') and 'event: error' in body:
+                status = 'error event'
+    except httpx.TimeoutException:
+        status = 'timeout'
+    return status, time.perf_counter() - start
+
+
+def run(env, config, path, turns, headers=None):
+    os.environ.update(env)
+    _, deepseek_base = serve(config)
+    process, base_url = start_app(SimpleNamespace(keys=KEYS), deepseek_base, None)
+    try:
+        turn(base_url, path)  # warm up
+        config.received = 0
+        with ThreadPoolExecutor(CONCURRENCY) as pool:
+            results = list(pool.map(lambda _: turn(base_url, path, headers), range(turns)))
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def summary(results):
+    ok = [seconds for status, seconds in results if status == 200]
+    failed = {}
+    for status, _ in results:
+        if status != 200:
+            failed[status] = failed.get(status, 0) + 1
+    return ok, failed
+
+
+def main():
+    print(f"stalls: {STALL_TURNS} streamed turns, 1/3 stall 60s before the first token")
+    for stall_timeout in ('2', '60'):
+        config = FakeDeepSeekConfig(latency=0.2, reply_tokens=40, stall_rate=1 / 3, stall_seconds=60, stall_after=0)
+        results = run({'DEEPSEEK_STALL_TIMEOUT': stall_timeout}, config, '/api/pure_deepseek_chat_stream',
+                      STALL_TURNS)
+        ok, failed = summary(results)
+        print(f"  DEEPSEEK_STALL_TIMEOUT={stall_timeout:>2}: {len(ok)}/{len(results)} ok, "
+              f"p50 {percentile(ok, 0.5):.2f}s, max {max(ok, default=0):.2f}s, "
+              f"failed {failed or '-'}, stalls injected {config.stalled}")
+
+    config = FakeDeepSeekConfig(latency=5.0, reply_tokens=40)
+    results = run({}, config, '/api/pure_deepseek_chat', 6, headers={'X-Request-Timeout': '1'})
+    print("deadline: DeepSeek 5s, X-Request-Timeout: 1 -> "
+          + ", ".join(f"{status} in {seconds:.2f}s" for status, seconds in results))
+
+    print(f"hedging: {HEDGE_TURNS} /api/pure_deepseek_chat turns, 2% of calls +3s")
+    print(f"{'hedging':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}{'calls/turn':>12}")
+    for hedging in ('0', '1'):
+        config = FakeDeepSeekConfig(latency=0.3, reply_tokens=20, tokens_per_second=100,
+                                    tail_rate=0.02, tail_latency=3.0)
+        results = run({'DEEPSEEK_HEDGING': hedging}, config, '/api/pure_deepseek_chat', HEDGE_TURNS)
+        ok, failed = summary(results)
+        print(f"{'on' if hedging == '1' else 'off':>9}{percentile(ok, 0.5):>8.2f}{percentile(ok, 0.95):>8.2f}"
+              f"{percentile(ok, 0.99):>8.2f}{max(ok, default=0):>8.2f}{config.received / len(results):>12.3f}"
+              + (f"  failed {failed}" if failed else ""))
+
+
+if __name__ == '__main__':
+    main()
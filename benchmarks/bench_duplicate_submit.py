@@ -0,0 +1,125 @@
+"""
+Duplicate-submit storms and concurrent turns against the real Flask app, with the
+per-session coordination (session_turns.py) switched off and on.
+
+- duplicate storm: every session gets the same /api/chat request DUPLICATES times at
+  once, as a client retrying with one Idempotency-Key; counts DeepSeek calls and the
+  turns that end up stored.
+- concurrent turns: every session gets DISTINCT different /api/pure_deepseek_chat inputs
+  at once; counts the messages that survive in the stored history (lost updates).
+- cross-worker: two coordinators on one store (as two gunicorn workers would have) run
+  the same request (same idempotency key) at once; counts how often the work actually ran.
+- repeat: the same input sent again after the first reply, without an Idempotency-Key,
+  is a new turn; counts the turns stored.
+
+DeepSeek is the local fake and mongomock stands in for Mongo (pip install mongomock).
+
+    python benchmarks/bench_duplicate_submit.py
+"""
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+
+config = FakeDeepSeekConfig(latency=0.2, tokens_per_second=200, reply_tokens=20)
+_, base_url = serve(config)
+os.environ["DEEPSEEK_API_BASE"] = base_url
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench-key-1")
+os.environ.setdefault("DEEPSEEK_API_KEY_2", "bench-key-2")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# the storms below are far past one worker's admission limit; this measures the session coordination
+os.environ.setdefault("ADMISSION_CONTROL", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mongomock  # noqa: E402
+import session_memory  # noqa: E402
+session_memory.MongoClient = mongomock.MongoClient
+import app  # noqa: E402
+from session_turns import SessionCoordinator  # noqa: E402
+
+SESSIONS = 8
+DUPLICATES = 5
+DISTINCT = 4
+
+
+def post(path, body, headers=None):
+    return app.app.test_client().post(path, json=body, headers=headers).status_code
+
+
+def storm(requests):
+    """Fire all (path, body) requests at once; (deepseek calls, statuses, seconds)."""
+    before = config.completed
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(requests)) as pool:
+        statuses = list(pool.map(lambda r: post(*r), requests))
+    return config.completed - before, statuses, time.perf_counter() - start
+
+
+def duplicate_storm(run):
+    sessions = [f"dup-{run}-{uuid.uuid4().hex[:8]}" for _ in range(SESSIONS)]
+    requests = [('/api/chat', {'session_id': s, 'input': '我最近总是睡不好。'}, {'Idempotency-Key': f"{s}-1"})
+                for s in sessions for _ in range(DUPLICATES)]
+    calls, statuses, elapsed = storm(requests)
+    turns = sum(app.session_memory_store.get(s).get('turn_count', 0) for s in sessions)
+    return calls, turns, statuses, elapsed
+
+
+def concurrent_turns(run):
+    sessions = [f"seq-{run}-{uuid.uuid4().hex[:8]}" for _ in range(SESSIONS)]
+    requests = [('/api/pure_deepseek_chat', {'session_id': s, 'input': f'第{i}个问题'})
+                for s in sessions for i in range(DISTINCT)]
+    calls, statuses, elapsed = storm(requests)
+    kept = sum(len(app.session_memory_store.get(s).get('messages', [])) // 2 for s in sessions)
+    return calls, kept, statuses, elapsed
+
+
+def cross_worker():
+    workers = [SessionCoordinator(app.session_memory_store) for _ in range(2)]
+    runs = []
+
+    def work(fence):
+        runs.append(fence)
+        time.sleep(0.2)
+        return 'reply'
+
+    session_id = f"xw-{uuid.uuid4().hex[:8]}"
+    with ThreadPoolExecutor(2 * DUPLICATES) as pool:
+        results = list(pool.map(lambda i: workers[i % 2].run(session_id, 'same-input', work, 'same-key'),
+                                range(2 * DUPLICATES)))
+    return len(runs), results.count('reply')
+
+
+def repeat():
+    session_id = f"rep-{uuid.uuid4().hex[:8]}"
+    before = config.completed
+    for _ in range(2):
+        post('/api/chat', {'session_id': session_id, 'input': '好'})
+    return config.completed - before, app.session_memory_store.get(session_id).get('turn_count', 0)
+
+
+def main():
+    print(f"{SESSIONS} sessions, fake DeepSeek {config.latency * 1000:.0f} ms to first token")
+    print(f"{'scenario':<34}{'coordination':>13}{'LLM calls':>11}{'stored':>8}{'expected':>10}"
+          f"{'non-200':>9}{'seconds':>9}")
+    for enabled in (False, True):
+        app.session_turns.enabled = enabled
+        label = 'on' if enabled else 'off'
+        calls, turns, statuses, elapsed = duplicate_storm(label)
+        print(f"{f'chat x{DUPLICATES} identical':<34}{label:>13}{calls:>11}{turns:>8}{SESSIONS:>10}"
+              f"{sum(s != 200 for s in statuses):>9}{elapsed:>9.2f}")
+        calls, kept, statuses, elapsed = concurrent_turns(label)
+        print(f"{f'pure chat x{DISTINCT} distinct':<34}{label:>13}{calls:>11}{kept:>8}"
+              f"{SESSIONS * DISTINCT:>10}{sum(s != 200 for s in statuses):>9}{elapsed:>9.2f}")
+    runs, answered = cross_worker()
+    print(f"cross-worker: {2 * DUPLICATES} identical requests on 2 coordinators ran the work "
+          f"{runs} time(s), {answered} answered")
+    calls, turns = repeat()
+    print(f"repeat: the same input sent twice in a row made {calls} LLM calls, stored {turns} turns")
+
+
+if __name__ == '__main__':
+    main()
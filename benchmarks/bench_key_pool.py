@@ -0,0 +1,61 @@
+"""
+Throughput of call_deepseek_with_fallback against the local fake server when every
+key is rate limited to the same requests-per-minute, for 1, 2 and 4 keys.
+Completed calls per second should scale with the number of keys.
+
+    python benchmarks/bench_key_pool.py
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+
+RPM_PER_KEY = 120
+CONCURRENCY = 16
+DURATION = 10.0
+
+config = FakeDeepSeekConfig(latency=0.05, tokens_per_second=2000, rpm_per_key=RPM_PER_KEY)
+_, base_url = serve(config)
+os.environ["DEEPSEEK_API_BASE"] = base_url
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench-key-1")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import helper  # noqa: E402
+from deepseek_key_manager import DeepSeekKeyManager, KeyPoolExhausted  # noqa: E402
+
+
+def run(n_keys):
+    helper.deepseek_key_manager = DeepSeekKeyManager(keys=[f"bench-{n_keys}-{i}" for i in range(n_keys)])
+    deadline = time.monotonic() + DURATION
+    messages = [{"role": "user", "content": "你好"}]
+
+    def worker():
+        ok = failed = 0
+        while time.monotonic() < deadline:
+            try:
+                helper.call_deepseek_with_fallback(messages)
+                ok += 1
+            except KeyPoolExhausted:
+                failed += 1
+        return ok, failed
+
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        results = [f.result() for f in [pool.submit(worker) for _ in range(CONCURRENCY)]]
+    ok = sum(r[0] for r in results)
+    failed = sum(r[1] for r in results)
+    stats = helper.deepseek_key_manager.stats()
+    print(f"{n_keys:>5}{ok / DURATION:>12.1f}{failed:>10}{stats['rate_limited']:>10}{stats['cooldowns']:>11}")
+
+
+def main():
+    print(f"per-key limit {RPM_PER_KEY} rpm, {CONCURRENCY} concurrent callers, {DURATION:.0f}s per run")
+    print(f"{'keys':>5}{'calls/s':>12}{'failed':>10}{'429s':>10}{'cooldowns':>11}")
+    for n_keys in (1, 2, 4):
+        run(n_keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+LLM calls spent on one narrative when the client drops mid-stream and reconnects with
+Last-Event-ID, plus a second tab subscribing to the same generation. With narrative
+jobs the whole exchange should cost exactly one streaming call to the fake server.
+
+Uses mongomock for the session store (pip install mongomock).
+
+    python benchmarks/bench_narrative_resume.py
+"""
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+
+config = FakeDeepSeekConfig(latency=0.05, tokens_per_second=100, reply_tokens=200)
+_, base_url = serve(config)
+os.environ["DEEPSEEK_API_BASE"] = base_url
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench-key-1")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mongomock  # noqa: E402
+import session_memory  # noqa: E402
+session_memory.MongoClient = mongomock.MongoClient
+import app  # noqa: E402
+
+URL = '/api/generate_narrative_sse?session_id=bench'
+
+
+def events(body):
+    """(id, text) pairs of the data events in an SSE body."""
+    pairs = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if ": " in line)
+        if 'id' in fields:
+            pairs.append((int(fields['id']), json.loads(fields['data'])['text']))
+    return pairs
+
+
+def main():
+    client = app.app.test_client()
+    client.post('/api/chat', json={'session_id': 'bench', 'input': '最近工作压力很大，总是睡不好。'})
+    calls_before = config.completed
+
+    # first tab: read a few events, then drop the connection
+    resp = client.get(URL, buffered=False)
+    received = []
+    for part in resp.response:
+        received += events(part.decode() if isinstance(part, bytes) else part)
+        if len(received) >= 20:
+            break
+    resp.close()
+    last_id = received[-1][0]
+
+    # second tab subscribes while the job is still running
+    other_tab = events(client.get(URL).get_data(as_text=True))
+    # first tab reconnects with the offset it got to
+    resumed = events(client.get(URL, headers={'Last-Event-ID': str(last_id)}).get_data(as_text=True))
+
+    story = app.session_memory_store.get('bench')['story']
+    first_tab = "".join(t for _, t in received + resumed)
+    print(f"dropped after {last_id} chars, resumed {len(resumed)} events")
+    print(f"first tab complete: {first_tab.strip() == story}, "
+          f"second tab complete: {''.join(t for _, t in other_tab).strip() == story}")
+    print(f"LLM calls: {config.completed - calls_before} "
+          f"(jobs started {app.narrative_jobs.started}, joined {app.narrative_jobs.joined})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Goodput under overload, with admission control (admission.py) off and on.
+
+The Dockerfile's gunicorn command (one gthread worker with 8 threads, mongomock_wsgi)
+gets an open-loop stream of /api/chat turns, one new session each, at several offered
+rates past what the worker can serve, plus /api/start and /api/login probes. Clients
+give up after CLIENT_TIMEOUT seconds, as a user would. The fake DeepSeek serves
+CAPACITY requests at full speed and slows down past that.
+
+Goodput is chat turns answered with a 200 within the client timeout, per second, over
+the second half of each run (the steady state once any queue has built up). Without admission control the worker queues every request, so under
+overload most turns are answered after their client left (and the cheap probes wait
+behind them); with it the excess is turned away with 503 + Retry-After at once.
+
+    python benchmarks/bench_overload.py
+"""
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+from load_test import percentile, start_app  # noqa: E402
+
+RATES = (2, 6, 12)  # offered /api/chat turns per second
+DURATION = 30.0
+CLIENT_TIMEOUT = 10.0
+PROBE_INTERVAL = 0.25
+CAPACITY = 6
+
+os.environ.setdefault("NARRATIVE_SPECULATION", "0")
+
+
+def chat(base_url, results, sent_at=0.0):
+    start = time.perf_counter()
+    try:
+        resp = httpx.post(f"{base_url}/api/chat", timeout=CLIENT_TIMEOUT,
+                          json={'session_id': f"ov-{uuid.uuid4().hex[:12]}", 'input': '最近总是睡不好，怎么办？'})
+        outcome = 'ok' if resp.status_code == 200 else str(resp.status_code)
+    except httpx.TimeoutException:
+        outcome = 'timeout'
+    except httpx.HTTPError:
+        outcome = 'error'
+    results.append((outcome, time.perf_counter() - start, sent_at))
+
+
+def probe(base_url, path, results):
+    start = time.perf_counter()
+    try:
+        if path == '/api/login':
+            httpx.post(f"{base_url}{path}", json={'session_id': 'probe'}, timeout=CLIENT_TIMEOUT)
+        else:
+            httpx.get(f"{base_url}{path}", timeout=CLIENT_TIMEOUT)
+        results.append(time.perf_counter() - start)
+    except httpx.HTTPError:
+        results.append(CLIENT_TIMEOUT)
+
+
+def warm_up(base_url):
+    """Wait for /healthz and run one turn, so the runs measure a warm worker."""
+    deadline = time.monotonic() + 60
+    while httpx.get(f"{base_url}/healthz", timeout=5).status_code != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError("worker did not warm up")
+        time.sleep(0.1)
+    chat(base_url, [])
+
+
+def offer(base_url, rate):
+    """Open-loop arrivals at `rate` chats/s for DURATION seconds, with cheap-endpoint probes."""
+    chats, probes = [], []
+    start = time.monotonic()
+    with ThreadPoolExecutor(int(rate * (CLIENT_TIMEOUT + 2)) + 16) as pool:
+        sent = probed = 0
+        while time.monotonic() - start < DURATION:
+            elapsed = time.monotonic() - start
+            while sent < elapsed * rate:
+                pool.submit(chat, base_url, chats, elapsed)
+                sent += 1
+            while probed < elapsed / PROBE_INTERVAL:
+                pool.submit(probe, base_url, ('/api/start', '/api/login')[probed % 2], probes)
+                probed += 1
+            time.sleep(0.005)
+    return chats, probes
+
+
+def main():
+    config = FakeDeepSeekConfig(latency=0.8, tokens_per_second=50, reply_tokens=40, capacity=CAPACITY)
+    _, deepseek_base = serve(config)
+    print(f"1 worker x 8 threads, DeepSeek ~{config.latency + config.reply_tokens / config.tokens_per_second:.1f}s "
+          f"per reply at <= {CAPACITY} concurrent, client timeout {CLIENT_TIMEOUT:.0f}s, {DURATION:.0f}s per run")
+    print(f"{'admission':>10}{'offered/s':>10}{'goodput/s':>10}{'503':>6}{'timeout':>8}{'other':>6}"
+          f"{'ok p50':>8}{'ok p95':>8}{'cheap p95':>10}{'cheap max':>10}")
+    for enabled in ('0', '1'):
+        os.environ["ADMISSION_CONTROL"] = enabled
+        for rate in RATES:
+            process, base_url = start_app(SimpleNamespace(keys=2), deepseek_base, None)
+            try:
+                warm_up(base_url)
+                chats, probes = offer(base_url, rate)
+            finally:
+                process.terminate()
+                process.wait()
+            steady = [(outcome, seconds) for outcome, seconds, sent_at in chats if sent_at >= DURATION / 2]
+            ok = [seconds for outcome, seconds in steady if outcome == 'ok']
+            rejected = sum(outcome == '503' for outcome, _ in steady)
+            timeouts = sum(outcome == 'timeout' for outcome, _ in steady)
+            other = len(steady) - len(ok) - rejected - timeouts
+            print(f"{'on' if enabled == '1' else 'off':>10}{rate:>10}{len(ok) / (DURATION / 2):>10.2f}{rejected:>6}"
+                  f"{timeouts:>8}{other:>6}{percentile(ok, 0.5):>8.2f}{percentile(ok, 0.95):>8.2f}"
+                  f"{percentile(probes, 0.95):>10.2f}{max(probes, default=0):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
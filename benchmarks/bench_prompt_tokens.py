@@ -0,0 +1,66 @@
+"""
+Input tokens per /api/chat request on a recorded transcript: the k=30 message window
+versus the token-budgeted history with a rolling summary.
+
+The transcript is a JSON list of {"role": "user"|"assistant", "content": ...} messages
+(without one, a synthetic 40-turn session is used). The summary is stood in for by a
+300-character placeholder, the length SUMMARY_PROMPT asks the model for.
+
+    python benchmarks/bench_prompt_tokens.py transcript.json
+"""
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench")
+from langchain.memory import ConversationBufferWindowMemory  # noqa: E402
+from helper import INITIAL_PROMPT  # noqa: E402
+from conversation_budget import (  # noqa: E402
+    budgeted_history,
+    estimate_prompt_tokens,
+    SUMMARY_EVERY_N_TURNS,
+    SUMMARY_KEEP_RECENT_TURNS,
+)
+
+PLACEHOLDER_SUMMARY = "用户最近因为工作压力和家庭关系感到焦虑失眠，" * 15
+
+
+def load_turns(path):
+    if path:
+        with open(path, encoding='utf-8') as f:
+            messages = json.load(f)
+        return [(messages[i]['content'], messages[i + 1]['content']) for i in range(0, len(messages) - 1, 2)]
+    user = "我最近总是睡不好，工作上的事情一直压在心里，和家人也常常因为小事争吵，觉得很累。"
+    ai = "谢谢你愿意告诉我这些。听起来工作和家庭两方面的压力叠在一起，让你很疲惫。能多说说最近一次争吵时发生了什么吗？"
+    return [(user, ai)] * 40
+
+
+def main():
+    turns = load_turns(sys.argv[1] if len(sys.argv) > 1 else None)
+    memory = ConversationBufferWindowMemory(k=30, return_messages=True)
+    session_data = {'turn_count': 0}
+    window_total = budget_total = 0
+    print(f"{'turn':>5}{'window k=30':>14}{'budgeted':>12}")
+    for n, (user_input, reply) in enumerate(turns, 1):
+        window = memory.load_memory_variables({})['history']
+        budgeted = budgeted_history(session_data, memory)
+        window_tokens = estimate_prompt_tokens(INITIAL_PROMPT, window, user_input)
+        budget_tokens = estimate_prompt_tokens(INITIAL_PROMPT, budgeted, user_input)
+        window_total += window_tokens
+        budget_total += budget_tokens
+        print(f"{n:>5}{window_tokens:>14}{budget_tokens:>12}")
+
+        memory.save_context({'input': user_input}, {'output': reply})
+        session_data['turn_count'] += 1
+        # same trigger as maybe_schedule_summary, with the summary applied immediately
+        if session_data['turn_count'] - session_data.get('summarized_turns', 0) >= \
+                SUMMARY_KEEP_RECENT_TURNS + SUMMARY_EVERY_N_TURNS:
+            session_data['summary'] = PLACEHOLDER_SUMMARY
+            session_data['summarized_turns'] = session_data['turn_count'] - SUMMARY_KEEP_RECENT_TURNS
+    print(f"total {window_total} vs {budget_total} input tokens "
+          f"({100 * (1 - budget_total / window_total):.0f}% fewer)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Mongo bytes read per /api/login and per /api/chat as one session grows.
+
+The session gets more chat turns, pure-chat messages and a narrative between
+measurements. Bytes are the BSON size of every document Mongo returns to the app
+during one request (find_one / find_one_and_update replies), next to the size of the
+whole session as one document, which is what an unprojected read of the pre-split
+layout returned. /api/chat is measured with the worker's session cache on and off.
+
+DeepSeek is the local fake and mongomock stands in for Mongo (pip install mongomock).
+
+    python benchmarks/bench_session_bytes.py
+"""
+import os
+import sys
+
+import bson
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+
+config = FakeDeepSeekConfig(latency=0.0, tokens_per_second=10000, reply_tokens=120)
+_, base_url = serve(config)
+os.environ["DEEPSEEK_API_BASE"] = base_url
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench-key-1")
+os.environ.setdefault("NARRATIVE_SPECULATION", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mongomock  # noqa: E402
+import session_memory  # noqa: E402
+session_memory.MongoClient = mongomock.MongoClient
+import app  # noqa: E402
+
+CHECKPOINTS = (1, 10, 30, 60, 120)  # chat turns (and pure-chat turns) in the session
+
+
+class MeteredCollection:
+    """Collection wrapper that adds up the BSON size of the documents read through it."""
+    def __init__(self, collection, meter):
+        self._collection = collection
+        self._meter = meter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in ('find_one', 'find_one_and_update'):
+            return attr
+
+        def read(*args, **kwargs):
+            doc = attr(*args, **kwargs)
+            if doc:
+                self._meter[0] += len(bson.encode(doc))
+            return doc
+        return read
+
+
+def metered(meter, request):
+    meter[0] = 0
+    request()
+    return meter[0]
+
+
+def whole_session_bytes(store, session_id):
+    """The session as one pre-split document (conversation data plus profile and artifacts)."""
+    doc = store.collection._collection.find_one({'_id': session_id}) or {'data': {}}
+    for extra in (store.artifacts._collection, store.profiles._collection):
+        fields = extra.find_one({'_id': session_id}) or {}
+        doc['data'].update({k: v for k, v in fields.items() if k not in ('_id', 'last_access', 'created')})
+    return len(bson.encode(doc))
+
+
+def main():
+    store = app.session_memory_store
+    meter = [0]
+    connection = store.connection()
+    connection.collection = MeteredCollection(connection.collection, meter)
+    connection.artifacts = MeteredCollection(connection.artifacts, meter)
+    connection.profiles = MeteredCollection(connection.profiles, meter)
+    cache = store.cache
+
+    client = app.app.test_client()
+    session_id = 'bench-bytes'
+    client.post('/api/login', json={'session_id': session_id, 'description': '压测用户，最近工作压力大。'})
+    turns = 0
+    print(f"{'turns':>6}{'whole doc B':>13}{'login B':>10}{'chat B (cache)':>16}{'chat B (no cache)':>19}")
+    for checkpoint in CHECKPOINTS:
+        while turns < checkpoint:
+            turns += 1
+            client.post('/api/chat', json={'session_id': session_id, 'input': f'第{turns}轮：我还是睡不好。'})
+            client.post('/api/pure_deepseek_chat', json={'session_id': session_id, 'input': f'第{turns}个问题'})
+            if turns == 1:
+                client.get(f'/api/generate_narrative_sse?session_id={session_id}').get_data()
+
+        login = metered(meter, lambda: client.post('/api/login', json={'session_id': session_id}))
+        # one chat to warm the cache, then the measured one
+        client.post('/api/chat', json={'session_id': session_id, 'input': '再说说。'})
+        cached = metered(meter, lambda: client.post('/api/chat', json={'session_id': session_id,
+                                                                        'input': f'再说说（{turns}）。'}))
+        store.cache = None
+        uncached = metered(meter, lambda: client.post('/api/chat', json={'session_id': session_id,
+                                                                          'input': f'还有（{turns}）。'}))
+        store.cache = cache
+        print(f"{turns:>6}{whole_session_bytes(store, session_id):>13}{login:>10}{cached:>16}{uncached:>19}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare the legacy pickled memory layout with the message-log layout.
+
+For every /api/chat turn the handler does one store.get() and one store.save_turn();
+this replays that loop and reports bytes sent to Mongo per turn and p99 store latency.
+
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_session_store.py
+"""
+import os
+import sys
+import time
+import uuid
+
+import bson
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from session_memory import MongoDBSessionMemoryStore  # noqa: E402
+from langchain.memory import ConversationBufferWindowMemory  # noqa: E402
+
+USER_TEXT = "最近工作压力很大，每天加班到很晚，回家以后也睡不好，总觉得自己做得不够好。" * 2
+AI_TEXT = "谢谢你愿意和我分享这些。听起来你承受了很多，能再多说说让你最焦虑的是哪一部分吗？" * 4
+
+
+class WriteBytesListener(monitoring.CommandListener):
+    def __init__(self):
+        self.bytes_written = 0
+
+    def started(self, event):
+        if event.command_name in ('update', 'insert'):
+            self.bytes_written += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def p99(samples):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def run(mode, turns, listener):
+    store = MongoDBSessionMemoryStore(os.getenv("MONGODB_URI"), db_name='sessions_bench', mode=mode)
+    session_id = f"bench-{mode}-{uuid.uuid4().hex}"
+    latencies = []
+    listener.bytes_written = 0
+    for _ in range(turns):
+        start = time.perf_counter()
+        session_data = store.get(session_id)
+        memory = session_data.get('memory') or ConversationBufferWindowMemory(k=30, return_messages=True)
+        memory.save_context({'input': USER_TEXT}, {'output': AI_TEXT})
+        session_data['memory'] = memory
+        store.save_turn(session_id, session_data, USER_TEXT, AI_TEXT)
+        latencies.append(time.perf_counter() - start)
+    store.delete(session_id)
+    return listener.bytes_written / turns, p99(latencies) * 1000
+
+
+def main():
+    listener = WriteBytesListener()
+    monitoring.register(listener)
+    print(f"{'mode':<8}{'turns':>7}{'bytes/turn':>14}{'p99 ms':>10}")
+    for turns in (10, 100, 1000):
+        for mode in ('pickle', 'log'):
+            bytes_per_turn, p99_ms = run(mode, turns, listener)
+            print(f"{mode:<8}{turns:>7}{bytes_per_turn:>14.0f}{p99_ms:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Bytes on the wire and frames per story for /api/generate_narrative_sse (sse.py).
+
+Each run starts the Dockerfile's gunicorn command (one mongomock_wsgi worker) with one
+framing setting, has a short chat so the session has memory, then reads one narrative
+over a real socket. The fake DeepSeek streams one CJK character per chunk, as the
+real API mostly does.
+
+- legacy: the frames of the per-chunk run, re-encoded as the old code framed them
+  (json.dumps with ensure_ascii=True: 6 bytes per CJK character)
+- per chunk: SSE_COALESCE_WINDOW=0, one frame per chunk, UTF-8
+- coalesced: SSE_COALESCE_WINDOW=0.04
+- + gzip / + deflate: coalesced, with the client sending Accept-Encoding
+
+Body bytes are what the socket carried for the response body (compressed where
+negotiated); HTTP chunk headers come on top of that, once per frame.
+
+    python benchmarks/bench_sse_framing.py
+"""
+import json
+import os
+import sys
+import time
+import uuid
+import zlib
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+from load_test import start_app  # noqa: E402
+
+STORY_TOKENS = 600
+TOKENS_PER_SECOND = 100
+
+os.environ.setdefault("NARRATIVE_SPECULATION", "0")
+os.environ.setdefault("ADMISSION_CONTROL", "0")
+
+
+def text_frames(body):
+    """(id, text) of the text events in a decoded SSE body."""
+    frames = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if ": " in line)
+        if 'id' in fields:
+            frames.append((fields['id'], json.loads(fields['data'])['text']))
+    return frames
+
+
+def read_story(base_url, encoding):
+    session_id = f"sse-{uuid.uuid4().hex[:12]}"
+    httpx.post(f"{base_url}/api/chat", timeout=60,
+               json={'session_id': session_id, 'input': '最近工作压力很大，总是睡不好。'})
+    headers = {'Accept-Encoding': encoding or 'identity'}
+    raw = b''
+    start = time.perf_counter()
+    first = None
+    with httpx.stream('GET', f"{base_url}/api/generate_narrative_sse", params={'session_id': session_id},
+                      headers=headers, timeout=120) as resp:
+        sent_encoding = resp.headers.get('Content-Encoding')
+        for part in resp.iter_raw():
+            if first is None:
+                first = time.perf_counter() - start
+            raw += part
+    if sent_encoding:
+        body = zlib.decompress(raw, 16 + zlib.MAX_WBITS if sent_encoding == 'gzip' else zlib.MAX_WBITS)
+    else:
+        body = raw
+    return len(raw), text_frames(body.decode('utf-8')), sent_encoding
+
+
+def run(window, encoding):
+    os.environ["SSE_COALESCE_WINDOW"] = window
+    config = FakeDeepSeekConfig(latency=0.1, tokens_per_second=TOKENS_PER_SECOND, reply_tokens=STORY_TOKENS)
+    _, deepseek_base = serve(config)
+    process, base_url = start_app(SimpleNamespace(keys=1), deepseek_base, None)
+    try:
+        return read_story(base_url, encoding)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def legacy_bytes(frames):
+    return sum(len(f"id: {end}\ndata: {json.dumps({'text': text})}\n\n".encode()) for end, text in frames)
+
+
+def main():
+    print(f"one narrative of {STORY_TOKENS} characters at {TOKENS_PER_SECOND} chunks/s")
+    print(f"{'framing':<14}{'body bytes':>12}{'text frames':>13}{'bytes/char':>12}{'story chars':>13}")
+    rows = []
+    body_bytes, frames, _ = run('0', None)
+    rows.append(('legacy', legacy_bytes(frames) + len("event: open\ndata: ok\n\nevent: done\ndata: end\n\n"), frames))
+    rows.append(('per chunk', body_bytes, frames))
+    for label, encoding in (('coalesced', None), ('+ gzip', 'gzip'), ('+ deflate', 'deflate')):
+        body_bytes, frames, sent = run('0.04', encoding)
+        assert sent == encoding, f"asked for {encoding}, got {sent}"
+        rows.append((label, body_bytes, frames))
+    for label, body_bytes, frames in rows:
+        chars = sum(len(text) for _, text in frames)
+        print(f"{label:<14}{body_bytes:>12}{len(frames):>13}{body_bytes / chars:>12.2f}{chars:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Worker start-up cost and readiness.
+
+- import: `import app` in a fresh interpreter with MONGODB_URI pointing at an address
+  nothing listens on, so any Mongo I/O at import time would show up as a stall; also
+  which of LangChain's slow modules the import pulled in, and what they cost on their own.
+- gunicorn: the Dockerfile's gunicorn command (mongomock_wsgi, WORKERS workers) from
+  spawn to the first 200 on /api/start and on /healthz, and each worker's own
+  warm-up time as /healthz reports it.
+
+DeepSeek is the local fake and mongomock stands in for Mongo (pip install mongomock).
+
+    python benchmarks/bench_startup.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+from load_test import ROOT, gunicorn_command  # noqa: E402
+from mongo_standin import free_port  # noqa: E402
+
+WORKERS = 2
+RUNS = 3
+HEAVY_MODULES = ('langchain_openai', 'openai', 'langchain.memory', 'tiktoken')
+
+IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+heavy = [m for m in %r if m in sys.modules]
+print(f"{elapsed:.3f} {','.join(heavy) or '-'}")
+""" % (HEAVY_MODULES,)
+
+MODULE_PROBE = """
+import time
+start = time.perf_counter()
+import %s
+print(f"{time.perf_counter() - start:.3f}")
+"""
+
+
+def probe(code, env):
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return out.strip().splitlines()[-1].split()
+
+
+def import_times(env):
+    samples = [probe(IMPORT_PROBE, env) for _ in range(RUNS)]
+    return min(float(s[0]) for s in samples), samples[-1][1]
+
+
+def gunicorn_boot(env):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    command = gunicorn_command(f"127.0.0.1:{port}", workers=WORKERS, app_module="mongomock_wsgi:app")
+    command[3:3] = ["--pythonpath", os.path.join(ROOT, 'benchmarks')]
+    env = dict(env, PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(prefix="bench-prom-"))
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    first_ok = None
+    ready = {}
+    try:
+        deadline = time.monotonic() + 60
+        while len(ready) < WORKERS and time.monotonic() < deadline:
+            try:
+                if first_ok is None and httpx.get(f"{base_url}/api/start", timeout=1).status_code == 200:
+                    first_ok = time.perf_counter() - start
+                resp = httpx.get(f"{base_url}/healthz", timeout=1)
+                report = resp.json()
+                if resp.status_code == 200 and report['pid'] not in ready:
+                    ready[report['pid']] = (time.perf_counter() - start, report['ready_after'])
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.02)
+    finally:
+        process.terminate()
+        process.wait()
+    return first_ok, ready
+
+
+def main():
+    _, base_url = serve(FakeDeepSeekConfig(latency=0.0))
+    env = dict(os.environ,
+               DEEPSEEK_API_BASE=base_url,
+               DEEPSEEK_API_KEY_1="bench-key-1",
+               # unroutable: connecting here would hang until serverSelectionTimeoutMS
+               MONGODB_URI="mongodb://10.255.255.1:27017/?serverSelectionTimeoutMS=5000",
+               LOG_LEVEL="WARNING")
+
+    elapsed, heavy = import_times(env)
+    print(f"import app (best of {RUNS}): {elapsed:.3f}s, heavy modules loaded: {heavy}")
+    for module in HEAVY_MODULES[:2] + ('langchain.memory',):
+        print(f"  import {module} on its own: {float(probe(MODULE_PROBE % module, env)[0]):.3f}s")
+
+    first_ok, ready = gunicorn_boot(env)
+    print(f"gunicorn, {WORKERS} workers: first /api/start 200 after {first_ok:.2f}s")
+    for pid, (seen, ready_after) in sorted(ready.items(), key=lambda item: item[1]):
+        print(f"  worker {pid}: /healthz 200 after {seen:.2f}s, warm-up took {ready_after:.2f}s")
+    if len(ready) < WORKERS:
+        print(f"  only {len(ready)} of {WORKERS} workers reported ready")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Concurrent narrative streams one worker process holds, gthread vs the ASGI mode.
+
+The same probe as load_test.py (probe_sse_capacity) runs against one worker of each
+server, on mongomock, with the fake DeepSeek:
+
+- gthread: the Dockerfile's gunicorn command (8 threads), mongomock_wsgi
+- asgi: hypercorn asgi_app:app, as asgi_app.py documents it, mongomock_asgi
+
+A gthread worker holds one thread per open stream, so once its threads are taken the
+next streams queue behind whole stories. The ASGI worker keeps every stream on its
+event loop. Capacity is the largest number of simultaneous streams whose p95 time to
+first token stayed within TTFT_SLO with none failing. The app, the fake server and the
+client share the machine's CPUs, so on a small box the ASGI worker runs out of CPU
+before it runs out of concurrency.
+
+    python benchmarks/bench_stream_capacity.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+from load_test import probe_sse_capacity, start_app  # noqa: E402
+
+LEVELS = [4, 8, 16, 32, 64, 128]
+TTFT_SLO = 2.0
+KEYS = 8
+
+os.environ.setdefault("NARRATIVE_SPECULATION", "0")
+os.environ.setdefault("ADMISSION_CONTROL", "0")
+
+
+def run(server):
+    config = FakeDeepSeekConfig(latency=0.2, tokens_per_second=10, reply_tokens=40)
+    _, deepseek_base = serve(config)
+    process, base_url = start_app(SimpleNamespace(keys=KEYS), deepseek_base, None, server=server)
+    try:
+        return probe_sse_capacity(base_url, LEVELS, TTFT_SLO)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    print(f"one worker, narrative of 40 tokens at 10/s after 0.2s, TTFT SLO {TTFT_SLO:.1f}s")
+    results = {server: run(server) for server in ('gunicorn', 'hypercorn')}
+    print(f"{'streams':>8}" + "".join(f"{label + ' p95 TTFT ms':>22}{'failed':>8}" for label in ('gthread', 'asgi')))
+    for i, level in enumerate(LEVELS):
+        print(f"{level:>8}" + "".join(f"{rows[i][2] * 1000:>22.0f}{rows[i][1]:>8}" for _, rows in results.values()))
+    print("capacity: " + ", ".join(f"{label} {results[server][0]}"
+                                   for label, server in (('gthread', 'gunicorn'), ('asgi', 'hypercorn'))))
+
+
+if __name__ == '__main__':
+    main()
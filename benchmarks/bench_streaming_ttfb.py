@@ -0,0 +1,68 @@
+"""
+Time to first byte of reply text for the blocking endpoints (/api/chat, /api/reflect,
+/api/pure_deepseek_chat) versus their SSE variants (*_stream), against the local fake
+DeepSeek. For a blocking endpoint the first text arrives with the whole response.
+
+Uses mongomock for the session store (pip install mongomock).
+
+    python benchmarks/bench_streaming_ttfb.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+
+config = FakeDeepSeekConfig(latency=0.3, tokens_per_second=40, reply_tokens=120)
+_, base_url = serve(config)
+os.environ["DEEPSEEK_API_BASE"] = base_url
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench-key-1")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mongomock  # noqa: E402
+import session_memory  # noqa: E402
+session_memory.MongoClient = mongomock.MongoClient
+import app  # noqa: E402
+
+ROUNDS = 3
+
+
+def blocking(client, path, body):
+    start = time.perf_counter()
+    client.post(path, json=body).get_data()
+    return time.perf_counter() - start
+
+
+def streaming(client, path, body):
+    """(first text event, end of stream) in seconds."""
+    start = time.perf_counter()
+    resp = client.post(path, json=body, buffered=False)
+    first = None
+    for part in resp.response:
+        if first is None and b'data: {"text"' in part:
+            first = time.perf_counter() - start
+    resp.close()
+    return first, time.perf_counter() - start
+
+
+def main():
+    client = app.app.test_client()
+    client.post('/api/chat', json={'session_id': 'bench', 'input': '最近工作压力很大，总是睡不好。'})
+    client.get('/api/generate_narrative_sse?session_id=bench').get_data()
+
+    print(f"fake DeepSeek: {config.latency * 1000:.0f} ms to first token, "
+          f"{config.reply_tokens} tokens at {config.tokens_per_second:.0f}/s")
+    print(f"{'endpoint':<22}{'blocking ms':>13}{'stream TTFB ms':>16}{'stream total ms':>17}")
+    for path, text in (('/api/chat', '我还是觉得很累。'),
+                       ('/api/reflect', '读完这个故事，我好像看到了自己。'),
+                       ('/api/pure_deepseek_chat', '你好')):
+        body = {'session_id': 'bench', 'input': text}
+        block = min(blocking(client, path, body) for _ in range(ROUNDS))
+        results = [streaming(client, path + '_stream', body) for _ in range(ROUNDS)]
+        print(f"{path:<22}{block * 1000:>13.0f}{min(r[0] for r in results) * 1000:>16.0f}"
+              f"{min(r[1] for r in results) * 1000:>17.0f}")
+
+
+if __name__ == '__main__':
+    main()
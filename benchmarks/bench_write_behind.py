@@ -0,0 +1,128 @@
+"""
+Session persistence on the response path, with write-behind (SESSION_WRITE_BEHIND) off and on.
+
+THREADS concurrent users each run TURNS /api/chat-style turns on their own session
+through SessionCoordinator and the store: acquire the turn, get(), save_turn(), release.
+The LLM call is left out. "save" is save_turn() + release, the part the response waits
+for once the reply is there; "turn" is acquire to release. Users either send their
+next turn at once (the worst case: its acquire has to apply the queued writes first)
+or pause THINK_TIME, longer than SESSION_WRITE_MAX_DELAY, as people do. Mongo round
+trips are counted per turn, and after flush_all() every session is checked to hold all
+of its turns.
+
+Without MONGODB_URI (and no mongod on PATH) the store runs on mongomock, with every
+collection call delayed by MONGO_RTT seconds to stand in for a network round trip.
+
+    python benchmarks/bench_write_behind.py
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("DEEPSEEK_API_KEY_1", "bench-key-1")
+from load_test import percentile  # noqa: E402
+from mongo_standin import patch_mongomock_bulk, start_mongo  # noqa: E402
+import session_memory  # noqa: E402
+from session_turns import SessionCoordinator  # noqa: E402
+
+THREADS = 8
+TURNS = 20
+THINK_TIME = 0.6
+MONGO_RTT = 0.002
+WRITE_COMMANDS = ('find_one_and_update', 'update_one', 'bulk_write')
+USER_TEXT = "最近工作压力很大，每天加班到很晚，回家以后也睡不好。"
+AI_TEXT = "谢谢你愿意和我分享这些。听起来你承受了很多，能再多说说让你最焦虑的是哪一部分吗？"
+
+round_trips = {'read': 0, 'write': 0}
+_counter_lock = threading.Lock()
+
+
+def use_mongomock():
+    """mongomock with a simulated round trip on every collection call."""
+    import mongomock
+    import mongomock.collection
+
+    patch_mongomock_bulk()
+
+    def delayed(name, call):
+        kind = 'write' if name in WRITE_COMMANDS else 'read'
+
+        def wrapper(*args, **kwargs):
+            with _counter_lock:
+                round_trips[kind] += 1
+            time.sleep(MONGO_RTT)
+            return call(*args, **kwargs)
+        return wrapper
+
+    for name in WRITE_COMMANDS + ('find_one',):
+        setattr(mongomock.collection.Collection, name, delayed(name, getattr(mongomock.collection.Collection, name)))
+    session_memory.MongoClient = mongomock.MongoClient
+
+
+def user(store, coordinator, session_id, think, save_times, turn_times):
+    for i in range(TURNS):
+        time.sleep(think)
+        acquired = time.perf_counter()
+        turn = coordinator.acquire(session_id, f"turn-{i}")
+        try:
+            data = store.get(session_id, session_memory.CHAT_FIELDS)
+            memory = data.get('memory') or session_memory.new_memory()
+            memory.save_context({'input': USER_TEXT}, {'output': AI_TEXT})
+            data['memory'] = memory
+            start = time.perf_counter()
+            store.save_turn(session_id, data, USER_TEXT, AI_TEXT, fence=turn.fence)
+            turn.finish(AI_TEXT)
+        finally:
+            turn.release()
+        save_times.append(time.perf_counter() - start)
+        turn_times.append(time.perf_counter() - acquired)
+
+
+def run(uri, write_behind, think):
+    store = session_memory.MongoDBSessionMemoryStore(uri, db_name='sessions_bench', ensure_indexes=False,
+                                                     write_behind=write_behind)
+    coordinator = SessionCoordinator(store)
+    sessions = [f"wb-{uuid.uuid4().hex[:12]}" for _ in range(THREADS)]
+    save_times, turn_times = [], []
+    round_trips.update(read=0, write=0)
+    threads = [threading.Thread(target=user, args=(store, coordinator, session_id, think, save_times, turn_times))
+               for session_id in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    session_memory.flush_all()
+    stored = [store.get_fields(session_id, ['turn_count']).get('turn_count', 0) for session_id in sessions]
+    for session_id in sessions:
+        store.delete(session_id)
+    return save_times, turn_times, dict(round_trips), stored
+
+
+def main():
+    uri, kind, stop = start_mongo()
+    if uri is None:
+        use_mongomock()
+        kind = f"mongomock, {MONGO_RTT * 1000:.0f}ms per call"
+    print(f"{THREADS} users x {TURNS} turns ({kind})")
+    print(f"{'think s':>8}{'write-behind':>13}{'save p50':>10}{'save p99':>10}{'turn p50':>10}{'turn p99':>10}"
+          f"{'writes/turn':>13}{'reads/turn':>12}{'all stored':>12}   (ms)")
+    try:
+        for think in (0.0, THINK_TIME):
+            for write_behind in (False, True):
+                save_times, turn_times, trips, stored = run(uri, write_behind, think)
+                turns = THREADS * TURNS
+                print(f"{think:>8.1f}{'on' if write_behind else 'off':>13}"
+                      + "".join(f"{percentile(samples, q) * 1000:>10.2f}"
+                                for samples in (save_times, turn_times) for q in (0.5, 0.99))
+                      + f"{trips['write'] / turns:>13.2f}{trips['read'] / turns:>12.2f}"
+                      f"{str(all(count == TURNS for count in stored)):>12}")
+    finally:
+        stop()
+
+
+if __name__ == '__main__':
+    main()
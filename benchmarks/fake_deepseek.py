@@ -0,0 +1,215 @@
+"""
+Local OpenAI-compatible stand-in for the DeepSeek API.
+
+Serves POST /v1/chat/completions in streaming and non-streaming mode with a
+configurable first-token latency, token rate and per-key request rate limit
+(429 + Retry-After once a key goes over its requests-per-minute). `error_rate`
+additionally answers that fraction of requests with a 429 at random. With `capacity`
+set, more concurrent requests than that share the server: latency and token gaps
+stretch by active/capacity, like an overloaded upstream. `tail_rate` of the requests
+wait an extra `tail_latency` before answering, and `stall_rate` of the streams go
+silent for `stall_seconds` after `stall_after` tokens (halfway through when unset).
+
+    python benchmarks/fake_deepseek.py --port 8011 --latency 0.2 --rpm-per-key 60 --error-rate 0.05
+    DEEPSEEK_API_BASE=http://127.0.0.1:8011/v1 ...
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = "谢谢你愿意和我分享这些。听起来你最近承受了很多压力，能再多说说让你最难受的是哪一部分吗？"
+
+
+class FakeDeepSeekConfig:
+    def __init__(self, latency=0.2, tokens_per_second=50.0, rpm_per_key=0, reply_tokens=40, error_rate=0.0,
+                 capacity=0, tail_rate=0.0, tail_latency=0.0, stall_rate=0.0, stall_seconds=30.0,
+                 stall_after=None):
+        self.latency = latency                      # seconds before the first token
+        self.tokens_per_second = tokens_per_second  # streaming/generation speed
+        self.rpm_per_key = rpm_per_key              # 0 = unlimited
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate                # fraction of requests answered with a random 429
+        self.capacity = capacity                    # concurrent requests served at full speed, 0 = unlimited
+        self.active = 0
+        self.tail_rate = tail_rate                  # fraction of requests delayed by tail_latency
+        self.tail_latency = tail_latency
+        self.stall_rate = stall_rate                # fraction of streams that go silent mid-reply
+        self.stall_seconds = stall_seconds
+        self.stall_after = stall_after
+        self.stalled = 0
+        self.received = 0
+        self.lock = threading.Lock()
+        self.requests_by_key = defaultdict(deque)   # key -> timestamps in the last minute
+        self.completed = 0
+        self.rate_limited = 0
+
+    def admit(self, api_key):
+        """None if the request may proceed, else seconds the caller should wait."""
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.rate_limited += 1
+            return 1.0
+        if not self.rpm_per_key:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            window = self.requests_by_key[api_key]
+            while window and now - window[0] > 60:
+                window.popleft()
+            if len(window) >= self.rpm_per_key:
+                self.rate_limited += 1
+                return max(0.0, 60 - (now - window[0]))
+            window.append(now)
+            return None
+
+    def slowdown(self):
+        """Factor on latency and token gaps for the requests in flight right now."""
+        if not self.capacity:
+            return 1.0
+        return max(1.0, self.active / self.capacity)
+
+    def reply_chunks(self):
+        text = (REPLY * (self.reply_tokens // len(REPLY) + 1))[:self.reply_tokens]
+        return list(text)  # one CJK character per "token"
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status, body, headers=None):
+            payload = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            if not self.path.endswith("/chat/completions"):
+                self._json(404, {"error": {"message": "not found"}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            api_key = self.headers.get("Authorization", "").replace("Bearer ", "")
+            wait = config.admit(api_key)
+            if wait is not None:
+                self._json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                           {"Retry-After": f"{wait:.2f}"})
+                return
+
+            with config.lock:
+                config.active += 1
+                config.received += 1
+            try:
+                self._reply(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client gave up (timeout, cancelled stream)
+            finally:
+                with config.lock:
+                    config.active -= 1
+
+        def _reply(self, body):
+            delay = config.latency * config.slowdown()
+            if config.tail_rate and random.random() < config.tail_rate:
+                delay += config.tail_latency
+            time.sleep(delay)
+            chunks = config.reply_chunks()
+            usage = {"prompt_tokens": len(json.dumps(body.get("messages", []), ensure_ascii=False)) // 2,
+                     "completion_tokens": len(chunks)}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            if body.get("stream"):
+                self._stream(body, chunks, usage)
+            else:
+                time.sleep(len(chunks) / config.tokens_per_second * config.slowdown())
+                self._json(200, {
+                    "id": "fake", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get("model", "deepseek-chat"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "".join(chunks)}}],
+                    "usage": usage,
+                })
+            with config.lock:
+                config.completed += 1
+
+        def _stream(self, body, chunks, usage):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send(obj):
+                data = f"data: {obj}\n\n".encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            base = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": body.get("model", "deepseek-chat")}
+            stall_at = None
+            if config.stall_rate and random.random() < config.stall_rate:
+                stall_at = len(chunks) // 2 if config.stall_after is None else config.stall_after
+            for i, token in enumerate(chunks):
+                if i == stall_at:
+                    with config.lock:
+                        config.stalled += 1
+                    time.sleep(config.stall_seconds)
+                if i:
+                    time.sleep(config.slowdown() / config.tokens_per_second)
+                send(json.dumps({**base, "choices": [{"index": 0, "delta": {"content": token},
+                                                      "finish_reason": None}]}, ensure_ascii=False))
+            final = {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            if (body.get("stream_options") or {}).get("include_usage"):
+                final["usage"] = usage
+            send(json.dumps(final))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def serve(config, host="127.0.0.1", port=0):
+    """Start the fake server on a daemon thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--rpm-per-key", type=int, default=0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=0)
+    parser.add_argument("--tail-rate", type=float, default=0.0)
+    parser.add_argument("--tail-latency", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-seconds", type=float, default=30.0)
+    parser.add_argument("--stall-after", type=int, default=None)
+    args = parser.parse_args()
+    config = FakeDeepSeekConfig(args.latency, args.tokens_per_second, args.rpm_per_key, args.reply_tokens,
+                                args.error_rate, args.capacity, args.tail_rate, args.tail_latency,
+                                args.stall_rate, args.stall_seconds, args.stall_after)
+    server, base_url = serve(config, args.host, args.port)
+    print(f"fake DeepSeek listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
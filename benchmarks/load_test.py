@@ -0,0 +1,278 @@
+"""
+Scenario load test of the real Flask app under the Dockerfile's gunicorn command.
+
+Each virtual user runs one realistic session: login, 15 chat turns, the narrative SSE
+stream and 8 reflect turns. DeepSeek is the local fake (fake_deepseek.py) and Mongo
+comes from mongo_standin.py. After the sessions, the SSE capacity is probed by opening
+more and more narrative streams at once.
+
+The report gives p50/p95/p99 latency per endpoint, narrative time-to-first-token, the
+largest number of concurrent streams whose p95 TTFT stayed within --ttft-slo, and
+Mongo bytes per session. Bytes are the size of the stored session documents, plus wire
+traffic when a real server reports it.
+
+    python benchmarks/load_test.py --users 20 --latency 0.2 --tokens-per-second 50
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/load_test.py --error-rate 0.05
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+import httpx
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_deepseek import FakeDeepSeekConfig, serve  # noqa: E402
+from mongo_standin import free_port, network_bytes, start_mongo  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CHAT_TURNS = 15
+REFLECT_TURNS = 8
+USER_TURNS = [
+    "最近工作压力很大，每天加班到很晚，回家以后也睡不好。",
+    "我总觉得自己做得不够好，领导一句话我能想一整晚。",
+    "和家里人说这些，他们只会让我别想太多。",
+    "周末也不想出门，朋友约我我都找理由推掉了。",
+    "有时候会突然很想哭，但又说不清为什么。",
+]
+REFLECT_TURNS_TEXT = [
+    "读完这个故事，我好像看到了自己。",
+    "主人公最后的选择让我有点意外。",
+    "我也想像他那样试着放下一些东西。",
+]
+
+
+def percentile(samples, q):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def gunicorn_command(bind, workers=None, app_module="app:app"):
+    """The Dockerfile's gunicorn CMD with the bind address (and optionally workers) replaced."""
+    with open(os.path.join(ROOT, 'Dockerfile'), encoding='utf-8') as f:
+        line = [l for l in f if l.startswith('CMD ["gunicorn"')][-1]
+    args = json.loads(line[len('CMD'):])
+    args[args.index('-b') + 1] = bind
+    if workers is not None:
+        args[args.index('-w') + 1] = str(workers)
+    args[-1] = app_module
+    return [sys.executable, '-m'] + args
+
+
+def hypercorn_command(bind, workers=None, app_module="asgi_app:app"):
+    """The ASGI serving mode as asgi_app.py documents it, with the bind address (and optionally workers) replaced."""
+    return [sys.executable, '-m', 'hypercorn', '-b', bind, '-w', str(workers or 2), app_module]
+
+
+def start_app(args, deepseek_base, mongo_uri, server="gunicorn"):
+    """Start the app under gunicorn gthread (the Dockerfile's CMD) or, with server="hypercorn", the ASGI app."""
+    port = free_port()
+    env = dict(os.environ,
+               DEEPSEEK_API_BASE=deepseek_base,
+               PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(prefix="bench-prom-"),
+               LOG_LEVEL="WARNING")
+    for i in range(args.keys):
+        env[f"DEEPSEEK_API_KEY_{i + 1}"] = f"bench-key-{i + 1}"
+    if server == "hypercorn":
+        if mongo_uri:
+            env["MONGODB_URI"] = mongo_uri
+            command = hypercorn_command(f"127.0.0.1:{port}")
+        else:
+            command = hypercorn_command(f"127.0.0.1:{port}", workers=1, app_module="mongomock_asgi:app")
+            env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.join(ROOT, 'benchmarks'), ROOT,
+                                                              env.get("PYTHONPATH")]))
+    elif mongo_uri:
+        env["MONGODB_URI"] = mongo_uri
+        command = gunicorn_command(f"127.0.0.1:{port}")
+    else:
+        command = gunicorn_command(f"127.0.0.1:{port}", workers=1, app_module="mongomock_wsgi:app")
+        command[3:3] = ["--pythonpath", os.path.join(ROOT, 'benchmarks')]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            if httpx.get(f"{base_url}/api/start", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.terminate()
+            raise RuntimeError(f"{server} did not come up")
+        time.sleep(0.2)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.ttft = []
+
+    def call(self, name, send):
+        start = time.perf_counter()
+        try:
+            resp = send()
+            ok = resp.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            self.latencies[name].append(time.perf_counter() - start)
+        else:
+            self.errors[name] += 1
+        return ok
+
+
+def read_narrative(client, session_id):
+    """(ttft, total) of one narrative stream, or None if it failed."""
+    start = time.perf_counter()
+    ttft = None
+    try:
+        with client.stream('GET', '/api/generate_narrative_sse', params={'session_id': session_id}) as resp:
+            if resp.status_code != 200:
+                return None
+            for line in resp.iter_lines():
+                if ttft is None and line.startswith('data: {"text"'):
+                    ttft = time.perf_counter() - start
+                elif line.startswith('event: error'):
+                    return None
+                elif line == 'event: done':
+                    break
+    except httpx.HTTPError:
+        return None
+    if ttft is None:
+        return None
+    return ttft, time.perf_counter() - start
+
+
+def chat(client, recorder, session_id, turn):
+    return recorder.call('chat', lambda: client.post(
+        '/api/chat', json={'session_id': session_id, 'input': USER_TURNS[turn % len(USER_TURNS)] + f"（{turn}）"}))
+
+
+def run_session(base_url, recorder, run_id):
+    session_id = f"bench-{run_id}-{uuid.uuid4().hex}"
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        recorder.call('login', lambda: client.post(
+            '/api/login', json={'session_id': session_id, 'description': '压测用户'}))
+        for turn in range(CHAT_TURNS):
+            chat(client, recorder, session_id, turn)
+        result = read_narrative(client, session_id)
+        if result is None:
+            recorder.errors['narrative'] += 1
+            return
+        recorder.ttft.append(result[0])
+        recorder.latencies['narrative'].append(result[1])
+        for turn in range(REFLECT_TURNS):
+            recorder.call('reflect', lambda: client.post('/api/reflect', json={
+                'session_id': session_id, 'input': REFLECT_TURNS_TEXT[turn % len(REFLECT_TURNS_TEXT)]}))
+
+
+def probe_sse_capacity(base_url, levels, slo):
+    """Largest level whose concurrent narrative streams all finished with p95 TTFT <= slo."""
+    def prepare(_):
+        session_id = f"bench-sse-{uuid.uuid4().hex}"
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            client.post('/api/login', json={'session_id': session_id, 'description': '压测用户'})
+            chat(client, Recorder(), session_id, 0)
+        return session_id
+
+    capacity = 0
+    rows = []
+    with ThreadPoolExecutor(max(levels)) as pool:
+        for level in levels:
+            sessions = list(pool.map(prepare, range(level)))
+
+            def stream(session_id):
+                with httpx.Client(base_url=base_url, timeout=120) as client:
+                    return read_narrative(client, session_id)
+
+            results = list(pool.map(stream, sessions))
+            ok = [r for r in results if r]
+            p95 = percentile([r[0] for r in ok], 0.95)
+            rows.append((level, len(results) - len(ok), p95))
+            if len(ok) == level and p95 <= slo:
+                capacity = level
+    return capacity, rows
+
+
+def stored_session_bytes(base_url, mongo_uri, prefix):
+    """Stored BSON bytes of each benchmark session, over its memory, artifacts and profile documents."""
+    if mongo_uri is None:
+        return httpx.get(f"{base_url}/_bench/session_bytes", params={'prefix': prefix}, timeout=30).json()
+    db = MongoClient(mongo_uri)['sessions']
+    sizes = defaultdict(int)
+    for name in ('memory', 'artifacts', 'profiles'):
+        for doc in db[name].find({'_id': {'$regex': f"^{prefix}"}}):
+            sizes[doc['_id']] += len(bson.encode(doc))
+    return list(sizes.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="sessions run concurrently")
+    parser.add_argument("--keys", type=int, default=2, help="fake DeepSeek API keys")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of DeepSeek calls answered with 429")
+    parser.add_argument("--sse-levels", default="4,8,16,32,64")
+    parser.add_argument("--ttft-slo", type=float, default=2.0)
+    args = parser.parse_args()
+
+    config = FakeDeepSeekConfig(args.latency, args.tokens_per_second, reply_tokens=args.reply_tokens,
+                                error_rate=args.error_rate)
+    _, deepseek_base = serve(config)
+    mongo_uri, mongo_kind, stop_mongo = start_mongo()
+    process, base_url = start_app(args, deepseek_base, mongo_uri)
+    try:
+        recorder = Recorder()
+        run_id = uuid.uuid4().hex[:8]
+        network_before = network_bytes(mongo_uri)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.users) as pool:
+            list(pool.map(lambda _: run_session(base_url, recorder, run_id), range(args.users)))
+        elapsed = time.perf_counter() - started
+        network_after = network_bytes(mongo_uri)
+        doc_sizes = stored_session_bytes(base_url, mongo_uri, f"bench-{run_id}-")
+
+        capacity, sse_rows = probe_sse_capacity(
+            base_url, [int(n) for n in args.sse_levels.split(",")], args.ttft_slo)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        stop_mongo()
+
+    print(f"{args.users} sessions in {elapsed:.1f}s, mongo: {mongo_kind}, "
+          f"fake DeepSeek: {config.completed} completions, {config.rate_limited} 429s")
+    print(f"{'endpoint':<12}{'n':>6}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in ('login', 'chat', 'narrative', 'reflect'):
+        samples = recorder.latencies[name]
+        print(f"{name:<12}{len(samples):>6}{recorder.errors[name]:>8}"
+              f"{percentile(samples, 0.5) * 1000:>10.0f}{percentile(samples, 0.95) * 1000:>10.0f}"
+              f"{percentile(samples, 0.99) * 1000:>10.0f}")
+    print(f"narrative TTFT p50/p95/p99: {percentile(recorder.ttft, 0.5) * 1000:.0f}/"
+          f"{percentile(recorder.ttft, 0.95) * 1000:.0f}/{percentile(recorder.ttft, 0.99) * 1000:.0f} ms")
+    print(f"{'streams':>8}{'failed':>8}{'p95 TTFT ms':>13}")
+    for level, failed, p95 in sse_rows:
+        print(f"{level:>8}{failed:>8}{p95 * 1000:>13.0f}")
+    print(f"concurrent SSE capacity (p95 TTFT <= {args.ttft_slo:.1f}s): {capacity}")
+    if doc_sizes:
+        print(f"stored session documents: {sum(doc_sizes) / len(doc_sizes):.0f} bytes on average, "
+              f"{max(doc_sizes)} max")
+    if network_before and network_after:
+        print(f"mongo wire bytes per session: {(network_after[0] - network_before[0]) / args.users:.0f} in, "
+              f"{(network_after[1] - network_before[1]) / args.users:.0f} out")
+
+
+if __name__ == '__main__':
+    main()
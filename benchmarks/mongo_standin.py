@@ -0,0 +1,83 @@
+"""
+Mongo for benchmarks that run the app in separate processes.
+
+start_mongo() uses MONGODB_URI when it is set, otherwise starts a throwaway mongod
+(from PATH or MONGOD_BIN) on a free port with a temporary dbpath. Without either it
+returns uri=None and callers fall back to mongomock_wsgi, which runs the app on an
+in-process mongomock database (single worker only, since workers would not share it).
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from pymongo import MongoClient
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(uri, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            MongoClient(uri, serverSelectionTimeoutMS=500).admin.command("ping")
+            return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+
+
+def start_mongo():
+    """(uri, kind, stop): kind is 'external', 'mongod' or 'mongomock' (uri None)."""
+    if os.getenv("MONGODB_URI"):
+        return os.environ["MONGODB_URI"], "external", lambda: None
+    mongod = os.getenv("MONGOD_BIN") or shutil.which("mongod")
+    if not mongod:
+        return None, "mongomock", lambda: None
+
+    dbpath = tempfile.mkdtemp(prefix="bench-mongo-")
+    port = free_port()
+    process = subprocess.Popen(
+        [mongod, "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1", "--quiet"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    def stop():
+        process.terminate()
+        process.wait(timeout=10)
+        shutil.rmtree(dbpath, ignore_errors=True)
+
+    uri = f"mongodb://127.0.0.1:{port}"
+    try:
+        _wait_for(uri)
+    except Exception:
+        stop()
+        raise
+    return uri, "mongod", stop
+
+
+def patch_mongomock_bulk():
+    """pymongo 4.9+ passes sort= to mongomock's bulk builder, which mongomock 4.3 does not take."""
+    import mongomock.collection
+    builder = mongomock.collection.BulkOperationBuilder
+    add_update = builder.add_update
+    builder.add_update = (
+        lambda self, selector, doc, multi=False, upsert=False, collation=None, array_filters=None,
+        hint=None, sort=None: add_update(self, selector, doc, multi, upsert, collation, array_filters, hint))
+
+
+def network_bytes(uri):
+    """(bytesIn, bytesOut) counters of the server, or None when unavailable."""
+    if not uri:
+        return None
+    try:
+        network = MongoClient(uri).admin.command("serverStatus")["network"]
+    except Exception:
+        return None
+    return network["bytesIn"], network["bytesOut"]
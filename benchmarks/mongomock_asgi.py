@@ -0,0 +1,16 @@
+"""
+ASGI twin of mongomock_wsgi.py: the real Quart app with mongomock standing in for
+MongoClient. Run it with a single hypercorn worker.
+"""
+import os
+import sys
+
+import mongomock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import session_memory  # noqa: E402
+from mongo_standin import patch_mongomock_bulk  # noqa: E402
+
+patch_mongomock_bulk()  # for SESSION_WRITE_BEHIND=1
+session_memory.MongoClient = mongomock.MongoClient
+from asgi_app import app  # noqa: E402
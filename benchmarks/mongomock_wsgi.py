@@ -0,0 +1,31 @@
+"""
+WSGI entry point for load tests without a mongod: the real Flask app with mongomock
+standing in for MongoClient. Run it with a single gunicorn worker.
+"""
+import os
+import sys
+from collections import defaultdict
+
+import bson
+import mongomock
+from flask import jsonify, request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import session_memory  # noqa: E402
+from mongo_standin import patch_mongomock_bulk  # noqa: E402
+
+patch_mongomock_bulk()  # for SESSION_WRITE_BEHIND=1
+session_memory.MongoClient = mongomock.MongoClient
+from app import app, session_memory_store  # noqa: E402
+
+
+@app.route('/_bench/session_bytes', methods=['GET'])
+def session_bytes():
+    """Stored BSON bytes per session (memory, artifacts and profile) for _ids starting with ?prefix=."""
+    query = {'_id': {'$regex': f"^{request.args.get('prefix', '')}"}}
+    sizes = defaultdict(int)
+    for collection in (session_memory_store.collection, session_memory_store.artifacts,
+                       session_memory_store.profiles):
+        for doc in collection.find(query):
+            sizes[doc['_id']] += len(bson.encode(doc))
+    return jsonify(list(sizes.values()))
@@ -0,0 +1,173 @@
+"""
+Token-budgeted conversation history with an incrementally updated rolling summary.
+
+Prompts carry at most PROMPT_TOKEN_BUDGET tokens of history. Turns that the summary
+already covers are replaced by the summary text; every SUMMARY_EVERY_N_TURNS turns the
+older unsummarized turns are folded into the summary on a background thread and the
+result is persisted with the session (`summary`, `summarized_turns`).
+"""
+import os
+import math
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.messages import SystemMessage
+from helper import call_deepseek_with_fallback
+
+logger = logging.getLogger(__name__)
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+SUMMARY_EVERY_N_TURNS = int(os.getenv("SUMMARY_EVERY_N_TURNS", "6"))
+SUMMARY_KEEP_RECENT_TURNS = int(os.getenv("SUMMARY_KEEP_RECENT_TURNS", "4"))
+MESSAGE_OVERHEAD_TOKENS = 4  # role/formatting tokens per chat message
+
+SUMMARY_PROMPT = (
+    "你是一位心理疗愈师的助手。请把下面的心理疗愈对话整理成一段简洁的中文摘要，"
+    "保留用户的情感困境、关键事件、相关人物和情绪变化，不要加入评价或建议，不超过300字。"
+    "如果提供了已有摘要，请在其基础上合并新增对话，输出更新后的完整摘要。"
+)
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return (0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or 0x3000 <= code <= 0x303F
+            or 0xFF00 <= code <= 0xFFEF or 0xF900 <= code <= 0xFAFF)
+
+
+def count_tokens(text):
+    """
+    CJK-aware token estimate following DeepSeek's published ratios: about 0.6 tokens per
+    Chinese character and 0.3 tokens per other character.
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) * 0.3)
+
+
+def message_tokens(message):
+    content = message['content'] if isinstance(message, dict) else message.content
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_to_budget(messages, budget=PROMPT_TOKEN_BUDGET):
+    """Newest messages that fit in `budget` tokens, never starting on an assistant reply."""
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        used += message_tokens(message)
+        if used > budget:
+            break
+        kept.append(message)
+    kept.reverse()
+    while kept and _role(kept[0]) != 'human':
+        kept.pop(0)
+    return kept
+
+
+def _role(message):
+    if isinstance(message, dict):
+        return 'human' if message['role'] == 'user' else message['role']
+    return message.type
+
+
+def _turn_count(session_data, messages):
+    return session_data.get('turn_count', len(messages) // 2)
+
+
+def _unsummarized(session_data, messages):
+    """Messages of the turns the rolling summary does not cover yet."""
+    first_turn = _turn_count(session_data, messages) - len(messages) // 2
+    skip = max(0, session_data.get('summarized_turns', 0) - first_turn)
+    return messages[2 * skip:]
+
+
+def budgeted_history(session_data, memory, budget=PROMPT_TOKEN_BUDGET):
+    """Summary (as a system message) plus the newest unsummarized turns that fit the budget."""
+    summary = session_data.get('summary')
+    history = []
+    if summary:
+        history.append(SystemMessage(content=f"此前对话的摘要：\n{summary}"))
+        budget -= message_tokens(history[0])
+    messages = _unsummarized(session_data, memory.chat_memory.messages)
+    return history + fit_to_budget(messages, budget)
+
+
+def budgeted_chat_inputs(session_data, memory, user_input):
+    """Runtime inputs for the intake chat chain with a token-capped history."""
+    return {'input': user_input, 'history': budgeted_history(session_data, memory)}
+
+
+def budgeted_history_string(session_data, memory, budget=PROMPT_TOKEN_BUDGET):
+    """Flattened history for the reflection prompt: summary first, then recent turns."""
+    lines = []
+    for message in budgeted_history(session_data, memory, budget):
+        if message.type == 'system':
+            lines.append(message.content)
+        else:
+            lines.append(f"{'用户' if message.type == 'human' else 'AI'}: {message.content}")
+    return "\n".join(lines)
+
+
+def estimate_prompt_tokens(system_prompt, history, user_input):
+    return (count_tokens(system_prompt) + sum(message_tokens(m) for m in history)
+            + count_tokens(user_input) + 2 * MESSAGE_OVERHEAD_TOKENS)
+
+
+def usage_from_reply(reply):
+    """OpenAI-style usage dict of a LangChain chat reply ({} when not reported)."""
+    return (getattr(reply, 'response_metadata', None) or {}).get('token_usage') or {}
+
+
+def record_prompt_tokens(endpoint, estimated, usage):
+    """
+    Log estimated vs. reported input tokens for one DeepSeek request, with the prompt
+    tokens DeepSeek served from its context cache.
+    """
+    usage = usage or {}
+    logger.info("prompt_tokens endpoint=%s estimated=%d actual=%s cache_hit=%s cache_miss=%s",
+                endpoint, estimated, usage.get('prompt_tokens'),
+                usage.get('prompt_cache_hit_tokens'), usage.get('prompt_cache_miss_tokens'))
+
+
+def maybe_schedule_summary(store, session_id, session_data, memory):
+    """
+    Fold older turns into the rolling summary once SUMMARY_EVERY_N_TURNS new turns have
+    accumulated beyond the SUMMARY_KEEP_RECENT_TURNS kept verbatim. Runs off the request path.
+    """
+    messages = list(memory.chat_memory.messages)
+    turn_count = _turn_count(session_data, messages)
+    summarized_turns = session_data.get('summarized_turns', 0)
+    if turn_count - summarized_turns < SUMMARY_KEEP_RECENT_TURNS + SUMMARY_EVERY_N_TURNS:
+        return
+    with _pending_lock:
+        if session_id in _pending:
+            return
+        _pending.add(session_id)
+    to_fold = _unsummarized(session_data, messages)[:-2 * SUMMARY_KEEP_RECENT_TURNS]
+    new_summarized_turns = turn_count - SUMMARY_KEEP_RECENT_TURNS
+    _summary_executor.submit(_update_summary, store, session_id, session_data.get('summary'),
+                             to_fold, new_summarized_turns)
+
+
+def _update_summary(store, session_id, summary, to_fold, summarized_turns):
+    try:
+        transcript = "\n".join(
+            f"{'用户' if m.type == 'human' else 'AI'}: {m.content}" for m in to_fold
+        )
+        user_content = f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{transcript}"
+        new_summary = call_deepseek_with_fallback(
+            [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": user_content}],
+            temperature=0.3,
+        )
+        store.update_fields(session_id, {'summary': new_summary.strip(),
+                                         'summarized_turns': summarized_turns})
+    except Exception:
+        logger.exception("rolling summary update failed for session %s", session_id)
+    finally:
+        with _pending_lock:
+            _pending.discard(session_id)
@@ -0,0 +1,84 @@
+"""
+Request deadlines for DeepSeek calls.
+
+Each request gets a deadline when it starts (DEEPSEEK_REQUEST_DEADLINE, or less if the
+client sends X-Request-Timeout). Every DeepSeek call made on its behalf only gets the
+time that is left: key lease waits, retries on other keys, hedged duplicates and each
+HTTP timeout. The deadline is a context variable, so it follows the request into
+stream generators and asyncio tasks; narrative jobs, which outlive their request,
+run under NARRATIVE_JOB_DEADLINE instead.
+
+A stream that sends nothing for DEEPSEEK_STALL_TIMEOUT (tokens and keep-alives alike)
+is treated as stalled and cut off.
+"""
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+
+import httpx
+
+from metrics import DEEPSEEK_TIMEOUTS, inc
+
+DEEPSEEK_REQUEST_DEADLINE = float(os.getenv("DEEPSEEK_REQUEST_DEADLINE", "90"))
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5"))
+# longest a single non-streaming call may take, whatever the deadline
+DEEPSEEK_CALL_TIMEOUT = float(os.getenv("DEEPSEEK_CALL_TIMEOUT", "60"))
+DEEPSEEK_STALL_TIMEOUT = float(os.getenv("DEEPSEEK_STALL_TIMEOUT", "20"))
+NARRATIVE_JOB_DEADLINE = float(os.getenv("NARRATIVE_JOB_DEADLINE", "300"))
+
+_deadline = contextvars.ContextVar('deepseek_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request ran out of time before DeepSeek answered."""
+
+
+def start_deadline(client_timeout=None):
+    """Set this request's deadline; `client_timeout` is an X-Request-Timeout value in seconds."""
+    seconds = DEEPSEEK_REQUEST_DEADLINE
+    try:
+        if client_timeout:
+            seconds = min(seconds, max(0.0, float(client_timeout)))
+    except ValueError:
+        pass
+    _deadline.set(time.monotonic() + seconds)
+
+
+@contextmanager
+def deadline(seconds):
+    """Run the block under a deadline `seconds` from now (for work outside a request)."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the deadline; raises DeadlineExceeded once it has passed."""
+    at = _deadline.get()
+    if at is None:
+        return DEEPSEEK_REQUEST_DEADLINE
+    left = at - time.monotonic()
+    if left <= 0:
+        inc(DEEPSEEK_TIMEOUTS, 'deadline')
+        raise DeadlineExceeded("DeepSeek did not answer before the request deadline")
+    return left
+
+
+def http_timeout(stream=False):
+    """httpx timeout for one DeepSeek call: what is left of the deadline, with a stall limit on streams."""
+    left = remaining()
+    if stream:
+        return httpx.Timeout(left, connect=min(DEEPSEEK_CONNECT_TIMEOUT, left),
+                             read=min(DEEPSEEK_STALL_TIMEOUT, left))
+    left = min(left, DEEPSEEK_CALL_TIMEOUT)
+    return httpx.Timeout(left, connect=min(DEEPSEEK_CONNECT_TIMEOUT, left))
+
+
+def is_timeout(exc):
+    """True for a connect/read timeout raised by httpx or by the openai client under LangChain."""
+    if isinstance(exc, (httpx.TimeoutException, TimeoutError)):
+        return True
+    return any(cls.__name__ == 'APITimeoutError' for cls in type(exc).__mro__)
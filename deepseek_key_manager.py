@@ -1,28 +1,298 @@
 import os
+import re
+import time
+import random
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import threading
+from metrics import (
+    KEYS_IN_FLIGHT,
+    KEY_COOLDOWNS,
+    KEY_FAILOVERS,
+    KEY_LEASE_TIMEOUTS,
+    KEY_RELEASES,
+    KEY_REMOVALS,
+    KEY_RETRIES,
+    inc,
+)
 
 # Load environment variables from .env
 load_dotenv()
 
+# Per-key client-side limits; 0 disables the bucket and relies on 429 feedback only
+DEEPSEEK_KEY_RPM = int(os.getenv("DEEPSEEK_KEY_RPM", "0"))
+DEEPSEEK_KEY_TPM = int(os.getenv("DEEPSEEK_KEY_TPM", "0"))
+DEEPSEEK_KEY_MAX_CONCURRENCY = int(os.getenv("DEEPSEEK_KEY_MAX_CONCURRENCY", "32"))
+# Tokens charged to a bucket when the caller has no better estimate
+DEEPSEEK_DEFAULT_TOKEN_ESTIMATE = int(os.getenv("DEEPSEEK_DEFAULT_TOKEN_ESTIMATE", "2000"))
+# How long a request may queue for a key when every key is saturated or cooling down
+DEEPSEEK_LEASE_TIMEOUT = float(os.getenv("DEEPSEEK_LEASE_TIMEOUT", "10"))
+COOLDOWN_BASE_SECONDS = 1.0
+COOLDOWN_MAX_SECONDS = 60.0
+
+
+class KeyPoolExhausted(Exception):
+    """No key could be leased before the timeout."""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _load_keys():
+    numbered = []
+    for name, value in os.environ.items():
+        match = re.fullmatch(r"DEEPSEEK_API_KEY_(\d+)", name)
+        if match and value:
+            numbered.append((int(match.group(1)), value))
+    return [value for _, value in sorted(numbered)]
+
+
+def _parse_duration(value):
+    """'1s', '6m0s', '20ms', '0.5' -> seconds (as used by x-ratelimit-reset-* headers)."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers):
+    """Seconds to wait according to Retry-After / rate-limit headers, or None."""
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in headers.items()}
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        value = headers['retry-after']
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for remaining, reset in (('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+                             ('x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens')):
+        if headers.get(remaining) == '0' and reset in headers:
+            return _parse_duration(headers[reset])
+    return None
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute, up to one minute's worth of burst."""
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.refill_per_second = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """0 if `amount` can be taken now, else seconds until it can."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class KeyState:
+    def __init__(self, key, rpm, tpm):
+        self.key = key
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.in_flight = 0
+        self.failures = 0  # consecutive failures, drives the backoff exponent
+        self.cooldown_until = 0.0
+        self.health = 1.0  # EWMA of success (1) / failure (0)
+
+    def wait_time(self, tokens, now):
+        waits = [max(0.0, self.cooldown_until - now)]
+        if self.requests:
+            waits.append(self.requests.wait_time(1, now))
+        if self.tokens:
+            waits.append(self.tokens.wait_time(tokens, now))
+        return max(waits)
+
+
+class KeyLease:
+    """
+    A key handed to one request. Report the outcome with succeeded()/rate_limited()/
+    failed()/revoked(); leaving the `with` block without a report counts as success.
+    """
+    def __init__(self, manager, state):
+        self.manager = manager
+        self.state = state
+        self.key = state.key
+        self._released = False
+
+    def succeeded(self):
+        self._release('success', None)
+
+    def rate_limited(self, retry_after=None):
+        self._release('rate_limited', retry_after)
+
+    def failed(self):
+        self._release('failure', None)
+
+    def revoked(self):
+        self._release('revoked', None)
+
+    def _release(self, outcome, retry_after):
+        if not self._released:
+            self._released = True
+            self.manager._release(self.state, outcome, retry_after)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.succeeded()
+        else:
+            self.failed()
+        return False
+
+
 class DeepSeekKeyManager:
-    def __init__(self):
-        self.keys = [
-            os.getenv("DEEPSEEK_API_KEY_1"),
-        ]
-        self.keys = [k for k in self.keys if k]
-        if not self.keys:
+    def __init__(self, keys=None, rpm=DEEPSEEK_KEY_RPM, tpm=DEEPSEEK_KEY_TPM,
+                 max_concurrency=DEEPSEEK_KEY_MAX_CONCURRENCY):
+        keys = [k for k in (keys if keys is not None else _load_keys()) if k]
+        if not keys:
             raise ValueError("No DeepSeek API keys found in environment variables.")
-        self.current = 0
+        self.max_concurrency = max_concurrency
+        self._states = [KeyState(k, rpm, tpm) for k in keys]
         self.lock = threading.Lock()
+        self._available = threading.Condition(self.lock)
+        self._removal_listeners = []
+        self.retries = 0
+        self.rate_limited_count = 0
+        self.cooldowns = 0
+        self.lease_timeouts = 0
+
+    @property
+    def keys(self):
+        return [s.key for s in self._states]
+
+    def lease(self, tokens=None, timeout=DEEPSEEK_LEASE_TIMEOUT, exclude=()):
+        """
+        Lease the least-loaded healthy key that has budget for one request of `tokens`.
+        Blocks (up to `timeout`) while every key is saturated or cooling down.
+        Keys in `exclude` are only used when no other key exists.
+        """
+        tokens = tokens or DEEPSEEK_DEFAULT_TOKEN_ESTIMATE
+        deadline = time.monotonic() + timeout
+        with self._available:
+            while True:
+                now = time.monotonic()
+                candidates = [s for s in self._states if s.key not in exclude] or self._states
+                ready = [s for s in candidates
+                         if s.in_flight < self.max_concurrency and s.wait_time(tokens, now) == 0]
+                if ready:
+                    state = min(ready, key=lambda s: (s.in_flight, -s.health))
+                    if state.requests:
+                        state.requests.take(1)
+                    if state.tokens:
+                        state.tokens.take(tokens)
+                    state.in_flight += 1
+                    inc(KEYS_IN_FLIGHT)
+                    if exclude:
+                        inc(KEY_FAILOVERS)
+                    return KeyLease(self, state)
+                remaining = deadline - now
+                soonest = min(s.wait_time(tokens, now) for s in candidates)
+                if remaining <= 0:
+                    if timeout:
+                        self.lease_timeouts += 1
+                        inc(KEY_LEASE_TIMEOUTS)
+                    raise KeyPoolExhausted("All DeepSeek API keys are saturated or cooling down.",
+                                           retry_after=soonest or None)
+                # woken early by a release; otherwise when the first key frees up
+                self._available.wait(min(remaining, soonest or remaining))
 
     def get_key(self):
+        """Healthiest key right now, without leasing (for callers outside the pool)."""
+        with self.lock:
+            now = time.monotonic()
+            return min(self._states, key=lambda s: (s.cooldown_until > now, s.in_flight, -s.health)).key
+
+    def _release(self, state, outcome, retry_after):
+        with self._available:
+            state.in_flight -= 1
+            inc(KEYS_IN_FLIGHT, amount=-1)
+            inc(KEY_RELEASES, outcome)
+            now = time.monotonic()
+            if outcome == 'success':
+                state.failures = 0
+                state.health = 0.9 * state.health + 0.1
+            else:
+                state.failures += 1
+                state.health = 0.9 * state.health
+                self.retries += 1
+                inc(KEY_RETRIES)
+                if outcome == 'rate_limited':
+                    self.rate_limited_count += 1
+                backoff = min(COOLDOWN_MAX_SECONDS, COOLDOWN_BASE_SECONDS * 2 ** (state.failures - 1))
+                backoff *= random.uniform(0.8, 1.2)
+                if outcome == 'rate_limited' or state.failures >= 3:
+                    state.cooldown_until = now + max(backoff, retry_after or 0)
+                    self.cooldowns += 1
+                    inc(KEY_COOLDOWNS)
+            self._available.notify_all()
+        if outcome == 'revoked':
+            self.remove_key(state.key)
+
+    def observe_headers(self, key, headers):
+        """Cool a key down early when a successful response says its rate window is used up."""
+        retry_after = parse_retry_after(headers)
+        if not retry_after:
+            return
+        with self.lock:
+            for state in self._states:
+                if state.key == key:
+                    state.cooldown_until = max(state.cooldown_until, time.monotonic() + retry_after)
+
+    def add_removal_listener(self, callback):
+        """Register callback(key), called after a key is taken out of rotation."""
+        self._removal_listeners.append(callback)
+
+    def remove_key(self, key):
+        """Take a revoked/invalid key out of rotation. The last remaining key is kept."""
         with self.lock:
-            return self.keys[self.current]
+            if key not in self.keys or len(self._states) == 1:
+                return False
+            self._states = [s for s in self._states if s.key != key]
+        inc(KEY_REMOVALS)
+        for callback in self._removal_listeners:
+            callback(key)
+        return True
 
-    def rotate(self):
+    def stats(self):
         with self.lock:
-            self.current = (self.current + 1) % len(self.keys)
-            return self.keys[self.current]
+            now = time.monotonic()
+            return {
+                'keys': len(self._states),
+                'cooling_down': sum(1 for s in self._states if s.cooldown_until > now),
+                'in_flight': sum(s.in_flight for s in self._states),
+                'retries': self.retries,
+                'rate_limited': self.rate_limited_count,
+                'cooldowns': self.cooldowns,
+                'lease_timeouts': self.lease_timeouts,
+            }
 
 deepseek_key_manager = DeepSeekKeyManager()
@@ -0,0 +1,37 @@
+"""
+gunicorn settings, loaded automatically from the working directory (see Dockerfile).
+
+Workers share PROMETHEUS_MULTIPROC_DIR so /metrics on any worker reports the whole
+server; it must be set here, before the workers import prometheus_client.
+Each worker starts its warm-up (startup.py) as soon as it has loaded the app, and
+applies its queued write-behind session writes before it exits.
+"""
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus_multiproc"))
+
+
+def on_starting(server):
+    # samples from a previous run would otherwise be summed into the new one
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # the app is loaded (and, with --preload, forked): warm this worker before traffic arrives
+    import startup
+    startup.start_all()
+
+
+def worker_exit(server, worker):
+    # after a graceful stop (SIGTERM) or max_requests restart: nothing queued may be lost
+    import session_memory
+    session_memory.flush_all()
@@ -1,11 +1,89 @@
-from operator import itemgetter
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferWindowMemory
-from langchain.schema.runnable import RunnablePassthrough, RunnableLambda
-from deepseek_key_manager import deepseek_key_manager
-import requests
-from flask import stream_with_context
+import os
+import json
+import time
+import asyncio
+import hashlib
+import itertools
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as futures_wait
+import httpx
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from metrics import DEEPSEEK_HEDGES, DEEPSEEK_TIMEOUTS, cache_event, inc, record_span, span
+from deadlines import (
+    DEEPSEEK_CALL_TIMEOUT,
+    DEEPSEEK_CONNECT_TIMEOUT,
+    DEEPSEEK_STALL_TIMEOUT,
+    DeadlineExceeded,
+    http_timeout,
+    is_timeout,
+    remaining,
+)
+from deepseek_key_manager import (
+    deepseek_key_manager,
+    parse_retry_after,
+    KeyPoolExhausted,
+    DEEPSEEK_LEASE_TIMEOUT,
+)
+
+
+DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
+# Connection pool shared by every DeepSeek call made from this process
+DEEPSEEK_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "64")),
+    max_keepalive_connections=int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "32")),
+    keepalive_expiry=75,
+)
+
+# Hedging of slow non-streaming calls (see HedgePolicy); off unless DEEPSEEK_HEDGING=1
+DEEPSEEK_HEDGING = os.getenv("DEEPSEEK_HEDGING", "0") == "1"
+DEEPSEEK_HEDGE_QUANTILE = float(os.getenv("DEEPSEEK_HEDGE_QUANTILE", "0.95"))
+DEEPSEEK_HEDGE_MAX_RATIO = float(os.getenv("DEEPSEEK_HEDGE_MAX_RATIO", "0.1"))
+DEEPSEEK_HEDGE_MIN_DELAY = float(os.getenv("DEEPSEEK_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+HEDGE_BURST = 5
+
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+
+def _pooled_client(kind):
+    # Clients are created lazily and per pid, so gunicorn workers never share a
+    # pool inherited across fork.
+    key = (kind, os.getpid())
+    client = _http_clients.get(key)
+    if client is None:
+        with _http_clients_lock:
+            client = _http_clients.get(key)
+            if client is None:
+                client_cls = httpx.AsyncClient if kind == 'async' else httpx.Client
+                client = client_cls(http2=True, limits=DEEPSEEK_POOL_LIMITS, timeout=60)
+                _http_clients[key] = client
+    return client
+
+
+def get_http_client():
+    """Long-lived, pooled HTTP/2 client for synchronous DeepSeek calls."""
+    return _pooled_client('sync')
+
+
+def get_async_http_client():
+    """Long-lived, pooled HTTP/2 client for the ASGI app (one event loop per process)."""
+    return _pooled_client('async')
+
+
+GREETING = (
+    "你好，我是一名心理疗愈机器人，感谢你愿意在这里分享。\n"
+    "你可以慢慢告诉我你最近遇到的情绪困境。无论是关于工作、学业上的压力，经济方面的焦虑，"
+    "身体或心理上的不适，还是在人际关系中的烦恼与失落，都可以随意向我倾诉。我会认真聆听，不评判、不催促。\n"
+    "你愿意和我说说看吗？"
+)
+
+PURE_CHAT_SYSTEM_PROMPT = (
+    "你是一位极其出色的心理疗愈师，擅长帮助用户缓解他们的情绪困境。"
+)
 
 
 INITIAL_PROMPT = """
@@ -40,95 +118,129 @@ REFLECTION_PROMPT = '''
 引导用户思考这个故事带来的新想法、新视角，以及这些新的想法和视角如何帮助他们自己应对目前的情绪困境。请注意不要重复询问用户对新想法和新视角的思考。但是你可以根据用户的回答适当、灵活地与用户就新想法和新视角进行互动和交流。
 '''
 
-def build_chain(memory, openai_api_key):
-    prompt = ChatPromptTemplate.from_messages([
-        ('system', INITIAL_PROMPT),
-        MessagesPlaceholder(variable_name='history'),
-        ('human', '{input}')
-    ])
-    llm = ChatOpenAI(
-    model="deepseek-chat",
-    temperature=0.7,
-    max_tokens=None,
-    openai_api_key=deepseek_key_manager.get_key(),
-    openai_api_base="https://api.deepseek.com/v1",  # Change this!
-)
-    chain = (
-        RunnablePassthrough.assign(
-            history=RunnableLambda(memory.load_memory_variables) | itemgetter('history')
-        )
-        | prompt
-        | llm
+CHAT_PROMPT = ChatPromptTemplate.from_messages([
+    ('system', INITIAL_PROMPT),
+    MessagesPlaceholder(variable_name='history'),
+    ('human', '{input}')
+])
+
+NARRATIVE_PROMPT = ChatPromptTemplate.from_messages([
+    ('system', STORYWRITER_PROMPT),
+    ('user', '{input}')
+])
+
+# History and story are template variables filled at invoke time, not baked into the string.
+# The static REFLECTION_PROMPT comes first so every request shares a byte-identical prefix
+# (DeepSeek's context cache only matches on prompt prefixes).
+REFLECTION_CHAT_PROMPT = ChatPromptTemplate.from_messages([
+    ('system', REFLECTION_PROMPT
+               + "\n用户的情感困境和对话历史如下：\n{history_chat}\n\n"
+               "以下是基于用户情感困境生成的文学作品：\n{story}"),
+    MessagesPlaceholder(variable_name='history', optional=True),
+    ('human', '{input}')
+])
+
+
+def warm_imports():
+    """
+    Import the modules the first chain build and chat turn need. They take about a second
+    to load, so they are not imported with the app; the worker warm-up calls this instead.
+    """
+    import langchain_openai  # noqa: F401
+    import langchain.memory  # noqa: F401
+    from langchain_core import output_parsers  # noqa: F401
+
+
+def _build_llm(model, openai_api_key, streaming=False):
+    from langchain_openai import ChatOpenAI
+    # fixed per client: streams get the stall limit between reads; the request deadline
+    # is enforced around the call by the key wrappers
+    read_timeout = DEEPSEEK_STALL_TIMEOUT if streaming else DEEPSEEK_CALL_TIMEOUT
+    return ChatOpenAI(
+        model=model,
+        temperature=0.7,
+        max_tokens=None,
+        openai_api_key=openai_api_key,
+        openai_api_base=DEEPSEEK_API_BASE,
+        streaming=streaming,
+        stream_usage=True,  # token usage on the last chunk of .stream()/.astream()
+        max_retries=0,  # 429s/errors go back to the key pool, which retries on another key
+        request_timeout=httpx.Timeout(DEEPSEEK_CALL_TIMEOUT, connect=DEEPSEEK_CONNECT_TIMEOUT, read=read_timeout),
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
     )
-    return chain
-
-# def build_narrative_chain(openai_api_key):
-#     from langchain_core.output_parsers import StrOutputParser
-#     generator_prompt = ChatPromptTemplate.from_messages([
-#         ('system', STORYWRITER_PROMPT),
-#         ('user', '{input}')
-#     ])
-#     llm = ChatOpenAI(
-#         model="deepseek-chat",
-#         temperature=0.7,
-#         max_tokens=None,
-#         openai_api_key=deepseek_key_manager.get_key(),
-#         openai_api_base="https://api.deepseek.com/v1",
-#     )
-#     output_parser = StrOutputParser()
-#     narrative_generator = generator_prompt | llm | output_parser
-#     return narrative_generator
+
+
+def _build_pipeline(kind, model, openai_api_key, streaming=False):
+    from langchain_core.output_parsers import StrOutputParser
+    if kind == 'chat':
+        return CHAT_PROMPT | _build_llm(model, openai_api_key, streaming)
+    if kind == 'narrative':
+        # streaming so .stream()/.astream() yield string chunks
+        return NARRATIVE_PROMPT | _build_llm(model, openai_api_key, streaming=True) | StrOutputParser()
+    if kind == 'reflection':
+        return REFLECTION_CHAT_PROMPT | _build_llm(model, openai_api_key, streaming)
+    raise ValueError(f"Unknown chain kind: {kind}")
+
+
+class ChainRegistry:
+    """
+    Compiled LCEL pipelines keyed by (chain kind, model, api key, streaming). Each pipeline is built
+    once and is stateless: per-session data (history, story, ...) is passed at invoke time.
+    """
+    def __init__(self):
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, openai_api_key, model="deepseek-chat", streaming=False):
+        key = (kind, model, openai_api_key, streaming)
+        chain = self._chains.get(key)
+        if chain is None:
+            with self._lock:
+                chain = self._chains.get(key)
+                if chain is None:
+                    with span('chain_build'):
+                        chain = _build_pipeline(kind, model, openai_api_key, streaming)
+                    self._chains[key] = chain
+        return chain
+
+    def evict_key(self, openai_api_key):
+        with self._lock:
+            for key in [k for k in self._chains if k[2] == openai_api_key]:
+                del self._chains[key]
+
+
+chain_registry = ChainRegistry()
+deepseek_key_manager.add_removal_listener(chain_registry.evict_key)
+
+
+def build_chain(openai_api_key, streaming=False):
+    """Intake chat chain; invoke with chat_inputs(memory, user_input). streaming=True for .stream()."""
+    return chain_registry.get('chat', openai_api_key, streaming=streaming)
+
+
+def chat_inputs(memory, user_input):
+    return {'input': user_input, 'history': memory.load_memory_variables({})['history']}
+
+
 def build_narrative_chain(openai_api_key: str):
     """
     Returns an LCEL pipeline: (prompt) -> (LLM-stream) -> (string chunks).
     - Uses the *provided* API key (no hidden re-fetch from manager)
-    - Caps max_tokens for predictable latency
-    - Enables streaming so .astream() yields string chunks
+    - Enables streaming so .stream()/.astream() yield string chunks
     """
-    from langchain_core.output_parsers import StrOutputParser
-    generator_prompt = ChatPromptTemplate.from_messages([
-        ('system', STORYWRITER_PROMPT),
-        ('user', '{input}')
-    ])
-
-    llm = ChatOpenAI(
-        model="deepseek-chat",
-        temperature=0.7,
-        max_tokens=None,                   # <= cap output to keep latency down
-        openai_api_key=openai_api_key,     # <= use the arg you pass in
-        openai_api_base="https://api.deepseek.com/v1",
-        streaming=True,                    # <= important for .astream()
-    )
+    return chain_registry.get('narrative', openai_api_key)
 
-    return generator_prompt | llm | StrOutputParser()
 
+def build_reflection_chain(openai_api_key, streaming=False):
+    """Reflection chain; invoke with {'input', 'history_chat', 'story'}. streaming=True for .stream()."""
+    return chain_registry.get('reflection', openai_api_key, streaming=streaming)
 
 
+# Helper to render a chat prompt to plain {'role', 'content'} dicts (for cache keys)
+def prompt_as_messages(prompt, inputs):
+    return [{"role": m.type, "content": m.content} for m in prompt.format_messages(**inputs)]
 
-def build_reflection_chain(history_chat, story, openai_api_key):
-    prompt = ChatPromptTemplate.from_messages([
-        ('system', f"用户的情感困境和对话历史如下：\n{history_chat}\n\n"
-                   f"以下是基于用户情感困境生成的文学作品：\n{story}\n\n"
-                   +REFLECTION_PROMPT),
-        MessagesPlaceholder(variable_name='history'),
-        ('human', '{input}')
-    ])
-    memory = ConversationBufferWindowMemory(k=30, return_messages=True)
-    llm = ChatOpenAI(
-        model="deepseek-chat",
-        temperature=0.7,
-        max_tokens=None,
-        openai_api_key=deepseek_key_manager.get_key(),
-        openai_api_base="https://api.deepseek.com/v1",  
-    )
-    reflector_chain = (
-        RunnablePassthrough.assign(
-            history=RunnableLambda(memory.load_memory_variables) | itemgetter('history')
-        )
-        | prompt
-        | llm
-    )
-    return reflector_chain, memory
 
 # Helper to flatten chat memory into a human-readable history string (for reflection)
 def get_history_as_string(memory):
@@ -141,31 +253,722 @@ def get_history_as_string(memory):
     return "\n".join(history)
 
 
-def call_deepseek_with_fallback(messages, model="deepseek-chat", temperature=0.7):
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {"Content-Type": "application/json"}
+NEXT_STEP = "下一步"  # what INITIAL_PROMPT tells the user to type once intake is done
+
+
+def _is_next_step(text):
+    return text.strip().strip('“”"\'。.!！') == NEXT_STEP
+
+
+def intake_concluded(reply):
+    """True when an intake reply asks the user to type "下一步", i.e. the narrative comes next."""
+    return NEXT_STEP in reply
+
+
+def narrative_input(memory, k=12):
+    """
+    Compact narrative seed built from the last k non-empty lines of the chat history.
+    A "下一步" turn (and the reply to it) is left out, so the seed is the same before
+    and after the user types it.
+    """
+    msgs = memory.buffer_as_messages if hasattr(memory, 'buffer_as_messages') else []
+    history = []
+    skip_reply = False
+    for m in msgs:
+        if m.type == "human" and _is_next_step(m.content):
+            skip_reply = True
+            continue
+        if skip_reply and m.type != "human":
+            skip_reply = False
+            continue
+        skip_reply = False
+        history.append(f"{'用户' if m.type == 'human' else 'AI'}: {m.content}")
+    lines = [ln for ln in "\n".join(history).splitlines() if ln.strip()]
+    chat_history = "\n".join(lines[-k:])
+    return f"我的情感困境（摘要）：\n{chat_history}"
+
+
+def _status_code(exc):
+    status = getattr(exc, 'status_code', None)
+    response = getattr(exc, 'response', None)
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)
+    return status
+
+
+def _is_rate_limited(exc):
+    return _status_code(exc) == 429 or "rate limit" in str(exc).lower()
+
+
+def _retry_after(exc):
+    response = getattr(exc, 'response', None)
+    return parse_retry_after(getattr(response, 'headers', None))
+
+
+def _report_failure(lease, exc):
+    """Report a failed call on `lease` to the pool; True if the call may be retried on another key."""
+    if isinstance(exc, DeadlineExceeded):
+        lease.succeeded()  # out of time; says nothing about the key
+        return False
+    if _status_code(exc) == 401:
+        lease.revoked()
+        return True
+    if _is_rate_limited(exc):
+        lease.rate_limited(_retry_after(exc))
+        return True
+    lease.failed()
+    # a call that timed out or stalled may well go through on another key
+    return is_timeout(exc)
 
-    for _ in range(len(deepseek_key_manager.keys)):
-        api_key = deepseek_key_manager.get_key()
-        headers["Authorization"] = f"Bearer {api_key}"
-        payload = {
-            "model": model,
-            "messages": messages,
-            "temperature": temperature,
-        }
+
+def _attempts():
+    return max(2, len(deepseek_key_manager.keys))
+
+
+def _exhausted(last_error):
+    return KeyPoolExhausted("All DeepSeek API keys exhausted or invalid.",
+                            retry_after=_retry_after(last_error))
+
+
+def _lease_timeout():
+    return min(DEEPSEEK_LEASE_TIMEOUT, remaining())
+
+
+async def _alease(tokens, exclude):
+    # fast path without a thread hop; only queue in a worker thread when the pool is saturated
+    try:
+        return deepseek_key_manager.lease(tokens, timeout=0, exclude=exclude)
+    except KeyPoolExhausted:
+        return await asyncio.to_thread(deepseek_key_manager.lease, tokens, _lease_timeout(), exclude)
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a slow non-streaming call on another key: once it has
+    taken longer than DEEPSEEK_HEDGE_QUANTILE of the recent calls of its kind, and only
+    while the budget of DEEPSEEK_HEDGE_MAX_RATIO extra calls per call allows it.
+    """
+    def __init__(self, enabled=DEEPSEEK_HEDGING, quantile=DEEPSEEK_HEDGE_QUANTILE,
+                 max_ratio=DEEPSEEK_HEDGE_MAX_RATIO, min_delay=DEEPSEEK_HEDGE_MIN_DELAY):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self._samples = {}  # kind -> recent call durations
+        self._budget = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, kind, seconds):
+        if kind is None:
+            return
+        with self._lock:
+            samples = self._samples.get(kind)
+            if samples is None:
+                samples = self._samples[kind] = deque(maxlen=HEDGE_WINDOW)
+            samples.append(seconds)
+
+    def delay(self, kind):
+        """Seconds after which a call of `kind` starting now gets hedged, or None."""
+        if not self.enabled or kind is None or len(deepseek_key_manager.keys) < 2:
+            return None
+        with self._lock:
+            self._budget = min(HEDGE_BURST, self._budget + self.max_ratio)
+            samples = sorted(self._samples.get(kind, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.min_delay, samples[min(len(samples) - 1, int(len(samples) * self.quantile))])
+
+    def can_hedge(self):
+        with self._lock:
+            return self._budget >= 1
+
+    def spend(self):
+        with self._lock:
+            self._budget -= 1
+
+
+hedge_policy = HedgePolicy()
+_call_pools = {}
+
+
+def _call_pool():
+    """Threads for non-streaming DeepSeek calls, so callers can stop waiting at their deadline (per pid)."""
+    pool = _call_pools.get(os.getpid())
+    if pool is None:
+        with _http_clients_lock:
+            pool = _call_pools.get(os.getpid())
+            if pool is None:
+                pool = _call_pools[os.getpid()] = ThreadPoolExecutor(
+                    max_workers=DEEPSEEK_POOL_LIMITS.max_connections, thread_name_prefix="deepseek")
+    return pool
+
+
+def _hedge_lease(tokens, tried):
+    """A free key not tried yet, if the hedge budget allows one more call; else None."""
+    lease = None
+    if hedge_policy.can_hedge():
         try:
-            resp = requests.post(url, json=payload, headers=headers, timeout=60)
-            resp.raise_for_status()
-            data = resp.json()
-            return data["choices"][0]["message"]["content"]
-        except requests.HTTPError as e:
-            if resp.status_code == 429:
-                deepseek_key_manager.rotate()
+            lease = deepseek_key_manager.lease(tokens, timeout=0, exclude=tried)
+        except KeyPoolExhausted:
+            pass
+    if lease is not None and lease.key in tried:
+        lease.succeeded()  # the only free key is one already in use
+        lease = None
+    if lease is None:
+        inc(DEEPSEEK_HEDGES, 'skipped')
+        return None
+    hedge_policy.spend()
+    inc(DEEPSEEK_HEDGES, 'sent')
+    return lease
+
+
+def _attempt(call, lease, kind):
+    """(result, error, retryable) of call(lease.key), with the outcome reported to the pool."""
+    started = time.perf_counter()
+    try:
+        with span('deepseek_total'):
+            result = call(lease.key)
+    except Exception as e:
+        if is_timeout(e) and not isinstance(e, DeadlineExceeded):
+            inc(DEEPSEEK_TIMEOUTS, 'call')
+        return None, e, _report_failure(lease, e)
+    lease.succeeded()
+    hedge_policy.observe(kind, time.perf_counter() - started)
+    return result, None, False
+
+
+def with_deepseek_key(call, tokens=None, hedge=None):
+    """
+    Run call(api_key) on a key leased from the pool, within the request deadline.
+    Rate-limited, revoked and timed-out keys are reported back (cool-down / removal) and
+    the call is retried on another key. A call of kind `hedge` that is slower than
+    usual gets a duplicate on another key (with hedging on); the first answer wins and
+    the other is left to finish on its own.
+    """
+    tried = set()
+    last_error = None
+    for _ in range(_attempts()):
+        lease = deepseek_key_manager.lease(tokens, timeout=_lease_timeout(), exclude=tried)
+        tried.add(lease.key)
+        # future -> True for the hedged duplicate; each runs in a copy of this context (deadline, spans)
+        pending = {_call_pool().submit(contextvars.copy_context().run, _attempt, call, lease, hedge): False}
+        hedge_at = hedge_policy.delay(hedge)
+        if hedge_at is not None:
+            hedge_at += time.monotonic()
+        retry = True
+        while pending:
+            timeout = remaining()
+            if hedge_at is not None:
+                timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+            done, _ = futures_wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                hedged = pending.pop(future)
+                result, error, retryable = future.result()
+                if error is None:
+                    if hedged:
+                        inc(DEEPSEEK_HEDGES, 'won')
+                    return result
+                last_error, retry = error, retry and retryable
+            if hedge_at is not None and time.monotonic() >= hedge_at and pending:
+                hedge_at = None
+                hedge_lease = _hedge_lease(tokens, tried)
+                if hedge_lease is not None:
+                    tried.add(hedge_lease.key)
+                    pending[_call_pool().submit(contextvars.copy_context().run, _attempt, call,
+                                                hedge_lease, hedge)] = True
+        if not retry:
+            raise last_error
+    raise _exhausted(last_error) from last_error
+
+
+async def _aattempt(call, lease, kind):
+    """Async twin of _attempt; a cancelled attempt (the losing hedge) gives its key back unharmed."""
+    started = time.perf_counter()
+    try:
+        with span('deepseek_total'):
+            result = await call(lease.key)
+    except Exception as e:
+        if is_timeout(e) and not isinstance(e, DeadlineExceeded):
+            inc(DEEPSEEK_TIMEOUTS, 'call')
+        return None, e, _report_failure(lease, e)
+    finally:
+        lease.succeeded()  # no-op once reported
+    hedge_policy.observe(kind, time.perf_counter() - started)
+    return result, None, False
+
+
+async def awith_deepseek_key(call, tokens=None, hedge=None):
+    """Async twin of with_deepseek_key; `call(api_key)` returns an awaitable. Losing hedges are cancelled."""
+    tried = set()
+    last_error = None
+    for _ in range(_attempts()):
+        lease = await _alease(tokens, tried)
+        tried.add(lease.key)
+        pending = {asyncio.ensure_future(_aattempt(call, lease, hedge)): False}
+        hedge_at = hedge_policy.delay(hedge)
+        if hedge_at is not None:
+            hedge_at += time.monotonic()
+        retry = True
+        try:
+            while pending:
+                timeout = remaining()
+                if hedge_at is not None:
+                    timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    hedged = pending.pop(task)
+                    result, error, retryable = task.result()
+                    if error is None:
+                        if hedged:
+                            inc(DEEPSEEK_HEDGES, 'won')
+                        return result
+                    last_error, retry = error, retry and retryable
+                if hedge_at is not None and time.monotonic() >= hedge_at and pending:
+                    hedge_at = None
+                    hedge_lease = _hedge_lease(tokens, tried)
+                    if hedge_lease is not None:
+                        tried.add(hedge_lease.key)
+                        pending[asyncio.ensure_future(_aattempt(call, hedge_lease, hedge))] = True
+        finally:
+            for task in pending:
+                task.cancel()
+        if not retry:
+            raise last_error
+    raise _exhausted(last_error) from last_error
+
+
+def stream_with_deepseek_key(open_stream, tokens=None):
+    """
+    Yield chunks from open_stream(api_key) on a leased key, within the request deadline.
+    Fails over to another key (also when the stream stalls) only until the first chunk
+    has been yielded; after that a stall or the deadline ends the stream with an error.
+    """
+    tried = set()
+    last_error = None
+    for _ in range(_attempts()):
+        lease = deepseek_key_manager.lease(tokens, timeout=_lease_timeout(), exclude=tried)
+        tried.add(lease.key)
+        started = False
+        opened = time.perf_counter()
+        try:
+            for chunk in open_stream(lease.key):
+                if not started:
+                    record_span('deepseek_ttft', time.perf_counter() - opened)
+                started = True
+                yield chunk
+                remaining()
+        except Exception as e:
+            if is_timeout(e) and not isinstance(e, DeadlineExceeded):
+                inc(DEEPSEEK_TIMEOUTS, 'stall')
+            if _report_failure(lease, e) and not started:
+                last_error = e
                 continue
             raise
+        finally:
+            lease.succeeded()  # no-op if already reported; covers consumers closing early
+            if started:
+                record_span('deepseek_total', time.perf_counter() - opened)
+        return
+    raise _exhausted(last_error) from last_error
+
+
+async def astream_with_deepseek_key(open_stream, tokens=None):
+    """Async twin of stream_with_deepseek_key; open_stream(api_key) returns an async iterator."""
+    tried = set()
+    last_error = None
+    for _ in range(_attempts()):
+        lease = await _alease(tokens, tried)
+        tried.add(lease.key)
+        started = False
+        opened = time.perf_counter()
+        try:
+            async for chunk in open_stream(lease.key):
+                if not started:
+                    record_span('deepseek_ttft', time.perf_counter() - opened)
+                started = True
+                yield chunk
+                remaining()
         except Exception as e:
-            if "rate limit" in str(e).lower():
-                deepseek_key_manager.rotate()
+            if is_timeout(e) and not isinstance(e, DeadlineExceeded):
+                inc(DEEPSEEK_TIMEOUTS, 'stall')
+            if _report_failure(lease, e) and not started:
+                last_error = e
                 continue
-            raise e
-    raise Exception("All DeepSeek API keys exhausted or invalid.")
+            raise
+        finally:
+            lease.succeeded()
+            if started:
+                record_span('deepseek_total', time.perf_counter() - opened)
+        return
+    raise _exhausted(last_error) from last_error
+
+
+def call_deepseek_with_fallback(messages, model="deepseek-chat", temperature=0.7, usage=None, hedge=None):
+    """
+    Plain chat completion; if `usage` is a dict it receives the response's token usage.
+    `hedge` names the kind of call for hedging (see with_deepseek_key).
+    """
+    url = f"{DEEPSEEK_API_BASE}/chat/completions"
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+    }
+
+    def call(api_key):
+        resp = get_http_client().post(
+            url, json=payload, headers={"Authorization": f"Bearer {api_key}"}, timeout=http_timeout()
+        )
+        resp.raise_for_status()
+        deepseek_key_manager.observe_headers(api_key, resp.headers)
+        data = resp.json()
+        if usage is not None:
+            usage.update(data.get("usage") or {})
+        return data["choices"][0]["message"]["content"]
+
+    return with_deepseek_key(call, hedge=hedge)
+
+
+async def acall_deepseek_with_fallback(messages, model="deepseek-chat", temperature=0.7, usage=None,
+                                       hedge=None):
+    """Async twin of call_deepseek_with_fallback for the ASGI app."""
+    url = f"{DEEPSEEK_API_BASE}/chat/completions"
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+    }
+
+    async def call(api_key):
+        resp = await get_async_http_client().post(
+            url, json=payload, headers={"Authorization": f"Bearer {api_key}"}, timeout=http_timeout()
+        )
+        resp.raise_for_status()
+        deepseek_key_manager.observe_headers(api_key, resp.headers)
+        data = resp.json()
+        if usage is not None:
+            usage.update(data.get("usage") or {})
+        return data["choices"][0]["message"]["content"]
+
+    return await awith_deepseek_key(call, hedge=hedge)
+
+
+def _stream_payload(messages, model, temperature):
+    return {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+
+
+def _stream_delta(line, usage):
+    """Content of one `data:` line of a chat completion stream; fills `usage` from the last event."""
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    event = json.loads(data)
+    if usage is not None and event.get("usage"):
+        usage.update(event["usage"])
+    choices = event.get("choices") or []
+    return (choices[0].get("delta") or {}).get("content") if choices else None
+
+
+def stream_deepseek_with_fallback(messages, model="deepseek-chat", temperature=0.7, usage=None, tokens=None):
+    """Streaming twin of call_deepseek_with_fallback: yields content deltas as they arrive."""
+    url = f"{DEEPSEEK_API_BASE}/chat/completions"
+    payload = _stream_payload(messages, model, temperature)
+
+    def open_stream(api_key):
+        with get_http_client().stream(
+            "POST", url, json=payload, headers={"Authorization": f"Bearer {api_key}"},
+            timeout=http_timeout(stream=True)
+        ) as resp:
+            resp.raise_for_status()
+            deepseek_key_manager.observe_headers(api_key, resp.headers)
+            for line in resp.iter_lines():
+                content = _stream_delta(line, usage)
+                if content:
+                    yield content
+
+    return stream_with_deepseek_key(open_stream, tokens=tokens)
+
+
+def astream_deepseek_with_fallback(messages, model="deepseek-chat", temperature=0.7, usage=None, tokens=None):
+    """Async twin of stream_deepseek_with_fallback."""
+    url = f"{DEEPSEEK_API_BASE}/chat/completions"
+    payload = _stream_payload(messages, model, temperature)
+
+    async def open_stream(api_key):
+        async with get_async_http_client().stream(
+            "POST", url, json=payload, headers={"Authorization": f"Bearer {api_key}"},
+            timeout=http_timeout(stream=True)
+        ) as resp:
+            resp.raise_for_status()
+            deepseek_key_manager.observe_headers(api_key, resp.headers)
+            async for line in resp.aiter_lines():
+                content = _stream_delta(line, usage)
+                if content:
+                    yield content
+
+    return astream_with_deepseek_key(open_stream, tokens=tokens)
+
+
+def _chunk_usage(chunk, usage):
+    meta = getattr(chunk, 'usage_metadata', None)
+    if usage is not None and meta:
+        usage['prompt_tokens'] = meta.get('input_tokens')
+        usage['completion_tokens'] = meta.get('output_tokens')
+        cache_read = (meta.get('input_token_details') or {}).get('cache_read')
+        if cache_read is not None:
+            usage['prompt_cache_hit_tokens'] = cache_read
+
+
+def chunk_texts(chunks, usage=None):
+    """Text of streamed message chunks; `usage` receives the token usage of the last chunk."""
+    for chunk in chunks:
+        _chunk_usage(chunk, usage)
+        if chunk.content:
+            yield chunk.content
+
+
+async def achunk_texts(chunks, usage=None):
+    """Async twin of chunk_texts."""
+    async for chunk in chunks:
+        _chunk_usage(chunk, usage)
+        if chunk.content:
+            yield chunk.content
+
+
+def primed(chunks):
+    """
+    Pull the first chunk now, so key failover and errors before the first token happen
+    before a streaming response has sent anything (and can still become a JSON error).
+    """
+    chunks = iter(chunks)
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], chunks)
+
+
+async def aprimed(chunks):
+    """Async twin of primed."""
+    chunks = chunks.__aiter__()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def rest():
+        if first is None:
+            return
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
+    return rest()
+
+
+# --- Response cache -------------------------------------------------------------------
+# Opt-in per endpoint, e.g. RESPONSE_CACHE_ENDPOINTS=narrative,pure_chat
+RESPONSE_CACHE_ENDPOINTS = {e.strip() for e in os.getenv("RESPONSE_CACHE_ENDPOINTS", "").split(",") if e.strip()}
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")  # 'memory' or 'mongo'
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+REPLAY_CHUNK_CHARS = 4  # cached narratives are replayed in small chunks like a live stream
+
+
+def response_cache_key(model, temperature, messages):
+    """sha256 over (model, temperature, messages) with whitespace-normalized contents."""
+    normalized = [{"role": m["role"], "content": " ".join(m["content"].split())} for m in messages]
+    raw = json.dumps({"model": model, "temperature": temperature, "messages": normalized},
+                     ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class InMemoryResponseBackend:
+    """Per-process LRU with TTL, bounded by entry count and total text size."""
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._bytes -= self._entries.pop(key)[2]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[key] = (time.time() + ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+
+class MongoResponseBackend:
+    """Cache collection shared by all workers; expiry is enforced by a TTL index on expires_at."""
+    def __init__(self, mongo_uri, db_name='sessions', collection='response_cache'):
+        from pymongo import MongoClient
+        self.collection = MongoClient(mongo_uri)[db_name][collection]
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    def get(self, key):
+        from datetime import datetime, timezone
+        doc = self.collection.find_one({'_id': key, 'expires_at': {'$gt': datetime.now(timezone.utc)}},
+                                       {'value': 1})
+        return doc['value'] if doc else None
+
+    def set(self, key, value, ttl):
+        from datetime import datetime, timedelta, timezone
+        self.collection.update_one(
+            {'_id': key},
+            {'$set': {'value': value, 'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+
+
+class ResponseCache:
+    """Exact-match completion cache; only endpoints listed in `endpoints` use it."""
+    def __init__(self, endpoints=RESPONSE_CACHE_ENDPOINTS, backend=RESPONSE_CACHE_BACKEND, ttl=RESPONSE_CACHE_TTL):
+        self.endpoints = set(endpoints)
+        self.backend_name = backend
+        self.ttl = ttl
+        self._backend = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    if self.backend_name == 'mongo':
+                        self._backend = MongoResponseBackend(os.getenv("MONGODB_URI"))
+                    else:
+                        self._backend = InMemoryResponseBackend()
+        return self._backend
+
+    def enabled(self, endpoint):
+        return endpoint in self.endpoints
+
+    def get(self, endpoint, messages, model="deepseek-chat", temperature=0.7):
+        if not self.enabled(endpoint):
+            return None
+        value = self.backend.get(response_cache_key(model, temperature, messages))
+        if value is None:
+            self.misses += 1
+            cache_event('response', 'miss')
+        else:
+            self.hits += 1
+            cache_event('response', 'hit')
+        return value
+
+    def set(self, endpoint, messages, value, model="deepseek-chat", temperature=0.7):
+        if self.enabled(endpoint) and value:
+            self.backend.set(response_cache_key(model, temperature, messages), value, self.ttl)
+
+
+response_cache = ResponseCache()
+
+
+def cached_completion(endpoint, messages, compute):
+    """
+    Return compute() (a completion string) through the response cache when `endpoint`
+    is enabled. `messages` is a zero-arg callable so prompts are only rendered when needed.
+    """
+    if not response_cache.enabled(endpoint):
+        return compute()
+    key_messages = messages()
+    cached = response_cache.get(endpoint, key_messages)
+    if cached is not None:
+        return cached
+    value = compute()
+    response_cache.set(endpoint, key_messages, value)
+    return value
+
+
+async def acached_completion(endpoint, messages, compute):
+    """Async twin of cached_completion; `compute` returns an awaitable."""
+    if not response_cache.enabled(endpoint):
+        return await compute()
+    key_messages = messages()
+    cached = await asyncio.to_thread(response_cache.get, endpoint, key_messages)
+    if cached is not None:
+        return cached
+    value = await compute()
+    await asyncio.to_thread(response_cache.set, endpoint, key_messages, value)
+    return value
+
+
+def cached_stream(endpoint, messages, stream):
+    """
+    Streaming twin of cached_completion: a hit is replayed in chunks, a miss streams
+    stream() and is cached once it completes.
+    """
+    if not response_cache.enabled(endpoint):
+        return stream()
+    key_messages = messages()
+    cached = response_cache.get(endpoint, key_messages)
+    if cached is not None:
+        return iter(replay_chunks(cached))
+    return _cache_when_done(endpoint, key_messages, stream())
+
+
+def _cache_when_done(endpoint, key_messages, chunks):
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    response_cache.set(endpoint, key_messages, "".join(parts))
+
+
+async def acached_stream(endpoint, messages, stream):
+    """Async twin of cached_stream; stream() returns an async iterator."""
+    if not response_cache.enabled(endpoint):
+        return stream()
+    key_messages = messages()
+    cached = await asyncio.to_thread(response_cache.get, endpoint, key_messages)
+    if cached is not None:
+        async def replay():
+            for chunk in replay_chunks(cached):
+                yield chunk
+        return replay()
+    return _acache_when_done(endpoint, key_messages, stream())
+
+
+async def _acache_when_done(endpoint, key_messages, chunks):
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    await asyncio.to_thread(response_cache.set, endpoint, key_messages, "".join(parts))
+
+
+def narrative_cache_messages(user_input):
+    return [{"role": "system", "content": STORYWRITER_PROMPT}, {"role": "user", "content": user_input}]
+
+
+def replay_chunks(text, size=REPLAY_CHUNK_CHARS):
+    """Split a cached completion into stream-sized chunks."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
@@ -0,0 +1,216 @@
+"""
+Prometheus instrumentation shared by the Flask and ASGI apps.
+
+Request handlers are timed per endpoint and the hot-path stages (Mongo reads/writes,
+(de)serializing session memory, chain construction, DeepSeek time-to-first-token and
+total time) are recorded as spans. Spans land in a per-stage histogram and, while a
+request is active, in its Server-Timing header.
+
+Under gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a shared directory
+before the workers import this module, so each worker writes its samples to mmap'd
+files and /metrics aggregates all of them. Without it the registry is per-process.
+
+METRICS_ENABLED=0 turns all recording off. Other modules record through inc(),
+set_gauge() and observe(), which check it, rather than calling the metrics directly.
+"""
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Handler time until the response starts (streams excluded)',
+    ['endpoint', 'status'], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram(
+    'stage_duration_seconds', 'Time spent in one hot-path stage of a request',
+    ['stage'], buckets=LATENCY_BUCKETS)
+STREAM_TTFT_SECONDS = Histogram(
+    'sse_ttft_seconds', 'Time from stream start to the first generated chunk',
+    ['endpoint'], buckets=LATENCY_BUCKETS)
+STREAM_TOKENS_PER_SECOND = Histogram(
+    'sse_tokens_per_second', 'Streaming generation rate after the first chunk (one chunk ~ one token)',
+    ['endpoint'], buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500))
+
+KEY_RELEASES = Counter('deepseek_key_releases_total', 'Key leases returned to the pool, by outcome', ['outcome'])
+KEY_RETRIES = Counter('deepseek_key_retries_total', 'Failed DeepSeek attempts reported back to the pool')
+KEY_FAILOVERS = Counter('deepseek_key_failovers_total', 'Leases that rotated away from a key that just failed')
+KEY_COOLDOWNS = Counter('deepseek_key_cooldowns_total', 'Keys put into cool-down')
+KEY_LEASE_TIMEOUTS = Counter('deepseek_key_lease_timeouts_total', 'Requests that found no key before the lease timeout')
+KEY_REMOVALS = Counter('deepseek_key_removals_total', 'Revoked keys taken out of rotation')
+KEYS_IN_FLIGHT = Gauge('deepseek_keys_in_flight', 'DeepSeek requests holding a key lease',
+                       multiprocess_mode='livesum')
+DEEPSEEK_TIMEOUTS = Counter('deepseek_timeouts_total',
+                            'DeepSeek calls cut off by the request deadline, a stalled stream or a '
+                            'call timeout', ['kind'])
+DEEPSEEK_HEDGES = Counter('deepseek_hedges_total',
+                          'Hedged non-streaming DeepSeek calls by outcome (sent/won/skipped)', ['outcome'])
+
+SESSION_DOCUMENT_BYTES = Histogram(
+    'session_document_bytes', 'BSON size of session data read from Mongo', buckets=SIZE_BUCKETS)
+CACHE_EVENTS = Counter('cache_events_total', 'Session and response cache lookups', ['cache', 'result'])
+SESSION_CACHE_BYTES = Gauge('session_cache_bytes', 'Bytes held by the session caches',
+                            multiprocess_mode='livesum')
+SESSION_CACHE_ENTRIES = Gauge('session_cache_entries', 'Entries held by the session caches',
+                              multiprocess_mode='livesum')
+SESSION_WRITE_QUEUE = Gauge('session_write_queue_depth', 'Sessions with write-behind writes not yet in Mongo',
+                            multiprocess_mode='livesum')
+SESSION_WRITE_FLUSH_SECONDS = Histogram(
+    'session_write_flush_seconds', 'Duration of one write-behind bulk_write', buckets=LATENCY_BUCKETS)
+SESSION_WRITE_LAG_SECONDS = Histogram(
+    'session_write_lag_seconds', 'Time from queueing a session write to it reaching Mongo', buckets=LATENCY_BUCKETS)
+SESSION_WRITES = Counter('session_writes_total',
+                         'Write-behind session writes by outcome (queued/coalesced/flushed/lost/failed)',
+                         ['outcome'])
+
+NARRATIVE_SPECULATIONS = Counter('narrative_speculations_total',
+                                 'Speculative narrative generations by result (started/hit/discarded/skipped)',
+                                 ['result'])
+NARRATIVE_WASTED_TOKENS = Counter('narrative_speculation_wasted_tokens_total',
+                                  'Tokens generated by speculative narratives that were never served')
+
+SESSION_TURNS = Counter('session_turns_total',
+                        'Session turns by outcome (executed/coalesced/replayed/busy)', ['outcome'])
+
+ADMISSION_DECISIONS = Counter('admission_decisions_total',
+                              'LLM-bound requests by priority and admission outcome '
+                              '(admitted/queued/rejected/timeout/shed)', ['priority', 'outcome'])
+ADMISSION_LIMIT = Gauge('admission_limit', 'Adaptive limit on in-flight LLM-bound requests',
+                        multiprocess_mode='livesum')
+ADMISSION_IN_FLIGHT = Gauge('admission_in_flight', 'LLM-bound requests holding an admission permit',
+                            multiprocess_mode='livesum')
+
+_spans = contextvars.ContextVar('spans', default=None)
+_stage_children = {}
+
+
+def _stage(stage):
+    child = _stage_children.get(stage)
+    if child is None:
+        child = _stage_children[stage] = STAGE_SECONDS.labels(stage)
+    return child
+
+
+def begin_request():
+    """Start collecting spans for the current request (thread or task context)."""
+    _spans.set([])
+    return time.perf_counter()
+
+
+def record_span(stage, seconds):
+    if not METRICS_ENABLED:
+        return
+    _stage(stage).observe(seconds)
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+
+def end_request(endpoint, status, started):
+    """Observe the request and return its Server-Timing header value."""
+    elapsed = time.perf_counter() - started
+    spans = _spans.get() or []
+    _spans.set(None)
+    if METRICS_ENABLED:
+        REQUEST_SECONDS.labels(endpoint or 'unknown', str(status)).observe(elapsed)
+    timings = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans]
+    timings.append(f"total;dur={elapsed * 1000:.1f}")
+    return ", ".join(timings)
+
+
+class _StreamTimer:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.first = None
+        self.chunks = 0
+
+    def chunk(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+            if METRICS_ENABLED:
+                STREAM_TTFT_SECONDS.labels(self.endpoint).observe(self.first - self.started)
+        self.chunks += 1
+
+    def finish(self):
+        if not METRICS_ENABLED or self.first is None or self.chunks < 2:
+            return
+        elapsed = time.perf_counter() - self.first
+        if elapsed > 0:
+            STREAM_TOKENS_PER_SECOND.labels(self.endpoint).observe((self.chunks - 1) / elapsed)
+
+
+def timed_stream(chunks, endpoint):
+    """Pass `chunks` through, recording TTFT and tokens/sec for `endpoint`."""
+    timer = _StreamTimer(endpoint)
+    try:
+        for chunk in chunks:
+            timer.chunk()
+            yield chunk
+    finally:
+        timer.finish()
+
+
+async def atimed_stream(chunks, endpoint):
+    """Async twin of timed_stream."""
+    timer = _StreamTimer(endpoint)
+    try:
+        async for chunk in chunks:
+            timer.chunk()
+            yield chunk
+    finally:
+        timer.finish()
+
+
+def inc(metric, *labels, amount=1):
+    """metric(.labels(*labels)).inc(amount), unless METRICS_ENABLED=0 (gauges: a negative amount decrements)."""
+    if METRICS_ENABLED:
+        (metric.labels(*labels) if labels else metric).inc(amount)
+
+
+def set_gauge(gauge, value, *labels):
+    if METRICS_ENABLED:
+        (gauge.labels(*labels) if labels else gauge).set(value)
+
+
+def observe(metric, value, *labels):
+    if METRICS_ENABLED:
+        (metric.labels(*labels) if labels else metric).observe(value)
+
+
+def cache_event(cache, result):
+    inc(CACHE_EVENTS, cache, result)
+
+
+def render():
+    """(body, content type) of the Prometheus exposition for all workers."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
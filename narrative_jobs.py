@@ -0,0 +1,410 @@
+"""
+Narrative generation as jobs keyed by session_id, decoupled from the SSE connection.
+
+A job keeps generating after its subscribers disconnect, buffers the chunks in memory
+and checkpoints the partial story to Mongo (`data.narrative_draft`). Subscribers read
+from any character offset, so the SSE endpoint resumes from `Last-Event-ID`, several
+tabs share one in-flight generation, and a duplicate start for the same seed joins the
+running job instead of paying for a second one. A request that lands on a worker
+without the job follows the owner's checkpoints (or replays the finished draft).
+
+/api/chat starts a speculative job once intake concludes, so the narrative is (partly)
+written before the client asks for it. Speculative jobs are capped per worker and are
+discarded when the conversation continues and the seed changes.
+"""
+import os
+import time
+import socket
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from conversation_budget import count_tokens
+from deadlines import NARRATIVE_JOB_DEADLINE, deadline
+from metrics import NARRATIVE_SPECULATIONS, NARRATIVE_WASTED_TOKENS, inc
+
+logger = logging.getLogger(__name__)
+
+NARRATIVE_MAX_CONCURRENT_JOBS = int(os.getenv("NARRATIVE_MAX_CONCURRENT_JOBS", "16"))
+NARRATIVE_SPECULATION = os.getenv("NARRATIVE_SPECULATION", "1") == "1"
+NARRATIVE_MAX_SPECULATIVE_JOBS = int(os.getenv("NARRATIVE_MAX_SPECULATIVE_JOBS", "4"))
+NARRATIVE_CHECKPOINT_INTERVAL = float(os.getenv("NARRATIVE_CHECKPOINT_INTERVAL", "2"))
+# finished jobs stay in memory this long so reconnecting clients resume without Mongo
+NARRATIVE_JOB_RETENTION = float(os.getenv("NARRATIVE_JOB_RETENTION", "600"))
+# a running draft not checkpointed for this long is treated as abandoned by its worker
+NARRATIVE_DRAFT_STALE_AFTER = max(30.0, 5 * NARRATIVE_CHECKPOINT_INTERVAL)
+
+
+def worker_id():
+    """host:pid of this worker (read at call time: the pid changes when gunicorn forks)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def seed_hash(seed):
+    return hashlib.sha256(seed.encode("utf-8")).hexdigest()[:16]
+
+
+def resume_offset(last_event_id):
+    """Character offset to resume from, taken from a Last-Event-ID value (0 if absent/invalid)."""
+    try:
+        return max(0, int(last_event_id or 0))
+    except ValueError:
+        return 0
+
+
+class NarrativeJob:
+    """Append-only chunk buffer with blocking (thread) and awaitable (asyncio) readers."""
+    def __init__(self, session_id, seed):
+        self.session_id = session_id
+        self.seed = seed
+        self.seed_hash = seed_hash(seed)
+        self.chunks = []  # (end_offset, text)
+        self.length = 0
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self.speculative = False
+        self.consumed = False  # a speculative job some client has asked for
+        self.discarded = False
+        self.story = None  # final text, set once generation completed successfully
+        self.finished_at = None
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (loop, future)
+
+    def text(self):
+        with self._cond:
+            return "".join(text for _, text in self.chunks)
+
+    def append(self, text):
+        with self._cond:
+            self.length += len(text)
+            self.chunks.append((self.length, text))
+            self._notify()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self.finished_at = time.time()
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def _after(self, offset):
+        """Chunks past `offset`; a chunk straddling the offset is cut at it."""
+        pending = []
+        start = 0
+        for end, text in self.chunks:
+            if end > offset:
+                pending.append((end, text[max(0, offset - start):]))
+            start = end
+        return pending
+
+    def wait_after(self, offset, timeout):
+        """Block up to `timeout` for data past `offset`. Returns (chunks, done, error)."""
+        with self._cond:
+            if self.length <= offset and not self.done:
+                self._cond.wait(timeout)
+            return self._after(offset), self.done, self.error
+
+    async def await_after(self, offset, timeout):
+        """Awaitable twin of wait_after for the ASGI app."""
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.length > offset or self.done:
+                return self._after(offset), self.done, self.error
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            return self._after(offset), self.done, self.error
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class NarrativeJobManager:
+    def __init__(self, store, max_jobs=NARRATIVE_MAX_CONCURRENT_JOBS,
+                 max_speculative=NARRATIVE_MAX_SPECULATIVE_JOBS):
+        self.store = store
+        self.max_speculative = max_speculative
+        self._jobs = {}  # session_id -> NarrativeJob
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="narrative")
+        self._speculating = 0
+        self.started = 0
+        self.joined = 0
+
+    def get(self, session_id):
+        with self._lock:
+            return self._jobs.get(session_id)
+
+    def _claim(self, session_id, seed, speculative=False):
+        """(job, created): the live or recently finished job for this seed, else a new one."""
+        with self._lock:
+            expired = self._expire()
+            job = self._jobs.get(session_id)
+            if job and job.seed == seed and not (job.done and job.error):
+                self.joined += 1
+                return job, False
+            if speculative and self._speculating >= self.max_speculative:
+                inc(NARRATIVE_SPECULATIONS, 'skipped')
+                return None, False
+            if job:
+                # the conversation moved on; stop spending tokens on the stale seed
+                expired.append(job)
+            job = NarrativeJob(session_id, seed)
+            job.speculative = speculative
+            if speculative:
+                self._speculating += 1
+                inc(NARRATIVE_SPECULATIONS, 'started')
+            self._jobs[session_id] = job
+            self.started += 1
+        for old in expired:
+            self._discard(old)
+        return job, True
+
+    def _discard(self, job):
+        """Stop a superseded job; an unserved speculative job counts as wasted tokens."""
+        if not job.done:
+            job.cancelled = True
+        if job.speculative and not job.consumed and not job.discarded:
+            job.discarded = True
+            inc(NARRATIVE_SPECULATIONS, 'discarded')
+            inc(NARRATIVE_WASTED_TOKENS, amount=count_tokens(job.text()))
+
+    def _consume(self, job):
+        """First request for a speculative job: count the hit and store its story if it is done."""
+        with self._lock:
+            if not job.speculative or job.consumed:
+                return
+            job.consumed = True
+            story = job.story
+        inc(NARRATIVE_SPECULATIONS, 'hit')
+        if story:
+            self.store.update_fields(job.session_id, {'story': story})
+
+    def speculate(self, session_id, seed, generate, on_complete=None):
+        """Start generating the narrative for `seed` before it is requested (bounded, best effort)."""
+        if not NARRATIVE_SPECULATION:
+            return None
+        job, started = self._claim(session_id, seed, speculative=True)
+        if started:
+            self._executor.submit(self._run, job, generate, on_complete)
+        return job
+
+    async def aspeculate(self, session_id, seed, agenerate, on_complete=None):
+        """Async variant of speculate(); the bookkeeping, which may reach Mongo, runs in a thread."""
+        if not NARRATIVE_SPECULATION:
+            return None
+        job, started = await asyncio.to_thread(self._claim, session_id, seed, True)
+        if started:
+            asyncio.get_running_loop().create_task(self._arun(job, agenerate, on_complete))
+        return job
+
+    def discard_stale(self, session_id, seed):
+        """Drop an unserved speculative job once the conversation has moved past its seed."""
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if not job or job.seed == seed or not job.speculative or job.consumed:
+                return
+            del self._jobs[session_id]
+        self._discard(job)
+
+    def open(self, session_id, seed, session_data, generate, on_complete=None):
+        """
+        (job, started) for this session and seed: the local job, a job following another
+        worker's draft, or a newly started generation (started=True).
+        """
+        job, started = self._open(session_id, seed, session_data)
+        if started:
+            self._executor.submit(self._run, job, generate, on_complete)
+        return job, started
+
+    async def aopen(self, session_id, seed, session_data, agenerate, on_complete=None):
+        """
+        Async variant of open(): the lookup, which may write to Mongo, runs in a thread and
+        a new generation runs as a task on the running loop.
+        """
+        job, started = await asyncio.to_thread(self._open, session_id, seed, session_data)
+        if started:
+            asyncio.get_running_loop().create_task(self._arun(job, agenerate, on_complete))
+        return job, started
+
+    def _open(self, session_id, seed, session_data):
+        """open() up to starting the generation, which is left to the caller."""
+        job = self.get(session_id)
+        if not (job and job.seed == seed and not (job.done and job.error)):
+            job = self.restore(session_id, seed, session_data)
+        if job is not None:
+            with self._lock:
+                self.joined += 1
+            self._consume(job)
+            return job, False
+        job, started = self._claim(session_id, seed)
+        if not started:
+            self._consume(job)
+        return job, started
+
+    def _expire(self):
+        """Drop finished jobs past retention (lock held); returns them for _discard()."""
+        cutoff = time.time() - NARRATIVE_JOB_RETENTION
+        expired = [s for s, j in self._jobs.items() if j.done and j.finished_at < cutoff]
+        return [self._jobs.pop(session_id) for session_id in expired]
+
+    def _finished(self, job):
+        if job.speculative:
+            with self._lock:
+                self._speculating -= 1
+
+    def _run(self, job, generate, on_complete):
+        try:
+            # the job outlives the request that started it, so it has a deadline of its own
+            with deadline(NARRATIVE_JOB_DEADLINE):
+                self._generate(job, generate, on_complete)
+        finally:
+            self._finished(job)
+
+    def _generate(self, job, generate, on_complete):
+        self._checkpoint(job)  # announce the job so other workers follow instead of regenerating
+        last_checkpoint = time.monotonic()
+        try:
+            for chunk in generate():
+                if job.cancelled:
+                    break
+                if chunk:
+                    job.append(chunk)
+                if time.monotonic() - last_checkpoint >= NARRATIVE_CHECKPOINT_INTERVAL:
+                    self._checkpoint(job)
+                    last_checkpoint = time.monotonic()
+        except Exception as e:
+            logger.exception("narrative job failed for session %s", job.session_id)
+            job.finish(error=str(e))
+            return
+        # persist before finishing so a client that saw `done` can rely on the stored story
+        job.finish(error=self._complete(job, on_complete))
+
+    async def _arun(self, job, agenerate, on_complete):
+        try:
+            with deadline(NARRATIVE_JOB_DEADLINE):
+                await self._agenerate(job, agenerate, on_complete)
+        finally:
+            self._finished(job)
+
+    async def _agenerate(self, job, agenerate, on_complete):
+        await asyncio.to_thread(self._checkpoint, job)
+        last_checkpoint = time.monotonic()
+        try:
+            async for chunk in agenerate():
+                if job.cancelled:
+                    break
+                if chunk:
+                    job.append(chunk)
+                if time.monotonic() - last_checkpoint >= NARRATIVE_CHECKPOINT_INTERVAL:
+                    await asyncio.to_thread(self._checkpoint, job)
+                    last_checkpoint = time.monotonic()
+        except Exception as e:
+            logger.exception("narrative job failed for session %s", job.session_id)
+            job.finish(error=str(e))
+            return
+        job.finish(error=await asyncio.to_thread(self._complete, job, on_complete))
+
+    def _checkpoint(self, job, done=False):
+        try:
+            self.store.update_fields(job.session_id, {'narrative_draft': {
+                'seed_hash': job.seed_hash,
+                'text': job.text(),
+                'done': done,
+                'owner': worker_id(),
+                'updated': time.time(),
+            }})
+        except Exception:
+            logger.exception("narrative checkpoint failed for session %s", job.session_id)
+
+    def _complete(self, job, on_complete):
+        """Persist the finished story; returns the error to finish the job with, if any."""
+        if job.cancelled:
+            return "superseded by a newer narrative request"
+        full_story = job.text().strip()
+        if not full_story:
+            return None
+        with self._lock:
+            job.story = full_story
+            # an unserved speculative story is only stored once a client asks for it (_consume)
+            serve = job.consumed or not job.speculative
+        try:
+            if serve:
+                self.store.update_fields(job.session_id, {'story': full_story})
+        except Exception as e:
+            logger.exception("saving narrative failed for session %s", job.session_id)
+            return str(e)
+        self._checkpoint(job, done=True)
+        if on_complete:
+            try:
+                on_complete(full_story)
+            except Exception:
+                logger.exception("narrative completion hook failed for session %s", job.session_id)
+        return None
+
+    def restore(self, session_id, seed, session_data):
+        """
+        Job rebuilt from the Mongo draft when this worker has none in memory: a finished
+        draft is replayed, a draft still being written by another worker is followed.
+        """
+        draft = session_data.get('narrative_draft') or {}
+        if draft.get('seed_hash') != seed_hash(seed):
+            return None
+        fresh = time.time() - draft.get('updated', 0) < NARRATIVE_DRAFT_STALE_AFTER
+        if not draft.get('done') and (draft.get('owner') == worker_id() or not fresh):
+            return None
+        job = NarrativeJob(session_id, seed)
+        if draft.get('text'):
+            job.append(draft['text'])
+        if draft.get('done'):
+            # a speculative draft finished on another worker has not been stored as the story yet
+            if draft.get('text') and session_data.get('story') != draft['text'].strip():
+                self.store.update_fields(session_id, {'story': draft['text'].strip()})
+            job.finish()
+        else:
+            self._executor.submit(self._follow, job)
+        with self._lock:
+            self._jobs[session_id] = job
+        return job
+
+    def _follow(self, job):
+        """Mirror another worker's checkpoints into a local job until it finishes."""
+        while True:
+            time.sleep(NARRATIVE_CHECKPOINT_INTERVAL)
+            try:
+                draft = self.store.get_fields(job.session_id, ['narrative_draft']).get('narrative_draft') or {}
+            except Exception as e:
+                job.finish(error=str(e))
+                return
+            if draft.get('seed_hash') != job.seed_hash:
+                job.finish(error="superseded by a newer narrative request")
+                return
+            text = draft.get('text', '')
+            if len(text) > job.length:
+                job.append(text[job.length:])
+            if draft.get('done'):
+                try:
+                    if text.strip():
+                        self.store.update_fields(job.session_id, {'story': text.strip()})
+                except Exception as e:
+                    job.finish(error=str(e))
+                    return
+                job.finish()
+                return
+            if time.time() - draft.get('updated', 0) > NARRATIVE_DRAFT_STALE_AFTER:
+                job.finish(error="narrative generation was interrupted")
+                return
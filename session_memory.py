@@ -1,38 +1,833 @@
+import os
+import copy
 import time
+import atexit
 import pickle
-from pymongo import MongoClient, ASCENDING
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
 
-class MongoDBSessionMemoryStore:
-    def __init__(self, mongo_uri, db_name='sessions', collection='memory'):
+import bson
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from metrics import (
+    SESSION_CACHE_BYTES,
+    SESSION_CACHE_ENTRIES,
+    SESSION_DOCUMENT_BYTES,
+    SESSION_WRITES,
+    SESSION_WRITE_FLUSH_SECONDS,
+    SESSION_WRITE_LAG_SECONDS,
+    SESSION_WRITE_QUEUE,
+    cache_event,
+    inc,
+    observe,
+    set_gauge,
+    span,
+)
+
+logger = logging.getLogger(__name__)
+
+# 'log'    -> turns are stored as compact JSON message records and appended with $push/$slice
+# 'pickle' -> legacy mode, the whole ConversationBufferWindowMemory is pickled and rewritten each turn
+SESSION_STORAGE_MODE = os.getenv("SESSION_STORAGE_MODE", "log")
+MEMORY_WINDOW = 30  # k of ConversationBufferWindowMemory used by /api/chat
+# Per-worker session cache bounds; SESSION_CACHE_MAX_ENTRIES=0 disables the cache
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "512"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Check the TTL indexes in the background once a worker connects; 0 leaves it to the
+# one-off migration (python session_memory.py)
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "1") == "1"
+# Write-behind (see WriteBehind): turn writes are queued and applied in the background,
+# so the response does not wait for Mongo. The durability bound: a queued write reaches
+# Mongo within SESSION_WRITE_MAX_DELAY seconds, and no more than SESSION_WRITE_MAX_PENDING
+# sessions per worker are ever waiting (past that the writer flushes inline).
+SESSION_WRITE_BEHIND = os.getenv("SESSION_WRITE_BEHIND", "0") == "1"
+SESSION_WRITE_MAX_DELAY = float(os.getenv("SESSION_WRITE_MAX_DELAY", "0.5"))
+SESSION_WRITE_MAX_PENDING = int(os.getenv("SESSION_WRITE_MAX_PENDING", "256"))
+SESSION_WRITE_BATCH = 500  # updates per bulk_write
+
+# A session is split over three collections, each expiring on its own last_access:
+#   profiles  {_id, description, created}         -> kept across visits (PROFILE_TTL)
+#   memory    {_id, data: {...conversation}, ...}  -> transient chat state (SESSION_TTL)
+#   artifacts {_id, story, narrative_draft}        -> generated narrative (ARTIFACT_TTL)
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", str(24 * 3600)))
+PROFILE_TTL = int(os.getenv("PROFILE_TTL", str(180 * 24 * 3600)))
+PROFILE_FIELDS = ('description',)
+ARTIFACT_FIELDS = ('story', 'narrative_draft')
+
+# Fields each endpoint reads with get(); 'memory' stands for the stored message log
+CHAT_FIELDS = ('memory', 'turn_count', 'summary', 'summarized_turns')
+REFLECT_FIELDS = CHAT_FIELDS + ('story',)
+NARRATIVE_FIELDS = ('memory', 'story', 'narrative_draft')
+PURE_CHAT_FIELDS = ('messages',)
+
+
+class LeaseLost(Exception):
+    """A fenced write found that another request has taken the session lease since."""
+
+
+def new_memory(k=MEMORY_WINDOW):
+    """Empty window memory. langchain.memory is slow to import, so it is loaded on first use."""
+    from langchain.memory import ConversationBufferWindowMemory
+    return ConversationBufferWindowMemory(k=k, return_messages=True)
+
+
+def memory_from_records(records, k=MEMORY_WINDOW):
+    """Rebuild a window memory from message records, only as far back as the k-turn window."""
+    from langchain_core.messages import AIMessage, HumanMessage
+    memory = new_memory(k)
+    for record in records[-2 * k:]:
+        message_cls = HumanMessage if record['type'] == 'human' else AIMessage
+        memory.chat_memory.add_message(message_cls(content=record['content']))
+    return memory
+
+
+def records_from_memory(memory, k=MEMORY_WINDOW):
+    return [{'type': m.type, 'content': m.content} for m in memory.chat_memory.messages[-2 * k:]]
+
+
+def _covers(cached_fields, fields):
+    """Whether an entry holding `cached_fields` (None = whole document) can answer `fields`."""
+    return cached_fields is None or (fields is not None and set(fields) <= cached_fields)
+
+
+class SessionCache:
+    """
+    In-process LRU of stored session `data` subdocuments, keyed by session_id.
+    Each entry carries the document's `version`; a cached copy is only served after a
+    projected read confirms the version in Mongo is unchanged. An entry filled by a
+    projected read remembers its fields and only answers reads within them.
+    """
+    def __init__(self, max_entries=SESSION_CACHE_MAX_ENTRIES, max_bytes=SESSION_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # session_id -> (version, data, size, fields)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, session_id, version, fields=None):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or not _covers(entry[3], fields):
+                self.misses += 1
+                cache_event('session', 'miss')
+                return None
+            if entry[0] != version:
+                self.stale += 1
+                self.misses += 1
+                cache_event('session', 'stale')
+                self._remove(session_id)
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            cache_event('session', 'hit')
+            data = entry[1] if fields is None else {k: v for k, v in entry[1].items() if k in fields}
+            return copy.deepcopy(data)
+
+    def cached_version(self, session_id, fields=None):
+        """Version of a cached copy holding `fields`, or None (counted as a miss)."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or not _covers(entry[3], fields):
+                self.misses += 1
+                cache_event('session', 'miss')
+                return None
+            return entry[0]
+
+    def put(self, session_id, version, data, size=None, fields=None):
+        data = copy.deepcopy(data)
+        with self._lock:
+            self._store(session_id, version, data, size, fields)
+
+    def update(self, session_id, version, mutate, touched):
+        """
+        Apply a write to the cached copy if it is exactly one version behind and holds
+        every field the write `touched`, else drop it.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            if entry[0] != version - 1 or not _covers(entry[3], touched):
+                self._remove(session_id)
+                return
+            mutate(entry[1])
+            self._store(session_id, version, entry[1], fields=entry[3])
+
+    def advance(self, session_id, mutate, touched):
+        """update() for a write applied without reading the new version back (write-behind)."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            version = entry[0]
+        self.update(session_id, version + 1, mutate, touched)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+            self._publish()
+
+    def _store(self, session_id, version, data, size=None, fields=None):
+        if size is None:
+            size = len(bson.encode(data))
+        self._remove(session_id)
+        if size > self.max_bytes:
+            return
+        self._entries[session_id] = (version, data, size, None if fields is None else frozenset(fields))
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+            cache_event('session', 'eviction')
+        self._publish()
+
+    def _publish(self):
+        set_gauge(SESSION_CACHE_BYTES, self._bytes)
+        set_gauge(SESSION_CACHE_ENTRIES, len(self._entries))
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry:
+            self._bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+            }
+
+
+def _now():
+    """Timestamp for last_access: a BSON Date, as TTL indexes only expire Date values."""
+    return datetime.now(timezone.utc)
+
+
+def _ttl_index(collection, seconds):
+    """TTL index on last_access; an existing one with another expiry is changed in place."""
+    try:
+        collection.create_index([('last_access', ASCENDING)], expireAfterSeconds=seconds)
+    except OperationFailure:
+        collection.database.command('collMod', collection.name, index={
+            'keyPattern': {'last_access': 1}, 'expireAfterSeconds': seconds})
+
+
+def _overlaps(path, other):
+    return path == other or path.startswith(other + '.') or other.startswith(path + '.')
+
+
+def _merge_updates(first, second):
+    """
+    One update with the effect of `first` followed by `second`, or None when a single
+    update cannot express both (the same field under two operators, $push with another $slice).
+    """
+    merged = {op: dict(fields) for op, fields in first.items()}
+    for op, fields in second.items():
+        target = merged.setdefault(op, {})
+        for path, value in fields.items():
+            if any(_overlaps(path, other) and (other_op, other) != (op, path)
+                   for other_op, others in merged.items() for other in others):
+                return None
+            if path not in target or op in ('$set', '$unset'):
+                target[path] = value
+            elif op == '$inc':
+                target[path] += value
+            elif (op == '$push' and '$each' in value and '$each' in target[path]
+                  and value.get('$slice') == target[path].get('$slice')):
+                target[path] = dict(target[path], **{'$each': target[path]['$each'] + value['$each']})
+            else:
+                return None
+    return merged
+
+
+class _PendingWrite:
+    """The queued writes of one session, folded into a single update."""
+    def __init__(self, update, fence, mutation):
+        self.update = update
+        self.fence = fence
+        self.mutations = [] if mutation is None else [mutation]  # (mutate, touched) per data write
+        self.writes = 1
+        self.queued_at = time.monotonic()
+
+    def fold(self, update, fence, mutation):
+        if fence != self.fence:
+            return False
+        merged = _merge_updates(self.update, update)
+        if merged is None:
+            return False
+        self.update = merged
+        if mutation is not None:
+            self.mutations.append(mutation)
+        self.writes += 1
+        return True
+
+
+_write_behinds = []
+
+
+class WriteBehind:
+    """
+    Per-worker queue of session document writes, applied by a background flusher in
+    bulk_write batches. Writes to one session that queue up before a flush are folded
+    into one update, and a turn's lease release rides along with its writes, so no other
+    worker can take the session before its data is in Mongo. Any direct read or write of
+    a session first applies what is queued for it (read-your-writes on this worker);
+    other workers may read the previous state for up to SESSION_WRITE_MAX_DELAY.
+
+    A fenced write cannot raise LeaseLost to its request any more: if the lease was taken
+    over before the flush, the write is dropped, logged and counted as 'lost'.
+    """
+    def __init__(self, store, max_delay=SESSION_WRITE_MAX_DELAY, max_pending=SESSION_WRITE_MAX_PENDING):
+        self.store = store
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # session_id -> _PendingWrite, oldest first
+        self._flushing = set()  # sessions in the bulk_write running right now
+        self._cond = threading.Condition()
+        # one bulk_write at a time, so a session's writes reach Mongo in order
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        _write_behinds.append(self)
+
+    def enqueue(self, session_id, update, fence=None, mutation=None, merge_only=False):
+        """
+        Queue `update` of the session document (a copy of it: the caller may keep changing
+        its objects). `mutation` is (mutate, touched) for the cached copy, None for updates
+        outside `data`. With merge_only the update only joins writes already queued for the
+        session; returns False if there are none.
+        """
+        self._start()
+        update = copy.deepcopy(update)
+        while True:
+            with self._cond:
+                pending = self._pending.get(session_id)
+                if pending is None:
+                    if merge_only:
+                        return False
+                    self._pending[session_id] = _PendingWrite(update, fence, mutation)
+                    inc(SESSION_WRITES, 'queued')
+                    set_gauge(SESSION_WRITE_QUEUE, len(self._pending))
+                    overflow = len(self._pending) > self.max_pending
+                    self._cond.notify()
+                    break
+                if pending.fold(update, fence, mutation):
+                    inc(SESSION_WRITES, 'queued')
+                    inc(SESSION_WRITES, 'coalesced')
+                    return True
+                if merge_only:
+                    return False
+            # cannot be folded into what is queued: apply that first
+            self.settle(session_id)
+        if overflow:
+            self.flush()
+        return True
+
+    def settle(self, session_id):
+        """Apply the session's queued writes now, before it is read or written directly."""
+        with self._cond:
+            if session_id not in self._pending and session_id not in self._flushing:
+                return
+        self.flush([session_id])
+
+    def flush(self, session_ids=None):
+        """Apply the queued writes (of `session_ids`, or all of them) and wait until they are in Mongo."""
+        with self._flush_lock:
+            with self._cond:
+                ids = list(self._pending) if session_ids is None else [s for s in session_ids if s in self._pending]
+                batch = [(session_id, self._pending.pop(session_id)) for session_id in ids]
+                self._flushing.update(ids)
+                set_gauge(SESSION_WRITE_QUEUE, len(self._pending))
+            try:
+                for i in range(0, len(batch), SESSION_WRITE_BATCH):
+                    self._apply(batch[i:i + SESSION_WRITE_BATCH])
+            finally:
+                with self._cond:
+                    self._flushing.difference_update(ids)
+
+    def _apply(self, batch):
+        requests = []
+        for session_id, pending in batch:
+            query = {'_id': session_id}
+            if pending.fence is not None:
+                query['lease_token'] = pending.fence
+            requests.append(UpdateOne(query, pending.update, upsert=pending.fence is None))
+        failed = set()
+        started = time.perf_counter()
+        try:
+            result = self.store.collection.bulk_write(requests, ordered=False)
+            applied = result.matched_count + len(result.upserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            failed = {error['index'] for error in errors}
+            applied = e.details.get('nMatched', 0) + e.details.get('nUpserted', 0)
+            logger.error("%d queued session writes failed, first: %s", len(failed), errors[:1])
+        except PyMongoError:
+            logger.exception("applying %d queued session writes failed", len(batch))
+            failed = set(range(len(batch)))
+            applied = 0
+        finally:
+            observe(SESSION_WRITE_FLUSH_SECONDS, time.perf_counter() - started)
+        # bulk_write only reports totals: fenced updates that matched nothing lost their lease
+        lost = len(batch) - len(failed) - applied
+        if lost > 0:
+            logger.warning("%d queued session writes were dropped: the session lease was taken over", lost)
+            inc(SESSION_WRITES, 'lost', amount=lost)
+        now = time.monotonic()
+        for index, (session_id, pending) in enumerate(batch):
+            observe(SESSION_WRITE_LAG_SECONDS, now - pending.queued_at)
+            doubtful = index in failed or (lost > 0 and pending.fence is not None)
+            if index in failed:
+                inc(SESSION_WRITES, 'failed', amount=pending.writes)
+            elif not doubtful:
+                inc(SESSION_WRITES, 'flushed', amount=pending.writes)
+            if self.store.cache is None:
+                continue
+            for mutate, touched in pending.mutations:
+                if doubtful or mutate is None:
+                    self.store.cache.invalidate(session_id)
+                    break
+                self.store.cache.advance(session_id, mutate, touched)
+
+    def _start(self):
+        """Start this process's flusher on first use (a forked worker gets its own)."""
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="session-writer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    due = next(iter(self._pending.values())).queued_at + self.max_delay - time.monotonic()
+                    if due <= 0 or len(self._pending) >= self.max_pending:
+                        break
+                    self._cond.wait(due)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("session write-behind flush failed")
+
+
+def flush_all():
+    """Apply every queued session write of this process (worker shutdown, interpreter exit)."""
+    for write_behind in _write_behinds:
+        if write_behind._pid == os.getpid():
+            try:
+                write_behind.flush()
+            except Exception:
+                logger.exception("flushing queued session writes failed")
+
+
+atexit.register(flush_all)
+
+
+class _Connection:
+    """MongoClient and collections of one process."""
+    def __init__(self, mongo_uri, db_name, collection):
+        self.pid = os.getpid()
         self.client = MongoClient(mongo_uri)
         self.db = self.client[db_name]
         self.collection = self.db[collection]
-        # TTL index: deletes documents an hour after last_access
-        self.collection.create_index([('last_access', ASCENDING)], expireAfterSeconds=3600)
+        self.artifacts = self.db['artifacts']
+        self.profiles = self.db['profiles']
+
+
+class MongoDBSessionMemoryStore:
+    """
+    Constructing the store does no I/O. The MongoClient is created on first use in each
+    process, so a store built before gunicorn forks (--preload) never shares a client
+    (which is not fork-safe) with the workers.
+    """
+    def __init__(self, mongo_uri, db_name='sessions', collection='memory', mode=SESSION_STORAGE_MODE,
+                 memory_window=MEMORY_WINDOW, cache_max_entries=SESSION_CACHE_MAX_ENTRIES,
+                 ensure_indexes=MONGO_ENSURE_INDEXES, write_behind=SESSION_WRITE_BEHIND):
+        self.mongo_uri = mongo_uri
+        self.db_name = db_name
+        self.collection_name = collection
+        self.mode = mode
+        self.memory_window = memory_window
+        self.cache = SessionCache(max_entries=cache_max_entries) if cache_max_entries > 0 else None
+        self.write_behind = WriteBehind(self) if write_behind else None
+        self.ensure_indexes_on_connect = ensure_indexes
+        self._connection = None
+        self._connection_lock = threading.Lock()
+
+    def connection(self):
+        connection = self._connection
+        if connection is None or connection.pid != os.getpid():
+            with self._connection_lock:
+                connection = self._connection
+                if connection is None or connection.pid != os.getpid():
+                    connection = _Connection(self.mongo_uri, self.db_name, self.collection_name)
+                    self._connection = connection
+                    if self.ensure_indexes_on_connect:
+                        threading.Thread(target=self._ensure_indexes_in_background,
+                                         name="session-indexes", daemon=True).start()
+        return connection
+
+    @property
+    def client(self):
+        return self.connection().client
+
+    @property
+    def collection(self):
+        return self.connection().collection
 
-    def get(self, session_id):
-        doc = self.collection.find_one({'_id': session_id})
+    @property
+    def artifacts(self):
+        return self.connection().artifacts
+
+    @property
+    def profiles(self):
+        return self.connection().profiles
+
+    def ensure_indexes(self):
+        """TTL indexes: each collection expires its documents after its own idle time."""
+        _ttl_index(self.collection, SESSION_TTL)
+        _ttl_index(self.artifacts, ARTIFACT_TTL)
+        _ttl_index(self.profiles, PROFILE_TTL)
+
+    def _ensure_indexes_in_background(self):
+        try:
+            self.ensure_indexes()
+        except Exception:
+            logger.exception("creating session TTL indexes failed")
+
+    def ping(self):
+        self.client.admin.command('ping')
+
+    def _settle(self, session_id):
+        """Apply the session's queued write-behind writes before touching its document directly."""
+        if self.write_behind is not None:
+            self.write_behind.settle(session_id)
+
+    def _stored_fields(self, fields):
+        """Stored `data` fields behind the requested ones ('memory' is the message log)."""
+        if fields is None:
+            return None
+        stored = set(fields)
+        if 'memory' in stored:
+            stored.add('memory_log')
+        return stored
+
+    def _load(self, session_id, fields=None):
+        """
+        Return the stored `data` subdocument, or only `fields` of it, from the worker cache
+        when its version is current.
+        """
+        self._settle(session_id)
+        if self.cache is not None and self.cache.cached_version(session_id, fields) is not None:
+            with span('mongo_find'):
+                head = self.collection.find_one({'_id': session_id}, {'version': 1})
+            if not head:
+                self.cache.invalidate(session_id)
+                return None
+            data = self.cache.get(session_id, head.get('version'), fields)
+            if data is not None:
+                return data
+        projection = {'data': 1, 'version': 1}
+        if fields is not None:
+            projection = {f'data.{f}': 1 for f in fields}
+            projection['version'] = 1
+        with span('mongo_find'):
+            doc = self.collection.find_one({'_id': session_id}, projection)
         if not doc or 'data' not in doc:
-            return {}
-        data = doc['data']
+            return None
+        size = len(bson.encode(doc['data']))
+        observe(SESSION_DOCUMENT_BYTES, size)
+        if self.cache is not None:
+            self.cache.put(session_id, doc.get('version'), doc['data'], size, fields)
+        return doc['data']
+
+    def _write(self, session_id, update, mutate=None, fence=None, touched=None, defer=False):
+        """
+        Apply `update` and bump the document version. `mutate` replays the same change on
+        the cached copy (write-through) when the copy holds the `touched` fields; without
+        it the cached entry is dropped.
+        With a `fence` (lease token from acquire_lease) the write only applies while that
+        lease is still the latest one, otherwise LeaseLost is raised.
+        With `defer` and write-behind on, the write is queued instead (see WriteBehind).
+        """
+        update.setdefault('$inc', {})['version'] = 1
+        if defer and self.write_behind is not None:
+            self.write_behind.enqueue(session_id, update, fence, (mutate, touched))
+            return
+        self._settle(session_id)
+        query = {'_id': session_id}
+        if fence is not None:
+            query['lease_token'] = fence
+        with span('mongo_update'):
+            doc = self.collection.find_one_and_update(
+                query, update,
+                projection={'version': 1}, upsert=fence is None, return_document=ReturnDocument.AFTER
+            )
+        if doc is None:
+            if self.cache is not None:
+                self.cache.invalidate(session_id)
+            raise LeaseLost(f"session {session_id} was taken over by a newer request")
+        if self.cache is not None:
+            if mutate is None:
+                self.cache.invalidate(session_id)
+            else:
+                self.cache.update(session_id, doc['version'], mutate, touched)
+
+    def get(self, session_id, fields=None):
+        """
+        Session data for the handlers: conversation fields plus the artifacts. `fields`
+        (e.g. CHAT_FIELDS) limits the read to what the caller uses.
+        """
+        conversation = None if fields is None else [
+            f for f in fields if f not in ARTIFACT_FIELDS and f not in PROFILE_FIELDS]
+        artifacts = [f for f in ARTIFACT_FIELDS if fields is None or f in fields]
+        data = {}
+        if conversation is None or conversation:
+            data = self._load(session_id, self._stored_fields(conversation)) or {}
+        if artifacts:
+            data.update(self.get_fields(session_id, artifacts))
+        if self.mode == 'log':
+            if data.get('memory'):
+                # Legacy pickled document: convert it in place on first read
+                data['memory_log'] = self._migrate_pickled(session_id, pickle.loads(data.pop('memory')))
+            records = data.pop('memory_log', None)
+            if records:
+                with span('deserialize'):
+                    data['memory'] = memory_from_records(records, self.memory_window)
+            return data
         # Unpickle memory
         if 'memory' in data and data['memory']:
-            data['memory'] = pickle.loads(data['memory'])
+            with span('deserialize'):
+                data['memory'] = pickle.loads(data['memory'])
         return data
 
-    def set(self, session_id, data):
-        # Pickle memory for storage
-        data_to_store = data.copy()
-        if 'memory' in data_to_store and data_to_store['memory']:
-            data_to_store['memory'] = pickle.dumps(data_to_store['memory'])
-        self.collection.update_one(
-            {'_id': session_id},
-            {'$set': {'data': data_to_store, 'last_access': time.time()}},
-            upsert=True
+    def set(self, session_id, data, fence=None):
+        """
+        $set the passed fields. In log mode the memory is only written by save_turn;
+        in pickle mode it is pickled and rewritten whole.
+        """
+        fields = {key: value for key, value in data.items()
+                  if key not in ARTIFACT_FIELDS and key not in PROFILE_FIELDS}
+        artifacts = {key: value for key, value in data.items() if key in ARTIFACT_FIELDS}
+        if artifacts:
+            self.update_fields(session_id, artifacts)
+        if 'description' in data:
+            self.upsert_profile(session_id, data['description'])
+        if self.mode == 'log':
+            fields = {key: value for key, value in fields.items()
+                      if key not in ('memory', 'memory_log', 'turn_count')}
+        elif fields.get('memory'):
+            with span('serialize'):
+                fields['memory'] = pickle.dumps(fields['memory'])
+        if not fields:
+            return
+        update = {f'data.{key}': value for key, value in fields.items()}
+        update['last_access'] = _now()
+        self._write(session_id, {'$set': update},
+                    lambda cached: cached.update(copy.deepcopy(fields)), fence, set(fields), defer=True)
+
+    def save_turn(self, session_id, data, user_input, output, fence=None):
+        """Persist one chat turn. `data['memory']` must already contain the turn."""
+        if self.mode != 'log':
+            # the summary trigger counts turns in pickle mode too
+            if 'turn_count' in data:
+                data['turn_count'] += 1
+            else:
+                data['turn_count'] = len(data['memory'].chat_memory.messages) // 2
+            # only the turn's fields: the summary may have been updated since `data` was read
+            self.set(session_id, {'memory': data['memory'], 'turn_count': data['turn_count']}, fence)
+            return
+        data['turn_count'] = data.get('turn_count', 0) + 1
+        records = [{'type': 'human', 'content': user_input}, {'type': 'ai', 'content': output}]
+
+        def append(cached):
+            log = cached.setdefault('memory_log', [])
+            log.extend(copy.deepcopy(records))
+            del log[:-2 * self.memory_window]
+            cached['turn_count'] = cached.get('turn_count', 0) + 1
+
+        self._write(
+            session_id,
+            {
+                '$push': {'data.memory_log': {'$each': records, '$slice': -2 * self.memory_window}},
+                '$inc': {'data.turn_count': 1},
+                '$set': {'last_access': _now()},
+            },
+            append,
+            fence,
+            {'memory_log', 'turn_count'},
+            defer=True
+        )
+
+    def get_fields(self, session_id, fields):
+        """Projected read of selected fields, bypassing the session cache."""
+        artifacts = [f for f in fields if f in ARTIFACT_FIELDS]
+        conversation = [f for f in fields if f not in ARTIFACT_FIELDS]
+        data = {}
+        if artifacts:
+            doc = self.artifacts.find_one({'_id': session_id}, {f: 1 for f in artifacts})
+            if doc is None:
+                doc = self._split_legacy(session_id) or {}
+            data.update({f: doc[f] for f in artifacts if f in doc})
+        if conversation:
+            self._settle(session_id)
+            doc = self.collection.find_one({'_id': session_id}, {f'data.{f}': 1 for f in conversation})
+            data.update((doc or {}).get('data', {}))
+        return data
+
+    def update_fields(self, session_id, fields):
+        """$set individual fields without touching the rest of the session (both modes)."""
+        now = _now()
+        artifacts = {key: value for key, value in fields.items() if key in ARTIFACT_FIELDS}
+        conversation = {key: value for key, value in fields.items() if key not in ARTIFACT_FIELDS}
+        if artifacts:
+            self.artifacts.update_one({'_id': session_id}, {'$set': dict(artifacts, last_access=now)},
+                                      upsert=True)
+        if conversation:
+            update = {f'data.{key}': value for key, value in conversation.items()}
+            update['last_access'] = now
+            self._write(session_id, {'$set': update},
+                        lambda cached: cached.update(copy.deepcopy(conversation)), touched=set(conversation))
+
+    def acquire_lease(self, session_id, owner, ttl):
+        """
+        Take the session lease if it is free or expired: (token, last_result), or None while
+        someone else holds it. The token is a counter bumped on every acquisition, so it
+        doubles as the fence for that holder's writes.
+        """
+        self._settle(session_id)
+        now = time.time()
+        try:
+            doc = self.collection.find_one_and_update(
+                {'_id': session_id, '$or': [{'lease': None}, {'lease.expires': {'$lt': now}}]},
+                {
+                    '$set': {'lease': {'owner': owner, 'expires': now + ttl}, 'last_access': _now()},
+                    '$inc': {'lease_token': 1},
+                },
+                projection={'lease_token': 1, 'last_result': 1}, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # the document exists but the filter did not match: the lease is held
+            return None
+        return doc['lease_token'], doc.get('last_result')
+
+    def release_lease(self, session_id, token, last_result=None):
+        """
+        Free the lease if `token` still holds it, recording the turn's result for retries.
+        With write-behind the release is queued behind the turn's writes.
+        """
+        update = {'$unset': {'lease': ''}}
+        if last_result is not None:
+            update['$set'] = {'last_result': last_result}
+        if self.write_behind is not None:
+            if self.write_behind.enqueue(session_id, update, token, merge_only=True):
+                return
+            self.write_behind.settle(session_id)
+        self.collection.update_one({'_id': session_id, 'lease_token': token}, update)
+
+    def _migrate_pickled(self, session_id, memory):
+        records = records_from_memory(memory, self.memory_window)
+        turn_count = len(memory.chat_memory.messages) // 2
+
+        def convert(cached):
+            cached.pop('memory', None)
+            cached['memory_log'] = copy.deepcopy(records)
+            cached['turn_count'] = turn_count
+
+        self._write(
+            session_id,
+            {
+                '$set': {'data.memory_log': records, 'data.turn_count': turn_count},
+                '$unset': {'data.memory': ''},
+            },
+            convert,
+            touched={'memory', 'memory_log', 'turn_count'}
         )
+        return records
+
+    def migrate_pickled_sessions(self):
+        """Convert every remaining pickled-memory document to the message-log layout."""
+        migrated = 0
+        for doc in self.collection.find({'data.memory': {'$type': 'binData'}}, {'data.memory': 1}):
+            self._migrate_pickled(doc['_id'], pickle.loads(doc['data']['memory']))
+            migrated += 1
+        return migrated
+
+    def _split_legacy(self, session_id, doc=None):
+        """
+        Move the profile and artifact fields of a pre-split session document into their
+        own collections. Returns the artifact fields found, or None if there were none.
+        """
+        legacy = PROFILE_FIELDS + ARTIFACT_FIELDS
+        if doc is None:
+            doc = self.collection.find_one({'_id': session_id}, {f'data.{f}': 1 for f in legacy})
+        data = (doc or {}).get('data') or {}
+        if not any(f in data for f in legacy):
+            return None
+        now = _now()
+        if 'description' in data:
+            self.profiles.update_one(
+                {'_id': session_id},
+                {'$setOnInsert': {'description': data['description'], 'created': now, 'last_access': now}},
+                upsert=True)
+        artifacts = {f: data[f] for f in ARTIFACT_FIELDS if f in data}
+        if artifacts:
+            self.artifacts.update_one({'_id': session_id}, {'$setOnInsert': dict(artifacts, last_access=now)},
+                                      upsert=True)
+
+        def drop(cached):
+            for f in legacy:
+                cached.pop(f, None)
+
+        self._write(session_id, {'$unset': {f'data.{f}': '' for f in legacy if f in data}}, drop,
+                    touched=set(legacy))
+        return artifacts
+
+    def migrate_split_sessions(self):
+        """Move profile and artifact fields out of every pre-split session document."""
+        legacy = PROFILE_FIELDS + ARTIFACT_FIELDS
+        query = {'$or': [{f'data.{f}': {'$exists': True}} for f in legacy]}
+        migrated = 0
+        for doc in self.collection.find(query, {f'data.{f}': 1 for f in legacy}):
+            if self._split_legacy(doc['_id'], doc) is not None:
+                migrated += 1
+        return migrated
+
+    def migrate_last_access(self):
+        """Convert numeric last_access timestamps (written before they were Dates) so TTL expires them."""
+        migrated = 0
+        for collection in (self.collection, self.artifacts, self.profiles):
+            for doc in collection.find({'last_access': {'$type': 'number'}}, {'last_access': 1}):
+                at = datetime.fromtimestamp(doc['last_access'], timezone.utc)
+                # only if untouched since the read: a request may have renewed it meanwhile
+                migrated += collection.update_one({'_id': doc['_id'], 'last_access': doc['last_access']},
+                                                  {'$set': {'last_access': at}}).modified_count
+        return migrated
 
     def delete(self, session_id):
+        self._settle(session_id)
         self.collection.delete_one({'_id': session_id})
+        self.artifacts.delete_one({'_id': session_id})
+        self.profiles.delete_one({'_id': session_id})
+        if self.cache is not None:
+            self.cache.invalidate(session_id)
 
     def cleanup(self):
         pass  # MongoDB TTL does this automatically
@@ -40,21 +835,37 @@ class MongoDBSessionMemoryStore:
     # --- New methods for login/signup ---
     def upsert_profile(self, session_id, description):
         """Create or update a user profile tied to session_id"""
-        self.collection.update_one(
+        now = _now()
+        self.profiles.update_one(
             {"_id": session_id},
-            {"$set": {
-                "data.description": description,
-                "last_access": time.time()
-            }},
+            {"$set": {"description": description, "last_access": now}, "$setOnInsert": {"created": now}},
             upsert=True
         )
-        return self.get_profile(session_id)
+        return {"session_id": session_id, "description": description}
 
     def get_profile(self, session_id):
-        doc = self.collection.find_one({"_id": session_id})
+        """Profile lookup that only reads the profile record; also renews its TTL."""
+        doc = self.profiles.find_one_and_update(
+            {"_id": session_id}, {"$set": {"last_access": _now()}}, projection={"description": 1}
+        )
         if not doc:
-            return None
+            if self._split_legacy(session_id) is None:
+                return None
+            doc = self.profiles.find_one({"_id": session_id}, {"description": 1})
+            if not doc:
+                return None
         return {
             "session_id": session_id,
-            "description": doc.get("data", {}).get("description", "")
+            "description": doc.get("description", "")
         }
+
+
+if __name__ == '__main__':
+    # One-off migration of legacy sessions and index setup: python session_memory.py
+    from dotenv import load_dotenv
+    load_dotenv()
+    store = MongoDBSessionMemoryStore(os.getenv("MONGODB_URI"), mode='log', ensure_indexes=False)
+    store.ensure_indexes()
+    print(f"Migrated {store.migrate_pickled_sessions()} pickled sessions to the message log layout.")
+    print(f"Moved profiles and stories out of {store.migrate_split_sessions()} session documents.")
+    print(f"Converted {store.migrate_last_access()} numeric last_access timestamps to dates.")
@@ -0,0 +1,259 @@
+"""
+Per-session ordering and single-flight for the handlers that read, call DeepSeek and
+write a session back (/api/chat, /api/pure_deepseek_chat and their stream variants).
+
+A turn holds two locks for its whole get -> LLM -> save:
+- a FIFO slot in this worker's lock table, so requests for one session run in arrival order;
+- a lease on the session document (`lease`, `lease_token`), so turns on other gunicorn
+  workers and hosts wait as well. The turn's writes are fenced on `lease_token`: if the
+  lease expired and another request took it, the stale turn fails with LeaseLost instead
+  of overwriting the newer one.
+
+An identical request (same session, endpoint and input) that arrives while the first is
+in flight in this worker waits for it and shares its result. Once a turn has finished,
+the same input again is a new turn: people do send "好" twice. Clients that retry send
+an Idempotency-Key header; the result of a turn with a key is kept on the document
+(`last_result`) for SESSION_DEDUPE_WINDOW seconds, so a retry with the same key that
+lands on another worker, or after the first finished, is answered without a second
+LLM call.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from metrics import SESSION_TURNS, inc, span
+from narrative_jobs import worker_id
+
+SESSION_COORDINATION = os.getenv("SESSION_COORDINATION", "1") == "1"
+# longer than any single turn; an expired lease lets the next request in
+SESSION_LEASE_TTL = float(os.getenv("SESSION_LEASE_TTL", "120"))
+# how long a request waits for the turns queued before it (409 after that)
+SESSION_LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "30"))
+SESSION_DEDUPE_WINDOW = float(os.getenv("SESSION_DEDUPE_WINDOW", "10"))
+
+
+class SessionBusy(Exception):
+    """The session stayed locked by earlier turns for longer than the lock timeout."""
+
+
+def request_key(endpoint, user_input):
+    return hashlib.sha256(f"{endpoint}\0{user_input}".encode("utf-8")).hexdigest()[:16]
+
+
+def idempotency_key(endpoint, header):
+    """Key of a request's Idempotency-Key header value, or None when it sent none."""
+    if not header:
+        return None
+    return hashlib.sha256(f"{endpoint}\0idempotency\0{header}".encode("utf-8")).hexdigest()[:16]
+
+
+class _Slot:
+    """FIFO of the requests waiting for one session in this worker."""
+    def __init__(self):
+        self.queue = deque()
+
+
+class SessionTurn:
+    """
+    The right to modify one session; `fence` goes to the store's writes. `key` is the
+    request's idempotency key, if it has one.
+    """
+    def __init__(self, coordinator, session_id, key, ticket, fence=None, previous=None):
+        self.coordinator = coordinator
+        self.session_id = session_id
+        self.key = key
+        self.ticket = ticket
+        self.fence = fence
+        # result of the last turn, if it had the same idempotency key and is recent enough to reuse
+        self.previous = previous
+        self.result = None
+        self.released = False
+
+    def finish(self, result):
+        """Record the turn's result; it is stored for retries when the turn is released."""
+        inc(SESSION_TURNS, 'executed')
+        self.result = result
+
+    def release(self):
+        with self.coordinator._cond:
+            if self.released:
+                return
+            self.released = True
+        self.coordinator._release(self)
+
+    async def arelease(self):
+        """release() in a thread; it runs to the end even if the awaiting task is cancelled."""
+        await asyncio.shield(asyncio.get_running_loop().run_in_executor(None, self.release))
+
+
+def _release_abandoned(future):
+    """Done-callback for an acquire whose caller was cancelled: give the turn back."""
+    if not future.cancelled() and future.exception() is None:
+        asyncio.get_running_loop().run_in_executor(None, future.result().release)
+
+
+class SessionCoordinator:
+    def __init__(self, store, enabled=SESSION_COORDINATION, lease_ttl=SESSION_LEASE_TTL,
+                 lock_timeout=SESSION_LOCK_TIMEOUT, dedupe_window=SESSION_DEDUPE_WINDOW):
+        self.store = store
+        self.enabled = enabled
+        self.lease_ttl = lease_ttl
+        self.lock_timeout = lock_timeout
+        self.dedupe_window = dedupe_window
+        self._cond = threading.Condition()
+        self._slots = {}  # session_id -> _Slot
+        self._inflight = {}  # (session_id, key) -> Future
+        self._ainflight = {}  # (session_id, key) -> asyncio.Future, event loop thread only
+
+    def acquire(self, session_id, key=None):
+        """
+        Wait for this session's earlier turns, then take its lease. Raises SessionBusy
+        after lock_timeout; the caller must release() the returned turn. `key` is the
+        request's idempotency_key(), if any.
+        """
+        if not self.enabled:
+            return SessionTurn(self, session_id, key, None)
+        deadline = time.monotonic() + self.lock_timeout
+        ticket = object()
+        with span('session_lock'):
+            with self._cond:
+                slot = self._slots.get(session_id)
+                if slot is None:
+                    slot = self._slots[session_id] = _Slot()
+                slot.queue.append(ticket)
+                while slot.queue[0] is not ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._leave(session_id, slot, ticket)
+                        inc(SESSION_TURNS, 'busy')
+                        raise SessionBusy(f"session {session_id} is busy, retry later")
+                    self._cond.wait(remaining)
+            try:
+                lease = self._lease(session_id, deadline)
+            except BaseException:
+                with self._cond:
+                    self._leave(session_id, slot, ticket)
+                raise
+        fence, last_result = lease
+        previous = None
+        if (key is not None and last_result and last_result.get('key') == key
+                and time.time() - last_result.get('at', 0) <= self.dedupe_window):
+            previous = last_result.get('value')
+            inc(SESSION_TURNS, 'replayed')
+        return SessionTurn(self, session_id, key, ticket, fence, previous)
+
+    async def aacquire(self, session_id, key=None):
+        """
+        acquire() in a thread. A cancelled caller (e.g. the client went away) stops
+        waiting at once; the turn, if the thread still gets it, is released right away.
+        """
+        future = asyncio.ensure_future(asyncio.to_thread(self.acquire, session_id, key))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(_release_abandoned)
+            raise
+
+    def _lease(self, session_id, deadline):
+        """Poll for the Mongo lease (held by another worker) until the deadline."""
+        delay = 0.02
+        while True:
+            lease = self.store.acquire_lease(session_id, worker_id(), self.lease_ttl)
+            if lease is not None:
+                return lease
+            if time.monotonic() + delay > deadline:
+                inc(SESSION_TURNS, 'busy')
+                raise SessionBusy(f"session {session_id} is busy, retry later")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    def _leave(self, session_id, slot, ticket):
+        slot.queue.remove(ticket)
+        if not slot.queue:
+            del self._slots[session_id]
+        self._cond.notify_all()
+
+    def _release(self, turn):
+        if turn.ticket is None:
+            return
+        try:
+            last_result = None
+            if turn.key is not None and turn.result is not None:
+                last_result = {'key': turn.key, 'value': turn.result, 'at': time.time()}
+            self.store.release_lease(turn.session_id, turn.fence, last_result)
+        finally:
+            with self._cond:
+                self._leave(turn.session_id, self._slots[turn.session_id], turn.ticket)
+
+    def run(self, session_id, key, fn, idempotency=None):
+        """
+        fn(fence) as one ordered turn, returning its result. Concurrent requests with the
+        same `key` (request_key()) share one call (and its exception). With an
+        `idempotency` key, requests share by that instead, and a recent turn with the
+        same one is reused.
+        """
+        if not self.enabled:
+            return fn(None)
+        key = idempotency or key
+        with self._cond:
+            future = self._inflight.get((session_id, key))
+            leader = future is None
+            if leader:
+                future = self._inflight[(session_id, key)] = Future()
+        if not leader:
+            inc(SESSION_TURNS, 'coalesced')
+            return future.result()
+        try:
+            turn = self.acquire(session_id, idempotency)
+            try:
+                if turn.previous is not None:
+                    result = turn.previous
+                else:
+                    result = fn(turn.fence)
+                    turn.finish(result)
+            finally:
+                turn.release()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._cond:
+                del self._inflight[(session_id, key)]
+        future.set_result(result)
+        return result
+
+    async def arun(self, session_id, key, afn, idempotency=None):
+        """Async twin of run(); the lock waits and lease round trips run in threads."""
+        if not self.enabled:
+            return await afn(None)
+        key = idempotency or key
+        future = self._ainflight.get((session_id, key))
+        if future is not None:
+            inc(SESSION_TURNS, 'coalesced')
+            return await asyncio.shield(future)
+        future = self._ainflight[(session_id, key)] = asyncio.get_running_loop().create_future()
+        try:
+            turn = await self.aacquire(session_id, idempotency)
+            try:
+                if turn.previous is not None:
+                    result = turn.previous
+                else:
+                    result = await afn(turn.fence)
+                    turn.finish(result)
+            finally:
+                await turn.arelease()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here so a lone request does not log "never retrieved"
+            raise
+        finally:
+            del self._ainflight[(session_id, key)]
+        future.set_result(result)
+        return result
@@ -0,0 +1,132 @@
+"""
+SSE framing for the text streams.
+
+Text frames carry {"text": ...} as UTF-8 JSON, not ASCII-escaped: a CJK character is
+3 bytes on the wire instead of a 6-byte \\uXXXX escape.
+
+The narrative streams coalesce chunks (TextFrames). The first text frame goes out at
+once, for the time to first token. Later chunks wait up to SSE_COALESCE_WINDOW seconds,
+or until SSE_COALESCE_BYTES of text is pending, and go out as one frame. Its id is the
+offset after its last chunk, so Last-Event-ID resumes exactly as before. Clients see
+the same events, only with longer texts, and join them as they always did.
+
+Clients that send Accept-Encoding: gzip or deflate get the stream compressed
+(SSE_COMPRESSION=1). Every event is sync-flushed, so it can be decoded as soon as it
+arrives; keep-alive pings included.
+"""
+import os
+import json
+import time
+import zlib
+
+SSE_COALESCE_WINDOW = float(os.getenv("SSE_COALESCE_WINDOW", "0.04"))  # 0: a frame per chunk, as before
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "1024"))
+SSE_COMPRESSION = os.getenv("SSE_COMPRESSION", "1") == "1"
+
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def text_event(text, event_id=None):
+    data = json.dumps({'text': text}, ensure_ascii=False)
+    if event_id is None:
+        return f"data: {data}\n\n"
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+
+class TextFrames:
+    """Chunks of one stream, held back and joined into fewer text frames."""
+    def __init__(self, window=SSE_COALESCE_WINDOW, max_bytes=SSE_COALESCE_BYTES):
+        self.window = window
+        self.max_bytes = max_bytes
+        self._parts = []  # (end offset, text)
+        self._bytes = 0
+        self._since = None
+        self._sent = False
+
+    def add(self, end, text):
+        if not self._parts:
+            self._since = time.monotonic()
+        self._parts.append((end, text))
+        self._bytes += len(text.encode('utf-8'))
+
+    def wait_time(self):
+        """Seconds until the pending text is due, or None when nothing is pending."""
+        if not self._parts:
+            return None
+        if not self._sent or self._bytes >= self.max_bytes:
+            return 0.0
+        return max(0.0, self._since + self.window - time.monotonic())
+
+    def due(self):
+        return self.wait_time() == 0.0
+
+    def flush(self):
+        """The pending text as one frame ('' when nothing is pending)."""
+        if not self._parts:
+            return ''
+        if self.window <= 0:
+            frame = ''.join(text_event(text, end) for end, text in self._parts)
+        else:
+            frame = text_event(''.join(text for _, text in self._parts), self._parts[-1][0])
+        self._parts = []
+        self._bytes = 0
+        self._sent = True
+        return frame
+
+
+def negotiate(accept_encoding, enabled=SSE_COMPRESSION):
+    """'gzip', 'deflate' or None for a request's Accept-Encoding header."""
+    if not enabled or not accept_encoding:
+        return None
+    offered = set()
+    for item in accept_encoding.split(','):
+        name, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            offered.add(name.strip().lower())
+    for encoding in ('gzip', 'deflate'):
+        if encoding in offered:
+            return encoding
+    return None
+
+
+def _compressor(encoding):
+    return zlib.compressobj(6, zlib.DEFLATED, _WBITS[encoding])
+
+
+def encode_stream(events, encoding=None):
+    """SSE events (str) as bytes, compressed with a sync flush per event when `encoding` is set."""
+    compressor = _compressor(encoding) if encoding is not None else None
+    try:
+        for event in events:
+            if compressor is None:
+                yield event.encode('utf-8')
+            else:
+                yield compressor.compress(event.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        events.close()  # a client that left closes this wrapper, not the events generator
+
+
+async def aencode_stream(events, encoding=None):
+    """Async twin of encode_stream for the ASGI app."""
+    compressor = _compressor(encoding) if encoding is not None else None
+    try:
+        async for event in events:
+            if compressor is None:
+                yield event.encode('utf-8')
+            else:
+                yield compressor.compress(event.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        await events.aclose()
+
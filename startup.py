@@ -0,0 +1,79 @@
+"""
+Worker warm-up and the /healthz readiness report.
+
+Importing app.py or asgi_app.py does no I/O and skips LangChain's slow modules, so a
+worker boots quickly and a --preload master holds nothing that is unsafe to fork. Each
+worker warms itself in a background thread once it is running (gunicorn's
+post_worker_init hook, the ASGI app's before_serving, or its first request): it imports
+the modules the first chain build needs and connects to Mongo, which also starts the
+TTL index check. /healthz answers 503 until both are done.
+"""
+import os
+import time
+import logging
+import threading
+
+from helper import warm_imports
+
+logger = logging.getLogger(__name__)
+
+WARMUP_RETRY_INTERVAL = 1.0
+_warmups = []
+
+
+class Warmup:
+    def __init__(self, store):
+        self.store = store
+        self.checks = {}
+        self.started = None
+        self.ready_after = None
+        self._pid = None
+        self._lock = threading.Lock()
+        _warmups.append(self)
+
+    def start(self):
+        """Warm this process once; later calls (and calls in the same worker) do nothing."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.started = time.monotonic()
+            self.ready_after = None
+            self.checks = {'imports': 'pending', 'mongo': 'pending'}
+            threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def _run(self):
+        steps = {'imports': warm_imports, 'mongo': self.store.ping}
+        while True:
+            for name, step in steps.items():
+                if self.checks[name] == 'ok':
+                    continue
+                try:
+                    step()
+                    self.checks[name] = 'ok'
+                except Exception as e:
+                    logger.warning("warm-up step %s failed: %s", name, e)
+                    self.checks[name] = f"error: {e}"
+            if all(value == 'ok' for value in self.checks.values()):
+                self.ready_after = time.monotonic() - self.started
+                return
+            time.sleep(WARMUP_RETRY_INTERVAL)
+
+    def status(self):
+        """(ready, report) for /healthz."""
+        self.start()
+        ready = self.ready_after is not None
+        return ready, {
+            'status': 'ready' if ready else 'starting',
+            'pid': os.getpid(),
+            'checks': dict(self.checks),
+            'ready_after': self.ready_after,
+        }
+
+
+def start_all():
+    """Warm every app loaded in this process (gunicorn post_worker_init)."""
+    for warmup in _warmups:
+        warmup.start()
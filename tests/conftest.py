@@ -0,0 +1,32 @@
+"""
+Shared fixtures: one fake DeepSeek server (benchmarks/fake_deepseek.py) for the whole
+run, since helper.py reads DEEPSEEK_API_BASE once at import, and the Flask app on mongomock.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+
+@pytest.fixture(scope='session')
+def deepseek():
+    from fake_deepseek import FakeDeepSeekConfig, serve
+    config = FakeDeepSeekConfig(latency=0.05, tokens_per_second=200, reply_tokens=200)
+    _, base_url = serve(config)
+    os.environ["DEEPSEEK_API_BASE"] = base_url
+    os.environ.setdefault("DEEPSEEK_API_KEY_1", "test-key-1")
+    os.environ.setdefault("NARRATIVE_SPECULATION", "0")
+    os.environ.setdefault("ADMISSION_CONTROL", "0")
+    return config
+
+
+@pytest.fixture(scope='session')
+def app(deepseek):
+    mongomock = pytest.importorskip('mongomock')
+    import session_memory
+    session_memory.MongoClient = mongomock.MongoClient
+    import app
+    return app
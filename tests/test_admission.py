@@ -0,0 +1,28 @@
+"""
+Admission (admission.py) of the handlers that hold a session turn: a request queued
+behind an earlier turn of its session holds no permit while it waits.
+"""
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_lock_wait_holds_no_permit(app, monkeypatch):
+    from admission import AdmissionController
+    admission = AdmissionController(enabled=True, threads=0, initial_limit=2, min_limit=2, max_limit=2)
+    monkeypatch.setattr(app, 'admission', admission)
+    session_id = f"admit-{uuid.uuid4().hex[:8]}"
+
+    def post(text):
+        client = app.app.test_client()
+        return client.post('/api/pure_deepseek_chat', json={'session_id': session_id, 'input': text}).status_code
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(post, '第一个问题')
+        time.sleep(0.3)
+        second = pool.submit(post, '第二个问题')  # waits for the first turn
+        time.sleep(0.3)
+        assert admission.stats()['in_flight'] == 1
+        assert first.result() == 200 and second.result() == 200
+    assert admission.stats()['in_flight'] == 0
+    assert len(app.session_memory_store.get(session_id)['messages']) == 4
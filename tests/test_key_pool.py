@@ -0,0 +1,99 @@
+"""
+DeepSeek key pool (deepseek_key_manager.py): per-key rate budgets, 429 cool-down,
+failover to another key, revoked keys and the rate-limit headers.
+"""
+import os
+import time
+from email.utils import formatdate
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def keys():
+    os.environ.setdefault("DEEPSEEK_API_KEY_1", "test-key-1")
+    import deepseek_key_manager
+    return deepseek_key_manager
+
+
+def drain(keys, manager):
+    """Leases granted right away until the pool has no budget left."""
+    granted = 0
+    while True:
+        try:
+            lease = manager.lease(timeout=0)
+        except keys.KeyPoolExhausted:
+            return granted
+        lease.succeeded()
+        granted += 1
+
+
+@pytest.mark.parametrize('n_keys', [1, 2, 4])
+def test_rpm_budget_scales_with_the_number_of_keys(keys, n_keys):
+    manager = keys.DeepSeekKeyManager([f"k{i}" for i in range(n_keys)], rpm=30)
+    assert drain(keys, manager) == 30 * n_keys
+
+
+def test_refill_rate_scales_with_the_number_of_keys(keys):
+    rates = []
+    for n_keys in (1, 2):
+        manager = keys.DeepSeekKeyManager([f"k{i}" for i in range(n_keys)], rpm=1200)
+        drain(keys, manager)
+        start = time.monotonic()
+        granted = 0
+        while time.monotonic() - start < 1.0:
+            manager.lease(timeout=1).succeeded()
+            granted += 1
+        rates.append(granted / (time.monotonic() - start))
+    assert rates[1] > 1.5 * rates[0]
+
+
+def test_429_cools_the_key_down_for_at_least_retry_after(keys):
+    manager = keys.DeepSeekKeyManager(['a', 'b'])
+    lease = manager.lease(exclude=('b',))
+    assert lease.key == 'a'
+    lease.rate_limited(retry_after=5.0)
+    state = next(s for s in manager._states if s.key == 'a')
+    assert state.cooldown_until - time.monotonic() >= 4.9
+    assert [manager.lease(timeout=0).key for _ in range(3)] == ['b'] * 3
+
+    single = keys.DeepSeekKeyManager(['a'])
+    single.lease().rate_limited(retry_after=5.0)
+    with pytest.raises(keys.KeyPoolExhausted) as exhausted:
+        single.lease(timeout=0)
+    assert exhausted.value.retry_after >= 4.9
+
+
+def test_lease_fails_over_to_another_key(keys):
+    manager = keys.DeepSeekKeyManager(['a', 'b', 'c'])
+    for _ in range(5):
+        lease = manager.lease(exclude=('a', 'b'))
+        assert lease.key == 'c'
+        lease.succeeded()
+    # with nothing else left, an excluded key is still better than none
+    assert keys.DeepSeekKeyManager(['a']).lease(exclude=('a',)).key == 'a'
+
+
+def test_revoked_key_is_removed_but_the_last_one_is_kept(keys):
+    manager = keys.DeepSeekKeyManager(['a', 'b'])
+    removed = []
+    manager.add_removal_listener(removed.append)
+    manager.lease(exclude=('b',)).revoked()
+    assert manager.keys == ['b'] and removed == ['a']
+    manager.lease().revoked()
+    assert manager.keys == ['b'] and removed == ['a']
+
+
+def test_parse_retry_after(keys):
+    parse = keys.parse_retry_after
+    assert parse(None) is None
+    assert parse({}) is None
+    assert parse({'Retry-After': '7'}) == 7.0
+    assert parse({'Retry-After': '-3'}) == 0.0
+    assert parse({'retry-after-ms': '1500', 'Retry-After': '7'}) == 1.5
+    assert 28 <= parse({'Retry-After': formatdate(time.time() + 30, usegmt=True)}) <= 30
+    assert parse({'Retry-After': formatdate(time.time() - 60, usegmt=True)}) == 0.0
+    assert parse({'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '6m0s'}) == 360.0
+    assert parse({'x-ratelimit-remaining-tokens': '0', 'x-ratelimit-reset-tokens': '20ms'}) == pytest.approx(0.02)
+    assert parse({'x-ratelimit-remaining-requests': '5', 'x-ratelimit-reset-requests': '1s'}) is None
+    assert parse({'Retry-After': 'soon'}) is None
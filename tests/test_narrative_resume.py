@@ -0,0 +1,83 @@
+"""
+Last-Event-ID resume of /api/generate_narrative_sse (narrative_jobs.py), through the
+Flask app against the fake DeepSeek server (benchmarks/fake_deepseek.py) and mongomock.
+"""
+import json
+
+import pytest
+
+URL = '/api/generate_narrative_sse'
+
+
+@pytest.fixture
+def session_id(app, request):
+    session_id = f"resume-{request.node.name}"
+    client = app.app.test_client()
+    resp = client.post('/api/chat', json={'session_id': session_id, 'input': '最近工作压力很大，总是睡不好。'})
+    assert resp.status_code == 200
+    return session_id
+
+
+def events(body):
+    """(id, text) of the text events in an SSE body."""
+    pairs = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if ": " in line)
+        if 'id' in fields:
+            pairs.append((int(fields['id']), json.loads(fields['data'])['text']))
+    return pairs
+
+
+def joined(pairs):
+    return "".join(text for _, text in pairs)
+
+
+def read_some(client, session_id, count):
+    """The first `count` text events of a stream, then drop the connection."""
+    resp = client.get(URL, query_string={'session_id': session_id}, buffered=False)
+    received = []
+    for part in resp.response:
+        received += events(part.decode() if isinstance(part, bytes) else part)
+        if len(received) >= count:
+            break
+    resp.close()
+    return received
+
+
+def test_resume_offset(deepseek):
+    from narrative_jobs import resume_offset
+    assert resume_offset("42") == 42
+    assert resume_offset(None) == 0
+    assert resume_offset("-5") == 0
+    assert resume_offset("abc") == 0
+
+
+def test_reconnect_resumes_after_last_event_id(app, deepseek, session_id):
+    client = app.app.test_client()
+    calls_before = deepseek.completed
+
+    received = read_some(client, session_id, 5)
+    last_id = received[-1][0]
+    assert last_id == len(joined(received))
+
+    body = client.get(URL, query_string={'session_id': session_id},
+                      headers={'Last-Event-ID': str(last_id)}).get_data(as_text=True)
+    assert "event: reset" not in body
+    assert "event: done" in body
+    resumed = events(body)
+    assert resumed[0][0] - len(resumed[0][1]) == last_id  # nothing repeated, nothing skipped
+
+    story = app.session_memory_store.get(session_id)['story']
+    assert (joined(received) + joined(resumed)).strip() == story
+    assert deepseek.completed - calls_before == 1  # the reconnect joined the running job
+
+
+def test_resume_from_finished_job(app, deepseek, session_id):
+    client = app.app.test_client()
+    full = joined(events(client.get(URL, query_string={'session_id': session_id}).get_data(as_text=True)))
+    calls_before = deepseek.completed
+
+    offset = len(full) // 2
+    resumed = client.get(URL, query_string={'session_id': session_id, 'last_event_id': offset})
+    assert joined(events(resumed.get_data(as_text=True))) == full[offset:]
+    assert deepseek.completed == calls_before
@@ -0,0 +1,89 @@
+"""
+Per-session ordering and single-flight (session_turns.py): duplicate submits, distinct
+concurrent turns, two coordinators on one store and the lease fence.
+"""
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+SESSIONS = 4
+DUPLICATES = 3
+DISTINCT = 3
+
+
+def post(app, path, body, headers=None):
+    return app.app.test_client().post(path, json=body, headers=headers).status_code
+
+
+def storm(app, requests):
+    with ThreadPoolExecutor(len(requests)) as pool:
+        return list(pool.map(lambda r: post(app, *r), requests))
+
+
+def new_session(prefix):
+    return f"{prefix}-{uuid.uuid4().hex[:8]}"
+
+
+def test_duplicate_submits_call_deepseek_once(app, deepseek):
+    sessions = [new_session('dup') for _ in range(SESSIONS)]
+    requests = [('/api/chat', {'session_id': s, 'input': '我最近总是睡不好。'}, {'Idempotency-Key': f"{s}-1"})
+                for s in sessions for _ in range(DUPLICATES)]
+    before = deepseek.completed
+    statuses = storm(app, requests)
+    assert statuses == [200] * len(requests)
+    assert deepseek.completed - before == SESSIONS
+    for s in sessions:
+        assert app.session_memory_store.get(s)['turn_count'] == 1
+
+
+def test_distinct_turns_are_all_stored(app):
+    sessions = [new_session('seq') for _ in range(SESSIONS)]
+    requests = [('/api/pure_deepseek_chat', {'session_id': s, 'input': f'第{i}个问题'})
+                for s in sessions for i in range(DISTINCT)]
+    statuses = storm(app, requests)
+    assert statuses == [200] * len(requests)
+    for s in sessions:
+        messages = app.session_memory_store.get(s)['messages']
+        asked = sorted(m['content'] for m in messages if m['role'] == 'user')
+        assert asked == [f'第{i}个问题' for i in range(DISTINCT)]
+
+
+def test_two_coordinators_run_the_work_once(app):
+    from session_turns import SessionCoordinator
+    workers = [SessionCoordinator(app.session_memory_store) for _ in range(2)]
+    runs = []
+
+    def work(fence):
+        runs.append(fence)
+        time.sleep(0.2)
+        return 'reply'
+
+    session_id = new_session('xw')
+    with ThreadPoolExecutor(2 * DUPLICATES) as pool:
+        results = list(pool.map(lambda i: workers[i % 2].run(session_id, 'same-input', work, 'same-key'),
+                                range(2 * DUPLICATES)))
+    assert len(runs) == 1
+    assert results == ['reply'] * (2 * DUPLICATES)
+
+
+def test_stale_turn_cannot_overwrite_the_next_one(app):
+    from session_memory import LeaseLost
+    from session_turns import SessionCoordinator
+    store = app.session_memory_store
+    if store.write_behind is not None:
+        pytest.skip("with write-behind a lost lease is only logged")
+    coordinator = SessionCoordinator(store, lease_ttl=0.1)
+    session_id = new_session('fence')
+
+    stale = coordinator._lease(session_id, time.monotonic() + 1)[0]
+    time.sleep(0.2)  # the lease expires and the next request takes it over
+    fence = coordinator._lease(session_id, time.monotonic() + 1)[0]
+    assert fence != stale
+
+    with pytest.raises(LeaseLost):
+        store.set(session_id, {'summary': 'stale'}, stale)
+    store.set(session_id, {'summary': 'current'}, fence)
+    assert store.get(session_id)['summary'] == 'current'
+    store.release_lease(session_id, fence)